@@ -5,6 +5,8 @@
 # SPDX-License-Identifier: MPL-2.0
 
 import os
+import threading
+import time
 import uuid
 
 __version__ = "0.0.0"
@@ -31,19 +33,283 @@ class EWMA:
         return self._ewma_state / self._weight
 
 
-# Randomized at module load time; we just need something semi-random.
-# 1048573 is the first prime before 1024*1024; resists compression
-# in transit.
-RANDOM_POOL = os.urandom(1048573)
+# Randomized on first use; we just need something semi-random.  The
+# pool size is a prime, which resists compression in transit; by
+# default 1048573, the first prime before 1024*1024.  It may be set
+# between 1 and 64 MiB (rounded down to a prime) with
+# QOSPEEDTEST_POOL_SIZE or configure_pool(), and kept in a file with
+# QOSPEEDTEST_POOL_FILE, which is memory-mapped so that every process
+# using the file shares one copy.
+POOL_SIZE_MIN = 1 << 20
+POOL_SIZE_MAX = 64 << 20
+_random_pool = None
+_random_pool_lock = threading.Lock()
+_pool_config = (None, None)
+
+
+def is_prime(n):
+    if n < 2 or n % 2 == 0:
+        return n == 2
+    i = 3
+    while i * i <= n:
+        if n % i == 0:
+            return False
+        i += 2
+    return True
+
+
+def pool_size(size):
+    """Largest prime not above size, which is kept between 1 and 64 MiB"""
+    n = min(max(size, POOL_SIZE_MIN), POOL_SIZE_MAX)
+    n -= 1 - n % 2
+    while not is_prime(n):
+        n -= 2
+    return n
+
+
+def make_pool(size, path=None):
+    """Random pool of pool_size(size) bytes, memory-mapped from path if given
+
+    An existing file of the right size is reused, otherwise it is
+    (re)generated and atomically replaced.
+    """
+    size = pool_size(size)
+    if path is None:
+        return os.urandom(size)
+    import mmap
+
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        f = None
+    if f is None or os.fstat(f.fileno()).st_size != size:
+        if f is not None:
+            f.close()
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as tmp:
+            left = size
+            while left > 0:
+                tmp.write(os.urandom(min(left, POOL_SIZE_MIN)))
+                left -= POOL_SIZE_MIN
+        os.replace(tmp_path, path)
+        f = open(path, "rb")
+    with f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def configure_pool(size=None, path=None):
+    """Set the random pool size and file, before it is first used"""
+    global _pool_config
+    with _random_pool_lock:
+        if _random_pool is not None:
+            raise RuntimeError("The random pool has already been created")
+        _pool_config = (size, path)
+
+
+def random_pool():
+    """The random pool: bytes, or an mmap if backed by a file"""
+    global _random_pool
+    if _random_pool is None:
+        with _random_pool_lock:
+            if _random_pool is None:
+                size, path = _pool_config
+                if size is None:
+                    size = int(os.environ.get("QOSPEEDTEST_POOL_SIZE") or POOL_SIZE_MIN)
+                if path is None:
+                    path = os.environ.get("QOSPEEDTEST_POOL_FILE") or None
+                _random_pool = make_pool(size, path)
+    return _random_pool
+
+
+def __getattr__(name):
+    # RANDOM_POOL is created lazily, so processes which never send
+    # data (e.g. qospeedtest --version) do not pay for it.
+    if name == "RANDOM_POOL":
+        return random_pool()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 def SemiRandomGenerator(byte_count):
+    """Yield byte_count bytes of the random pool, as bytes objects"""
+    pool = random_pool()
+    pool_len = len(pool)
+    # Slicing an mmap pool copies it into bytes
+    whole = pool if isinstance(pool, bytes) else None
     while byte_count > 0:
-        if byte_count < 1048573:
-            yield RANDOM_POOL[:byte_count]
+        if byte_count < pool_len:
+            yield pool[:byte_count]
+        else:
+            yield whole if whole is not None else pool[:]
+        byte_count -= pool_len
+
+
+class SemiRandomPayload:
+    """Sized, re-iterable semi-random payload
+
+    Iterating yields slices of the random pool of up to chunk_size
+    (or the whole pool), so the payload is never materialized.  len()
+    allows HTTP clients to send a Content-Length rather than using
+    chunked encoding.
+    """
+
+    def __init__(self, byte_count=0, chunk_size=None):
+        self.byte_count = byte_count
+        self.chunk_size = chunk_size
+        # ThroughputSeries to record send progress into, if any
+        self.series = None
+
+    def __len__(self):
+        return self.byte_count
+
+    def __iter__(self):
+        pool = random_pool()
+        pool_len = len(pool)
+        view = memoryview(pool)
+        chunk_size = min(self.chunk_size or pool_len, pool_len)
+        byte_count = self.byte_count
+        series = self.series
+        if series is not None:
+            series.start()
+        sent = 0
+        while sent < byte_count:
+            if series is not None:
+                series.add(sent)
+            offset = sent % pool_len
+            size = min(chunk_size, pool_len - offset, byte_count - sent)
+            yield pool if size == pool_len else view[offset : offset + size]
+            sent += size
+
+
+class ThroughputSeries:
+    """Cumulative bytes over time within a single transfer
+
+    add() is called after each chunk with the bytes transferred so
+    far, but only records a point every interval_ns, so the cost per
+    chunk is a clock read and a comparison.  Offsets are from start().
+
+    Points are only as frequent as the chunks.  Upload progress is the
+    data handed to the socket, which runs ahead of the link by as much
+    as the send buffer holds, and then follows it in steps as the
+    kernel frees buffer space.
+    """
+
+    __slots__ = ("start_ns", "interval_ns", "next_ns", "points")
+
+    def __init__(self, interval_ns=10000000):
+        self.interval_ns = interval_ns
+        self.start()
+
+    def start(self, start_ns=None):
+        self.start_ns = time.perf_counter_ns() if start_ns is None else start_ns
+        self.next_ns = self.start_ns + self.interval_ns
+        self.points = [(0, 0)]
+
+    def add(self, transferred):
+        """Record progress if the interval has passed, returning the current time"""
+        now = time.perf_counter_ns()
+        if now >= self.next_ns:
+            self.points.append((now - self.start_ns, transferred))
+            self.next_ns = now + self.interval_ns
+        return now
+
+    def finish(self, end_ns, transferred):
+        offset = end_ns - self.start_ns
+        if self.points[-1][0] >= offset:
+            self.points[-1] = (offset, transferred)
         else:
-            yield RANDOM_POOL
-        byte_count -= 1048573
+            self.points.append((offset, transferred))
+
+    def steady_bps(self):
+        """Throughput after the slow start head, or None if too few points
+
+        The head ends at the first interval whose rate reaches 90% of
+        the rate over the rest of the transfer, and at most half way
+        through it.
+        """
+        points = self.points
+        if len(points) < 3:
+            return None
+        end_offset, end_bytes = points[-1]
+        for i in range(len(points) - 1):
+            offset, transferred = points[i]
+            if offset * 2 >= end_offset:
+                break
+            next_offset, next_transferred = points[i + 1]
+            interval_rate = (next_transferred - transferred) / (next_offset - offset)
+            if interval_rate >= 0.9 * (end_bytes - transferred) / (end_offset - offset):
+                break
+        if end_offset <= offset:
+            return None
+        return (end_bytes - transferred) * 8e9 / (end_offset - offset)
+
+
+class Sample:
+    """Timing record for a single download/upload transfer
+
+    All times are time.perf_counter_ns() values or durations.  The
+    phases are connection setup (zero if a connection was reused),
+    request send, time to first response byte, and body transfer.
+    Throughput is computed from transfer_ns only.
+    """
+
+    __slots__ = (
+        "mode",
+        "transfer_bytes",
+        "start_ns",
+        "end_ns",
+        "connect_ns",
+        "send_ns",
+        "ttfb_ns",
+        "transfer_ns",
+        "server_ns",
+        "streams",
+        "series",
+    )
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.transfer_bytes = 0
+        self.start_ns = time.perf_counter_ns()
+        self.end_ns = self.start_ns
+        self.connect_ns = 0
+        self.send_ns = 0
+        self.ttfb_ns = 0
+        self.transfer_ns = 0
+        self.server_ns = None
+        self.streams = None
+        self.series = None
+
+    @property
+    def bps(self):
+        if not self.transfer_ns:
+            return 0.0
+        return self.transfer_bytes * 8e9 / self.transfer_ns
+
+    @property
+    def steady_bps(self):
+        """Throughput excluding the slow start head, where a series is available"""
+        if self.streams is not None:
+            return sum(stream.steady_bps for stream in self.streams)
+        steady_bps = self.series.steady_bps() if self.series is not None else None
+        return self.bps if steady_bps is None else steady_bps
+
+    def as_dict(self):
+        ret = {
+            "mode": self.mode,
+            "bytes": self.transfer_bytes,
+            "bps": self.bps,
+            "steady_bps": self.steady_bps,
+            "connect_ns": self.connect_ns,
+            "send_ns": self.send_ns,
+            "ttfb_ns": self.ttfb_ns,
+            "transfer_ns": self.transfer_ns,
+            "server_ns": self.server_ns,
+        }
+        if self.streams is not None:
+            ret["streams"] = [stream.as_dict() for stream in self.streams]
+        if self.series is not None:
+            ret["series"] = self.series.points
+        return ret
 
 
 def guid():
@@ -0,0 +1,284 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import os
+import tempfile
+import threading
+import time
+import weakref
+import zlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Layout of the shared state: the number of active transfers, then
+# (tokens, last refill time) for the global bucket and for each client
+# slot, then (pid, start time, active transfers) for each process.
+_ACTIVE = 0
+_GLOBAL = 1
+_CLIENTS = 3
+
+
+def pid_alive(pid):
+    if os.name != "posix":
+        # Without signal 0 to test with, assume so
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def process_start_time(pid):
+    """Start time of a process in clock ticks since boot, or 0 if unknown"""
+    try:
+        with open("/proc/{}/stat".format(pid), "rb") as f:
+            stat = f.read()
+    except OSError:
+        return 0
+    # Fields follow the command name, which may itself contain ")"
+    return int(stat.rpartition(b")")[2].split()[19])
+
+
+def process_alive(pid, start_time):
+    """Whether the process which claimed a slot is still running
+
+    The start time tells a reused pid apart, where it is known.
+    """
+    if not pid_alive(pid):
+        return False
+    return not start_time or process_start_time(pid) == start_time
+
+
+def remove_lock_file(path, pid):
+    # Only by the process which created it, not those forked from it
+    if os.getpid() == pid:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+class Transfer:
+    """An admitted transfer, to be released once complete"""
+
+    __slots__ = ("admission", "slot", "released")
+
+    def __init__(self, admission, slot):
+        self.admission = admission
+        self.slot = slot
+        self.released = False
+
+    def delay(self, transferred):
+        """Account for bytes transferred, returning seconds to wait before the next"""
+        return self.admission.take(self.slot, transferred)
+
+    def throttle(self, transferred):
+        delay = self.delay(transferred)
+        if delay > 0:
+            time.sleep(delay)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.admission.release()
+
+
+class Admission:
+    """Transfer admission control and rate limiting
+
+    At most max_transfers downloads and uploads run at once, and the
+    bytes sent or received are paced by token buckets: one shared by
+    all transfers (rate, in bytes per second), and one per client
+    address (client_rate).  Buckets hold up to burst_seconds worth of
+    tokens, and may go into debt, which the transfer then sleeps off.
+
+    The counters live in shared memory, so when created before the
+    server forks (as qospeedtest-server does for Gunicorn), all
+    workers and their threads share the same limits.  Client
+    addresses are hashed into client_slots buckets; clients which
+    collide share a bucket.
+
+    Active transfers are also counted per process, so those of a
+    worker which was killed mid-transfer are reclaimed once the
+    limit is reached.  Processes are told apart by pid and start
+    time, so a reused pid does not keep them alive.  The shared state is guarded by flock() where
+    available, which the kernel releases if its holder dies.
+    """
+
+    def __init__(
+        self, max_transfers=0, rate=0.0, client_rate=0.0, burst_seconds=0.1, client_slots=4096, process_slots=256, retry_after=5
+    ):
+        import multiprocessing
+
+        self.max_transfers = max_transfers
+        self.rate = rate
+        self.client_rate = client_rate
+        self.burst_seconds = burst_seconds
+        self.client_slots = client_slots
+        self.process_slots = process_slots
+        self.retry_after = retry_after
+        self.processes = _CLIENTS + 2 * client_slots
+        self.shared = multiprocessing.RawArray("d", self.processes + 3 * process_slots)
+        if fcntl is not None:
+            fd, self.lock_path = tempfile.mkstemp(prefix="qospeedtest-admission-")
+            os.close(fd)
+            self.mp_lock = None
+            weakref.finalize(self, remove_lock_file, self.lock_path, os.getpid())
+        else:
+            self.lock_path = None
+            self.mp_lock = multiprocessing.Lock()
+        self._init_process_state()
+
+    def _init_process_state(self):
+        # State of the current process, set up on first use in each one
+        self.pid = None
+        self.process = None
+        self.lock_fd = None
+        self.thread_lock = None
+        self.init_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ("pid", "process", "lock_fd", "thread_lock", "init_lock"):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_process_state()
+
+    @property
+    def shaping(self):
+        return bool(self.rate or self.client_rate)
+
+    @property
+    def active(self):
+        return int(self.shared[_ACTIVE])
+
+    def _process_lock(self):
+        """Open this process's own lock, after a fork or on first use"""
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+        with self.init_lock:
+            if self.pid == pid:
+                return
+            if self.lock_path is not None:
+                # flock() locks belong to the open file description, so each
+                # process needs its own, and a thread lock as its threads share it
+                self.lock_fd = os.open(self.lock_path, os.O_RDWR | getattr(os, "O_CLOEXEC", 0))
+                self.thread_lock = threading.Lock()
+            self.process = None
+            self.pid = pid
+
+    def __enter__(self):
+        self._process_lock()
+        if self.mp_lock is not None:
+            self.mp_lock.acquire()
+            return self
+        self.thread_lock.acquire()
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        except BaseException:
+            self.thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.mp_lock is not None:
+            self.mp_lock.release()
+            return False
+        fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+        self.thread_lock.release()
+        return False
+
+    def _process_slot(self):
+        """Index of this process's (pid, start time, active) entry, claiming one if need be; called locked"""
+        if self.process is not None:
+            return self.process
+        shared = self.shared
+        pid = self.pid
+        free = None
+        for index in range(self.processes, len(shared), 3):
+            entry_pid = int(shared[index])
+            if entry_pid == pid:
+                # Left by an earlier process with the same pid
+                self._free_process_slot(index)
+                free = index
+                break
+            elif free is None and (not entry_pid or not process_alive(entry_pid, shared[index + 1])):
+                free = index
+        if free is None:
+            raise RuntimeError("No free process slots for transfer admission")
+        self._free_process_slot(free)
+        shared[free] = pid
+        shared[free + 1] = process_start_time(pid)
+        self.process = free
+        return free
+
+    def _free_process_slot(self, index):
+        shared = self.shared
+        shared[_ACTIVE] -= shared[index + 2]
+        shared[index] = 0
+        shared[index + 1] = 0
+        shared[index + 2] = 0
+
+    def reclaim(self):
+        """Release the transfers of processes which have died; called locked"""
+        reclaimed = 0
+        shared = self.shared
+        for index in range(self.processes, len(shared), 3):
+            entry_pid = int(shared[index])
+            if entry_pid and entry_pid != self.pid and not process_alive(entry_pid, shared[index + 1]):
+                reclaimed += int(shared[index + 2])
+                self._free_process_slot(index)
+        return reclaimed
+
+    def admit(self, client=None):
+        """Start a transfer for a client address, or None if the server is busy"""
+        with self:
+            process = self._process_slot()
+            if self.max_transfers and self.shared[_ACTIVE] >= self.max_transfers:
+                if not self.reclaim() or self.shared[_ACTIVE] >= self.max_transfers:
+                    return None
+            self.shared[_ACTIVE] += 1
+            self.shared[process + 2] += 1
+        slot = None
+        if self.client_rate and client is not None:
+            slot = zlib.crc32(client.encode("UTF-8")) % self.client_slots
+        return Transfer(self, slot)
+
+    def release(self):
+        with self:
+            process = self._process_slot()
+            self.shared[_ACTIVE] -= 1
+            self.shared[process + 2] -= 1
+
+    def _take(self, index, transferred, rate, now):
+        shared = self.shared
+        # A zero refill time (never used) fills the bucket
+        tokens = min(rate * self.burst_seconds, shared[index] + (now - shared[index + 1]) * rate) - transferred
+        shared[index] = tokens
+        shared[index + 1] = now
+        return -tokens / rate if tokens < 0 else 0.0
+
+    def take(self, slot, transferred):
+        if not (self.rate or (self.client_rate and slot is not None)):
+            return 0.0
+        with self:
+            now = time.monotonic()
+            delay = 0.0
+            if self.rate:
+                delay = self._take(_GLOBAL, transferred, self.rate, now)
+            if self.client_rate and slot is not None:
+                delay = max(delay, self._take(_CLIENTS + 2 * slot, transferred, self.client_rate, now))
+        return delay
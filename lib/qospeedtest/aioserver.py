@@ -0,0 +1,302 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import asyncio
+import io
+import logging
+import time
+import urllib.parse
+
+from . import random_pool
+from .server import Request, ServerApplication, download_size, finish_transfer
+
+
+class AsyncioServer:
+    """Native asyncio HTTP/1.1 server with the same semantics as ServerApplication
+
+    Each connection is a coroutine rather than a thread, so idle
+    keep-alive clients cost little more than their socket.  Requests
+    are routed through the application's own route table; downloads
+    and uploads are streamed natively, and everything else is answered
+    by calling the application as WSGI.
+
+    Admission control may block on its lock, so it is called from
+    admission_executor rather than on the event loop.
+    """
+
+    _sendfile_file = None
+
+    def __init__(self, application=None, keepalive_timeout=60.0, admission_threads=4):
+        import concurrent.futures
+
+        if application is None:
+            application = ServerApplication()
+        self.application = application
+        self.keepalive_timeout = keepalive_timeout
+        self.admission_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=admission_threads, thread_name_prefix="qospeedtest-admission"
+        )
+        # Application routes which are streamed natively
+        self.native_routes = {
+            application.process_download: self.process_download,
+            application.process_upload: self.process_upload,
+        }
+
+    async def serve_forever(self, host="0.0.0.0", port=8080):
+        server = await self.start_server(host, port)
+        logging.info("Listening at: http://{}:{}/ (asyncio)".format(host, port))
+        async with server:
+            await server.serve_forever()
+
+    async def start_server(self, host="0.0.0.0", port=8080):
+        return await asyncio.start_server(self.handle_connection, host, port, backlog=4096)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.keepalive_timeout)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                    break
+                if not await self.handle_request(head, reader, writer):
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def make_environ(self, method, target, version, headers, writer):
+        path, _, query_string = target.partition("?")
+        environ = {
+            "REQUEST_METHOD": method,
+            "PATH_INFO": urllib.parse.unquote(path, "ISO-8859-1"),
+            "QUERY_STRING": query_string,
+            "SERVER_PROTOCOL": version,
+            "REMOTE_ADDR": self.client_address(writer) or "",
+            "wsgi.input": io.BytesIO(),
+            "wsgi.url_scheme": "https" if writer.get_extra_info("sslcontext") is not None else "http",
+        }
+        for name, value in headers.items():
+            if name == "content-length":
+                environ["CONTENT_LENGTH"] = value
+            elif name == "content-type":
+                environ["CONTENT_TYPE"] = value
+            else:
+                environ["HTTP_" + name.upper().replace("-", "_")] = value
+        return environ
+
+    async def handle_request(self, head, reader, writer):
+        lines = head.decode("ISO-8859-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ")
+        except ValueError:
+            await self.simple_response(writer, "Bad Request", "400 Bad Request", keep_alive=False)
+            return False
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.1":
+            keep_alive = connection != "close"
+        else:
+            keep_alive = connection == "keep-alive"
+        try:
+            content_length = int(headers["content-length"])
+        except (KeyError, ValueError):
+            # Without a usable length the rest of a POST cannot be framed
+            content_length = None if method == "POST" else 0
+        request = Request(self.make_environ(method, target, version, headers, writer), None)
+
+        route = None
+        if method == "GET":
+            route = self.application.get_routes.get(request.path)
+        elif method == "POST" and content_length is not None:
+            route = self.application.post_routes.get(request.path)
+        native_route = self.native_routes.get(route)
+        if native_route is not None:
+            return await native_route(request, reader, writer, content_length, keep_alive)
+        if content_length != 0:
+            # The unread body would be parsed as the next request
+            keep_alive = False
+        await self.wsgi_response(request, writer, keep_alive)
+        return keep_alive
+
+    async def wsgi_response(self, request, writer, keep_alive):
+        """Answer a request by calling the application as WSGI"""
+        response = []
+
+        def start_response(code_str, headers):
+            response[:] = [code_str, headers]
+
+        iterable = self.application(request.environ, start_response)
+        try:
+            body = b"".join(iterable)
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+        code_str, headers = response
+        if not any(name.lower() == "content-length" for name, value in headers):
+            headers = headers + [("Content-Length", str(len(body)))]
+        await self.send_response(writer, code_str, headers, body, keep_alive=keep_alive)
+
+    @property
+    def sendfile_file(self):
+        # loop.sendfile() leaves the file offset at the end of what it
+        # sent, which must not happen to the shared PoolFile.  None if
+        # it cannot be reopened with an offset of its own.
+        if self._sendfile_file is None:
+            try:
+                self._sendfile_file = self.application.pool_file.reopen()
+            except io.UnsupportedOperation:
+                self._sendfile_file = False
+        return self._sendfile_file or None
+
+    def client_address(self, writer):
+        peername = writer.get_extra_info("peername")
+        return peername[0] if peername else None
+
+    async def run_admission(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.admission_executor, func, *args)
+
+    async def finish(self, finish, transfer, transferred, expected):
+        if finish is None:
+            return
+        if transfer is None:
+            finish(transferred, expected)
+            return
+        # Releasing an admitted transfer must happen even if the
+        # connection's task is cancelled meanwhile
+        await asyncio.shield(self.run_admission(finish, transferred, expected))
+
+    async def throttle(self, transfer, transferred):
+        delay = await self.run_admission(transfer.delay, transferred)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def admit(self, request, writer, mode, keep_alive):
+        """Admit a transfer: a Transfer, None without admission control, or False if refused as busy"""
+        admission = self.application.admission
+        if admission is None:
+            return None
+        transfer = await self.run_admission(admission.admit, request.environ["REMOTE_ADDR"] or None)
+        if transfer is not None:
+            return transfer
+        if self.application.metrics is not None:
+            self.application.metrics.reject(mode)
+        await self.simple_response(
+            writer,
+            "Busy",
+            "503 Service Unavailable",
+            headers=[("Retry-After", str(admission.retry_after))],
+            keep_alive=keep_alive,
+        )
+        return False
+
+    async def send_response(self, writer, code_str, headers, body=b"", keep_alive=True):
+        out = ["HTTP/1.1 {}\r\n".format(code_str)]
+        out += ["{}: {}\r\n".format(k, v) for k, v in headers]
+        out.append("Connection: {}\r\n\r\n".format("keep-alive" if keep_alive else "close"))
+        writer.write("".join(out).encode("ISO-8859-1") + body)
+        await writer.drain()
+
+    async def simple_response(self, writer, message, code_str="200 OK", headers=None, keep_alive=True):
+        body = "{}\n".format(message).encode("UTF-8")
+        await self.send_response(
+            writer,
+            code_str,
+            [
+                ("Content-Type", "text/plain; charset=UTF-8"),
+                ("Content-Length", str(len(body))),
+            ]
+            + (headers or []),
+            body,
+            keep_alive=keep_alive,
+        )
+
+    async def process_download(self, request, reader, writer, content_length, keep_alive):
+        transfer = await self.admit(request, writer, "download", keep_alive)
+        if transfer is False:
+            return keep_alive
+        output_len = download_size(request.query_params)
+        writer.write(
+            "HTTP/1.1 200 OK\r\n"
+            "Content-Type: application/octet-stream\r\n"
+            "Content-Length: {}\r\n"
+            "Connection: {}\r\n\r\n".format(output_len, "keep-alive" if keep_alive else "close").encode("ISO-8859-1")
+        )
+        finish = self.application.metrics.start("download") if self.application.metrics is not None else None
+        shaping = transfer is not None and self.application.admission.shaping
+        if self.application.tracer.enabled:
+            finish = self.application.trace_transfer("download", finish)
+        if transfer is not None:
+            finish = finish_transfer(transfer, finish)
+        sendfile_file = None
+        if self.application.sendfile_max and not shaping and writer.get_extra_info("sslcontext") is None:
+            sendfile_file = self.sendfile_file
+        left = output_len
+        try:
+            if sendfile_file is not None:
+                # The pool file is a whole number of random pools, so
+                # sending it repeatedly from offset 0 repeats the pool.
+                loop = asyncio.get_running_loop()
+                pool_file_size = self.application.pool_file.size
+                while left > 0:
+                    count = left if left < pool_file_size else pool_file_size
+                    await loop.sendfile(writer.transport, sendfile_file, 0, count)
+                    left -= count
+            else:
+                pool = memoryview(random_pool())
+                pool_len = len(pool)
+                while left > 0:
+                    data = pool if left >= pool_len else pool[:left]
+                    writer.write(data)
+                    await writer.drain()
+                    left -= len(data)
+                    if shaping:
+                        await self.throttle(transfer, len(data))
+        finally:
+            await self.finish(finish, transfer, output_len - left, output_len)
+        return keep_alive
+
+    async def process_upload(self, request, reader, writer, content_length, keep_alive):
+        # The unread body of a refused upload means closing the connection
+        transfer = await self.admit(request, writer, "upload", False)
+        if transfer is False:
+            return False
+        if request.environ.get("HTTP_EXPECT", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        chunk_size = self.application.upload_chunk_size
+        finish = self.application.metrics.start("upload") if self.application.metrics is not None else None
+        shaping = transfer is not None and self.application.admission.shaping
+        if self.application.tracer.enabled:
+            finish = self.application.trace_transfer("upload", finish)
+        if transfer is not None:
+            finish = finish_transfer(transfer, finish)
+        received = 0
+        t_start = time.perf_counter()
+        try:
+            while received < content_length:
+                left = content_length - received
+                n = len(await reader.read(left if left < chunk_size else chunk_size))
+                if not n:
+                    return False
+                received += n
+                if shaping:
+                    await self.throttle(transfer, n)
+        finally:
+            await self.finish(finish, transfer, received, content_length)
+        t_receive = time.perf_counter() - t_start
+        await self.simple_response(
+            writer,
+            "size={}".format(received),
+            headers=[("Server-Timing", "recv;dur={:0.3f}".format(t_receive * 1000.0))],
+            keep_alive=keep_alive,
+        )
+        return keep_alive
@@ -0,0 +1,155 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+# Batch testing of several servers.  Servers are grouped by the local
+# link they are reached over (the "link" key of a saved server profile,
+# "default" otherwise).  Tests sharing a link run one after another so
+# they do not compete for it, while separate links are tested in
+# parallel worker processes.
+
+import datetime
+import logging
+import time
+
+from . import __version__
+from . import si_number
+from .client import QOSpeedTest
+
+DEFAULT_LINK = "default"
+
+
+def run_link(args, user_config, session_guid, link, entries, worker=True):
+    """Test each server in turn, returning an entry per server"""
+    speedtest = QOSpeedTest()
+    speedtest.args = args
+    speedtest.user_config = user_config
+    speedtest.session_guid = session_guid
+    if args.trace:
+        from .tracing import Tracer
+
+        # One trace per link, as each is a separate process
+        speedtest.tracer = Tracer("qospeedtest [{}]".format(link), cpu=args.trace_cpu)
+        speedtest.trace_path = "{}.{}".format(args.trace, link)
+    if worker:
+        # Output from parallel workers is interleaved, so no progress
+        # bars, and each line is marked with its link
+        speedtest.is_tty = False
+        logging.basicConfig(
+            format="[{}] %(message)s".format(link),
+            level=(logging.DEBUG if args.debug else logging.INFO),
+            force=True,
+        )
+    speedtest.http_session = speedtest.new_http_session()
+    results = []
+    for entry in entries:
+        result = dict(entry, error=None, output=None)
+        t_start = time.perf_counter_ns()
+        try:
+            result["output"] = speedtest.run_tests(entry["server"])
+        except Exception as e:
+            logging.debug("{} failed".format(entry["name"]), exc_info=True)
+            logging.info("{} failed: {}".format(entry["name"], e))
+            logging.info("")
+            result["error"] = "{}: {}".format(type(e).__name__, e)
+        result["duration_ns"] = time.perf_counter_ns() - t_start
+        results.append(result)
+    return results
+
+
+class Batch:
+    def __init__(self, speedtest, servers, workers=4):
+        self.speedtest = speedtest
+        self.servers = servers
+        self.workers = workers
+
+    def resolve(self):
+        """Group servers by link, returning ({link: [entry, ...]}, [failed entry, ...])"""
+        links = {}
+        failed = []
+        for name in self.servers:
+            profile = self.speedtest.user_config["servers"].get(name) or {}
+            entry = {"name": name, "server": None, "link": str(profile.get("link", DEFAULT_LINK))}
+            try:
+                entry["server"] = self.speedtest.resolve_server(name)
+            except Exception as e:
+                logging.info("Could not resolve {}: {}".format(name, e))
+                failed.append(dict(entry, error="{}: {}".format(type(e).__name__, e), output=None, duration_ns=0))
+                continue
+            links.setdefault(entry["link"], []).append(entry)
+        return links, failed
+
+    def run(self):
+        started = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        t_start = time.perf_counter_ns()
+        links, results = self.resolve()
+        args = self.speedtest.args
+        context = (args, self.speedtest.user_config, self.speedtest.session_guid)
+        if len(links) <= 1 or self.workers <= 1:
+            for link, entries in links.items():
+                results += run_link(*context, link, entries, worker=False)
+        else:
+            import concurrent.futures
+
+            with concurrent.futures.ProcessPoolExecutor(max_workers=min(self.workers, len(links))) as executor:
+                futures = [(executor.submit(run_link, *context, link, entries), entries) for link, entries in links.items()]
+                for future, entries in futures:
+                    try:
+                        results += future.result()
+                    except Exception as e:
+                        # The worker itself failed; only its link is affected
+                        logging.info("Worker for link {} failed: {}".format(entries[0]["link"], e))
+                        results += [
+                            dict(entry, error="{}: {}".format(type(e).__name__, e), output=None, duration_ns=0) for entry in entries
+                        ]
+        order = {name: i for i, name in enumerate(self.servers)}
+        results.sort(key=lambda result: order[result["name"]])
+        return {
+            "version": __version__,
+            "session": self.speedtest.session_guid,
+            "time": started,
+            "duration_ns": time.perf_counter_ns() - t_start,
+            "batch": results,
+        }
+
+    def log_report(self, report):
+        def bps(output, mode):
+            for result in output["results"]:
+                if result["mode"] == mode:
+                    value = si_number(result["bps"])
+                    return "{:0.02f} {}b/s".format(value, value.prefix)
+            return "-"
+
+        logging.info(
+            "Batch of {} servers complete in {:0.01f} seconds, {} failed".format(
+                len(report["batch"]), report["duration_ns"] / 1e9, len([e for e in report["batch"] if e["error"]])
+            )
+        )
+        for entry in report["batch"]:
+            if entry["error"]:
+                logging.info("{name} [{link}]: failed: {error}".format(**entry))
+                continue
+            output = entry["output"]
+            latency = "-" if not output["latency"] else "{:0.02f} ms".format(output["latency"]["median_ns"] / 1e6)
+            logging.info(
+                "{name} [{link}]: download {download}, upload {upload}, idle latency {latency}".format(
+                    name=entry["name"],
+                    link=entry["link"],
+                    download=bps(output, "download"),
+                    upload=bps(output, "upload"),
+                    latency=latency,
+                )
+            )
+        if self.speedtest.args.format == "ndjson":
+            for entry in report["batch"]:
+                self.speedtest.emit(
+                    {
+                        "type": "batch",
+                        "name": entry["name"],
+                        "server": entry["server"],
+                        "link": entry["link"],
+                        "error": entry["error"],
+                    }
+                )
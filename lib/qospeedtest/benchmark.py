@@ -0,0 +1,240 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+# Loopback benchmark of qospeedtest-server backends against the
+# qospeedtest client.  The server and the client each run as a separate
+# process per backend and mode, so CPU time and peak RSS can be taken
+# for each from os.wait4() (including Gunicorn's reaped workers).
+#
+#   python3 -m qospeedtest.benchmark --backend asyncio --backend wsgiref
+
+import argparse
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import __version__
+from . import si_number
+
+BACKENDS = ("wsgiref", "gunicorn", "asyncio", "tcp")
+
+
+class ProcessUsage:
+    __slots__ = ("cpu_seconds", "maxrss_bytes", "returncode")
+
+    def __init__(self, cpu_seconds=None, maxrss_bytes=None, returncode=None):
+        self.cpu_seconds = cpu_seconds
+        self.maxrss_bytes = maxrss_bytes
+        self.returncode = returncode
+
+
+def decode_status(status):
+    """Return code for a wait status, as Popen gives: negative for a signal"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def wait_usage(proc):
+    """Wait for a subprocess, returning its resource usage"""
+    if not hasattr(os, "wait4"):
+        return ProcessUsage(returncode=proc.wait())
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    # The process has been reaped here, so Popen must not wait for it
+    proc.returncode = decode_status(status)
+    # ru_maxrss is in kilobytes, except on macOS
+    maxrss = rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+    return ProcessUsage(rusage.ru_utime + rusage.ru_stime, maxrss, proc.returncode)
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_listening(proc, port, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("Server exited with status {}".format(proc.returncode))
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1.0).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("Server did not start listening on port {}".format(port))
+
+
+def backend_available(backend):
+    if backend != "gunicorn":
+        return True
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.env = dict(os.environ)
+        self.env["PYTHONPATH"] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+            + ([self.env["PYTHONPATH"]] if self.env.get("PYTHONPATH") else [])
+        )
+        # Keep any user configuration (default server etc) out of the client
+        self.config_dir = tempfile.TemporaryDirectory()
+        self.env["XDG_CONFIG_HOME"] = self.config_dir.name
+
+    def start_server(self, backend):
+        port = free_port()
+        command = [sys.executable, "-m", "qospeedtest.server", "--no-metrics"]
+        if backend == "tcp":
+            # The HTTP side is idle and only provides a backend to run under
+            command += ["--backend", "asyncio", "--bind", "127.0.0.1:{}".format(free_port())]
+            command += ["--tcp-bind", "127.0.0.1:{}".format(port)]
+            url = "tcp://127.0.0.1:{}/".format(port)
+        else:
+            command += ["--backend", backend, "--bind", "127.0.0.1:{}".format(port)]
+            url = "http://127.0.0.1:{}/".format(port)
+        proc = subprocess.Popen(command, env=self.env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_listening(proc, port)
+        except Exception:
+            proc.kill()
+            wait_usage(proc)
+            raise
+        return proc, url
+
+    def run_client(self, url, mode):
+        command = [
+            sys.executable,
+            "-m",
+            "qospeedtest.client",
+            url,
+            "--format=json",
+            "--no-latency",
+            "--no-history",
+            "--no-upload" if mode == "download" else "--no-download",
+            "--target-seconds={}".format(self.args.target_seconds),
+            "--minimum-samples={}".format(self.args.minimum_samples),
+            "--maximum-samples={}".format(self.args.maximum_samples),
+            "--streams={}".format(self.args.streams),
+        ]
+        proc = subprocess.Popen(command, env=self.env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        stdout = proc.stdout.read()
+        proc.stdout.close()
+        usage = wait_usage(proc)
+        if usage.returncode:
+            raise RuntimeError("Client exited with status {}".format(usage.returncode))
+        return json.loads(stdout)["results"][0], usage
+
+    def run(self, backend, mode):
+        server, url = self.start_server(backend)
+        try:
+            result, client_usage = self.run_client(url, mode)
+        finally:
+            server.terminate()
+            server_usage = wait_usage(server)
+        gigabytes = result["bytes"] / 1e9
+
+        def per_gb(usage):
+            return None if usage.cpu_seconds is None else usage.cpu_seconds / gigabytes
+
+        return {
+            "backend": backend,
+            "mode": mode,
+            "bps": result["bps"],
+            "bytes": result["bytes"],
+            "duration_ns": result["duration_ns"],
+            "client_cpu_seconds_per_gb": per_gb(client_usage),
+            "server_cpu_seconds_per_gb": per_gb(server_usage),
+            "client_maxrss_bytes": client_usage.maxrss_bytes,
+            "server_maxrss_bytes": server_usage.maxrss_bytes,
+        }
+
+
+def format_row(row):
+    def fmt(value, template):
+        return "-" if value is None else template.format(value)
+
+    return "{:<10} {:<9} {:>10} {:>10} {:>10} {:>11} {:>11}".format(
+        row["backend"],
+        row["mode"],
+        fmt(row["bps"] / 1e9, "{:0.02f}"),
+        fmt(row["client_cpu_seconds_per_gb"], "{:0.03f}"),
+        fmt(row["server_cpu_seconds_per_gb"], "{:0.03f}"),
+        fmt(row["client_maxrss_bytes"] and row["client_maxrss_bytes"] / 1048576, "{:0.01f}"),
+        fmt(row["server_maxrss_bytes"] and row["server_maxrss_bytes"] / 1048576, "{:0.01f}"),
+    )
+
+
+def parse_args(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    program = os.path.basename(argv[0])
+    parser = argparse.ArgumentParser(
+        description="{} ({})".format(program, __version__),
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        prog=program,
+    )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        action="append",
+        default=None,
+        help="Server backend to benchmark, may be given multiple times (default: all available)",
+    )
+    parser.add_argument("--mode", choices=["download", "upload"], action="append", default=None, help="Test to run (default: both)")
+    parser.add_argument("--target-seconds", type=float, default=0.5, help="Length of each request to try for")
+    parser.add_argument("--minimum-samples", type=int, default=5, help="Minimum number of samples per test")
+    parser.add_argument("--maximum-samples", type=int, default=10, help="Maximum number of samples per test")
+    parser.add_argument("--streams", type=int, default=1, help="Number of concurrent connections per sample")
+    parser.add_argument("--format", choices=["text", "json"], default="text", help="Output format")
+    return parser.parse_args(args=argv[1:])
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    benchmark = Benchmark(args)
+    rows = []
+    if args.format == "text":
+        print(
+            "{:<10} {:<9} {:>10} {:>10} {:>10} {:>11} {:>11}".format(
+                "backend", "mode", "Gbit/s", "cli CPU/GB", "srv CPU/GB", "cli RSS MiB", "srv RSS MiB"
+            )
+        )
+    for backend in args.backend or BACKENDS:
+        if not backend_available(backend):
+            logging.info("Skipping {}: not installed".format(backend))
+            continue
+        for mode in args.mode or ("download", "upload"):
+            try:
+                row = benchmark.run(backend, mode)
+            except Exception as e:
+                logging.info("{} {} failed: {}".format(backend, mode, e))
+                continue
+            rows.append(row)
+            if args.format == "text":
+                print(format_row(row), flush=True)
+            else:
+                logging.info("{} {}: {bps:0.02f} {bps.prefix}b/s".format(backend, mode, bps=si_number(row["bps"])))
+    if args.format == "json":
+        json.dump({"version": __version__, "python": sys.version.split()[0], "results": rows}, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
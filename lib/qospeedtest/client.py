@@ -4,31 +4,50 @@
 # SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
 # SPDX-License-Identifier: MPL-2.0
 
+# Heavier modules (requests, yaml, statistics, etc) are imported where
+# they are used, to keep startup fast for --version, --list, etc.
 import argparse
 import datetime
+import json
 import logging
 import math
 import os
 import pathlib
-import statistics
 import sys
 import time
-import urllib.parse
-import xml.etree.ElementTree as ET
-
-import requests
-import yaml
 
 from . import __version__
-from . import EWMA, SemiRandomGenerator
+from . import Sample
 from . import guid, si_number
+from .tracing import NULL_TRACER
+
+
+def ns_timedelta(ns):
+    return datetime.timedelta(microseconds=(ns / 1000.0))
+
+
+def parse_location(value):
+    try:
+        location = tuple(float(i) for i in value.split(","))
+    except ValueError:
+        location = ()
+    if len(location) != 2:
+        raise argparse.ArgumentTypeError("expected LAT,LON, got {!r}".format(value))
+    return location
 
 
 class QOSpeedTest:
+    # Requested for a download ramp-up which is cut off at the target time
+    partial_rampup_bytes = 1 << 30
     args = None
     user_config = None
     http_session = None
     session_guid = None
+    history = None
+    tracer = NULL_TRACER
+    trace_path = None
+    # Trace tids for parallel streams, which are not threads of their own
+    stream_tid_base = 1 << 24
     is_tty = sys.stdin.isatty()
 
     def __init__(self):
@@ -55,11 +74,42 @@ class QOSpeedTest:
         )
 
         action_group = parser.add_mutually_exclusive_group(required=False)
-        action_group.add_argument("server", type=str, nargs="?", help="Speed test server profile or URL")
+        action_group.add_argument("server", type=str, nargs="?", help="Speed test server profile, URL, or speedtest.net server ID")
         action_group.add_argument("--list", action="store_true", help="List saved servers.")
         action_group.add_argument("--nearby", action="store_true", help="List nearby speedtest.net servers")
+        action_group.add_argument(
+            "--batch",
+            nargs="*",
+            metavar="SERVER",
+            default=None,
+            help="Test several server profiles, URLs or speedtest.net server IDs (default: all saved servers)",
+        )
 
         parser.add_argument("--debug", action="store_true", help="Print extra debugging information.")
+        parser.add_argument(
+            "--location",
+            type=parse_location,
+            default=None,
+            metavar="LAT,LON",
+            help="With --nearby, list the speedtest.net servers nearest to these coordinates",
+        )
+        parser.add_argument(
+            "--auto-select",
+            action="store_true",
+            help="When no server is given, pick the lowest latency of the nearby speedtest.net servers",
+        )
+        parser.add_argument(
+            "--select-candidates",
+            type=int,
+            default=10,
+            help="Number of nearby speedtest.net servers to probe with --auto-select",
+        )
+        parser.add_argument(
+            "--select-timeout",
+            type=float,
+            default=5.0,
+            help="Total seconds to spend probing servers with --auto-select",
+        )
         parser.add_argument(
             "--ewma-weight",
             type=float,
@@ -87,11 +137,49 @@ class QOSpeedTest:
             default=(1024 * 128),
             help="Number of bytes to send for the initial upload",
         )
+        parser.add_argument("--no-latency", action="store_true", help="Skip idle and loaded latency measurements")
         parser.add_argument(
-            "--minimum-samples",
+            "--latency-samples",
             type=int,
             default=10,
-            help="Minimum number of samples to gather per individual download/upload test",
+            help="Number of idle latency probes to send before testing",
+        )
+        parser.add_argument(
+            "--latency-interval",
+            type=float,
+            default=0.2,
+            help="Seconds between latency probes",
+        )
+        parser.add_argument(
+            "--streams",
+            type=int,
+            default=1,
+            help="Number of concurrent connections to use for each sample",
+        )
+        parser.add_argument(
+            "--convergence",
+            choices=["ewma", "ci"],
+            default="ewma",
+            help="When to stop sampling: once the EWMA request time settles near the target (ewma), "
+            "or once the confidence interval on the mean speed is narrow enough (ci)",
+        )
+        parser.add_argument(
+            "--relative-error",
+            type=float,
+            default=0.05,
+            help="With --convergence ci, stop once the confidence interval is within this fraction of the mean",
+        )
+        parser.add_argument(
+            "--confidence-level",
+            type=float,
+            default=0.95,
+            help="With --convergence ci, confidence level of the interval",
+        )
+        parser.add_argument(
+            "--minimum-samples",
+            type=int,
+            default=None,
+            help="Minimum number of samples to gather per individual download/upload test (default: 10, or 3 for ci)",
         )
         parser.add_argument(
             "--maximum-samples",
@@ -99,11 +187,65 @@ class QOSpeedTest:
             default=50,
             help="Maximum number of samples to gather per individual download/upload test",
         )
+        parser.add_argument(
+            "--format",
+            choices=["text", "json", "ndjson"],
+            default="text",
+            help="Output format for results; json and ndjson are written to stdout",
+        )
+        parser.add_argument(
+            "--include-samples",
+            action="store_true",
+            help="With --format json or ndjson, include every individual sample",
+        )
+        parser.add_argument("--daemon", action="store_true", help="Run tests continuously on a schedule")
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=300.0,
+            help="With --daemon, seconds between the start of each test run",
+        )
+        parser.add_argument(
+            "--jitter",
+            type=float,
+            default=30.0,
+            help="With --daemon, randomly move each test run by up to this many seconds",
+        )
+        parser.add_argument(
+            "--metrics-bind",
+            type=str,
+            default="127.0.0.1:9469",
+            help="With --daemon, address to serve Prometheus metrics on at /metrics (empty to disable)",
+        )
+
+        parser.add_argument(
+            "--batch-workers",
+            type=int,
+            default=4,
+            help="With --batch, maximum number of links to test in parallel",
+        )
+        parser.add_argument(
+            "--trace",
+            type=str,
+            metavar="FILE",
+            default=None,
+            help="Write a timeline of the run to FILE in Chrome trace event format",
+        )
+        parser.add_argument("--trace-cpu", action="store_true", help="With --trace, also record process CPU time used by each span")
+        parser.add_argument(
+            "--history",
+            action="store_true",
+            help="Summarize past results (for the given server, if any) instead of testing",
+        )
+        parser.add_argument("--history-days", type=int, default=30, help="With --history, number of days to summarize")
+        parser.add_argument("--no-history", action="store_true", help="Do not record results in the history database")
 
         args = parser.parse_args(args=argv[1:])
         return args
 
     def load_user_config(self):
+        import yaml
+
         base_config_dir = os.environ.get("XDG_CONFIG_HOME", os.path.join(os.path.expanduser("~"), ".config"))
         yaml_file = pathlib.Path(os.path.join(base_config_dir, "qospeedtest", "config.yaml"))
         if yaml_file.exists():
@@ -116,130 +258,470 @@ class QOSpeedTest:
         if ("default_server" not in self.user_config) or (self.user_config["default_server"] not in self.user_config["servers"]):
             self.user_config["default_server"] = None
 
-    def get_speedtest_net_servers(self):
+    def get_cache_dir(self):
         base_cache_dir = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
-        xml_cache_file = pathlib.Path(
-            os.path.join(
-                base_cache_dir,
-                "qospeedtest",
-                "speedtest-servers-static.xml",
+        return pathlib.Path(os.path.join(base_cache_dir, "qospeedtest"))
+
+    def get_data_dir(self):
+        base_data_dir = os.environ.get("XDG_DATA_HOME", os.path.join(os.path.expanduser("~"), ".local", "share"))
+        return pathlib.Path(os.path.join(base_data_dir, "qospeedtest"))
+
+    def open_history(self):
+        from .history import History
+
+        return History(self.get_data_dir().joinpath("history.sqlite3"))
+
+    def record_history(self, output):
+        # Written once the tests are complete, in a single transaction
+        import sqlite3
+
+        try:
+            if self.history is None:
+                self.history = self.open_history()
+            self.history.add(output)
+            self.history.flush()
+        except (OSError, ValueError, sqlite3.Error) as e:
+            logging.info("Could not record results in history: {}".format(e))
+
+    def print_history(self):
+        def bps(value):
+            if value is None:
+                return "-"
+            value = si_number(value)
+            return "{:0.02f} {}b/s".format(value, value.prefix)
+
+        server = self.args.server
+        if server in self.user_config["servers"]:
+            server = self.user_config["servers"][server]["url"]
+        if server and not server.endswith("/"):
+            server += "/"
+        since = time.time() - self.args.history_days * 86400
+        history = self.open_history()
+        try:
+            summaries = history.summary(server=server, since=since)
+        finally:
+            history.close()
+
+        if self.args.format == "json":
+            json.dump({"version": __version__, "days": self.args.history_days, "history": summaries}, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+            return
+        elif self.args.format == "ndjson":
+            for summary in summaries:
+                self.emit(dict(type="history", **summary))
+            return
+
+        if not summaries:
+            logging.info("No results recorded in the last {} days".format(self.args.history_days))
+        for summary in summaries:
+            logging.info(
+                "{server} {mode}: {count} runs, median {median}, 10th percentile {p10}, 90th percentile {p90}".format(
+                    server=summary["server"],
+                    mode=summary["mode"],
+                    count=summary["count"],
+                    median=bps(summary["median_bps"]),
+                    p10=bps(summary["p10_bps"]),
+                    p90=bps(summary["p90_bps"]),
+                )
             )
-        )
-        if xml_cache_file.exists() and (xml_cache_file.stat().st_mtime >= (time.time() - (60 * 60 * 24))):
-            logging.debug("Using cached speedtest-servers-static.xml")
-            root = ET.fromstring(xml_cache_file.read_text())
-            return root.iter("server")
+            logging.info(
+                "Mean {mean}, lowest {min}, highest {max}, trend {trend}".format(
+                    mean=bps(summary["mean_bps"]),
+                    min=bps(summary["min_bps"]),
+                    max=bps(summary["max_bps"]),
+                    trend=("-" if summary["trend"] is None else "{:+.2%} per day".format(summary["trend"])),
+                )
+            )
+            for day in summary["days"]:
+                logging.info(
+                    "  {day}: {count} runs, median {median}, lowest {min}, highest {max}".format(
+                        day=day["day"],
+                        count=day["count"],
+                        median=bps(day["median_bps"]),
+                        min=bps(day["min_bps"]),
+                        max=bps(day["max_bps"]),
+                    )
+                )
+            logging.info("")
+
+    def get_speedtest_net_servers(self):
+        import requests
 
-        res = self.http_session.get("https://www.speedtest.net/speedtest-servers-static.php")
+        from .servers import ServerList
+
+        cache_file = self.get_cache_dir().joinpath("speedtest-servers.json")
+        if cache_file.exists() and (cache_file.stat().st_mtime >= (time.time() - (60 * 60 * 24))):
+            try:
+                servers = ServerList.load(cache_file)
+            except (OSError, ValueError, KeyError):
+                logging.debug("Ignoring unreadable speedtest-servers.json")
+            else:
+                logging.debug("Using cached speedtest-servers.json")
+                return servers
+
+        res = self.http_session.get("https://www.speedtest.net/speedtest-servers-static.php", stream=True)
         try:
             res.raise_for_status()
         except requests.exceptions.HTTPError:
-            if xml_cache_file.exists():
+            if cache_file.exists():
                 logging.exception("Warning: Received error from speedtest.net servers list, using outdated cache instead")
-                root = ET.fromstring(xml_cache_file.read_text())
-                return root.iter("server")
+                return ServerList.load(cache_file)
             else:
                 raise
         else:
-            root = ET.fromstring(res.text)
-            xml_cache_file.parent.mkdir(parents=True, exist_ok=True)
-            xml_cache_file.write_text(res.text)
-            return root.iter("server")
+            # Parse the XML incrementally as it arrives
+            res.raw.decode_content = True
+            servers = ServerList.from_xml(res.raw)
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = cache_file.with_suffix(".tmp")
+            servers.save(tmp_file)
+            tmp_file.replace(cache_file)
+            return servers
 
     def print_nearby_remote(self):
-        for i, server in enumerate(self.get_speedtest_net_servers()):
-            logging.info(
-                "http://{}/\t{}, {}\t{}".format(
-                    server.attrib["host"],
-                    server.attrib["name"],
-                    server.attrib["cc"],
-                    server.attrib["sponsor"],
-                )
-            )
-            if i >= 9:
-                return
-
-    def st_request(self, *args, **kwargs):
+        servers = self.get_speedtest_net_servers()
+        if self.args.location:
+            nearby = servers.nearest(*self.args.location, count=10)
+        else:
+            nearby = list(servers)[:10]
+        for server in nearby:
+            logging.info("http://{}/\t{}, {}\t{}".format(server["host"], server["name"], server["cc"], server["sponsor"]))
+
+    def probe_server(self, server, deadline):
+        url_base = "http://{}/".format(server["host"])
+        http_session = self.new_http_session()
+        rtt = None
+        try:
+            for i in range(3):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                t_start = time.perf_counter_ns()
+                r = self.st_request("GET", url_base + "hello", http_session=http_session, timeout=remaining)
+                t_rtt = time.perf_counter_ns() - t_start
+                if not r.text.startswith("hello"):
+                    raise ValueError("Expected hello response from server, got: {}".format(r.text.strip()))
+                if rtt is None or t_rtt < rtt:
+                    rtt = t_rtt
+        except Exception as e:
+            logging.debug("{}: {}".format(url_base, e))
+        finally:
+            http_session.close()
+        return rtt
+
+    def auto_select_server(self):
+        import concurrent.futures
+
+        ranking_cache_file = self.get_cache_dir().joinpath("speedtest-servers-ranking.json")
+        if ranking_cache_file.exists() and (ranking_cache_file.stat().st_mtime >= (time.time() - (60 * 60 * 24))):
+            try:
+                ranking = json.loads(ranking_cache_file.read_text())
+            except ValueError:
+                ranking = []
+            if ranking:
+                logging.debug("Using cached speedtest-servers-ranking.json")
+                return ranking[0]
+
+        candidates = [dict(server) for server in list(self.get_speedtest_net_servers())[: self.args.select_candidates]]
+        logging.info(
+            "Probing latency to {} speedtest.net servers (up to {} seconds)".format(len(candidates), self.args.select_timeout)
+        )
+        deadline = time.monotonic() + self.args.select_timeout
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(len(candidates), 1))
+        try:
+            futures = [executor.submit(self.probe_server, server, deadline) for server in candidates]
+            # Request timeouts apply per socket operation, so the
+            # deadline is enforced here; servers still not done by then
+            # are left behind.
+            done, not_done = concurrent.futures.wait(futures, timeout=max(deadline - time.monotonic(), 0))
+        finally:
+            executor.shutdown(wait=False)
+        ranking = []
+        for server, future in zip(candidates, futures):
+            if future not in done:
+                logging.debug("{}: no response within {} seconds".format(server["host"], self.args.select_timeout))
+                continue
+            rtt = future.result()
+            if rtt is None:
+                continue
+            server["rtt_ns"] = rtt
+            ranking.append(server)
+            logging.debug("{}: {:0.02f} ms".format(server["host"], rtt / 1e6))
+        if not ranking:
+            raise ValueError("No speedtest.net servers responded")
+        ranking.sort(key=lambda server: server["rtt_ns"])
+        ranking_cache_file.parent.mkdir(parents=True, exist_ok=True)
+        ranking_cache_file.write_text(json.dumps(ranking))
+        return ranking[0]
+
+    def new_http_session(self):
+        from .httptransport import new_http_session
+
+        return new_http_session()
+
+    def st_request(self, *args, http_session=None, **kwargs):
         kwargs["params"] = kwargs.get("params", {}).copy()
         kwargs["params"]["guid"] = self.session_guid
         kwargs["params"]["nocache"] = guid()
-        r = self.http_session.request(*args, **kwargs)
+        r = (http_session or self.http_session).request(*args, **kwargs)
         r.raise_for_status()
         return r
 
+    def get_transport(self, url_base, stream=0):
+        if url_base.startswith("tcp://"):
+            from .tcp import TCPClient
+
+            return TCPClient(url_base)
+        from .httptransport import HTTPTransport
+
+        # Additional streams each get their own connection pool
+        return HTTPTransport(self, url_base, http_session=(self.new_http_session() if stream else None))
+
+    def transfer(self, transport, mode, size, max_ns=None):
+        if mode == "download":
+            sample = transport.download(size, max_ns=max_ns)
+            if size < sample.transfer_bytes or (max_ns is None and size != sample.transfer_bytes):
+                raise ValueError("Requested {} bytes from server, got {}".format(size, sample.transfer_bytes))
+        else:
+            sample = transport.upload(size)
+            if size != sample.transfer_bytes:
+                raise ValueError("Expected confirmation of {} bytes from server, got {}".format(size, sample.transfer_bytes))
+        return sample
+
+    def parallel_transfer(self, executor, transports, mode, size, max_ns=None):
+        import concurrent.futures
+
+        # A size of 0 is taken by the server as its default, so every
+        # stream gets at least a byte, using fewer streams if need be.
+        transports = transports[: max(min(size, len(transports)), 1)]
+        sizes = [size // len(transports)] * len(transports)
+        sizes[0] += size % len(transports)
+        futures = [executor.submit(self.transfer, transport, mode, size, max_ns) for transport, size in zip(transports, sizes)]
+        # No stream is left running if another fails
+        concurrent.futures.wait(futures)
+        streams = [future.result() for future in futures]
+
+        # Aggregate over the window from the first stream starting its
+        # transfer to the last stream finishing.
+        sample = Sample(mode)
+        sample.streams = streams
+        sample.start_ns = min(stream.start_ns for stream in streams)
+        sample.end_ns = max(stream.end_ns for stream in streams)
+        sample.transfer_bytes = sum(stream.transfer_bytes for stream in streams)
+        sample.transfer_ns = sample.end_ns - min(stream.end_ns - stream.transfer_ns for stream in streams)
+        sample.connect_ns = max(stream.connect_ns for stream in streams)
+        sample.send_ns = max(stream.send_ns for stream in streams)
+        sample.ttfb_ns = max(stream.ttfb_ns for stream in streams)
+        for i, stream in enumerate(streams):
+            logging.debug(
+                "Stream {i}: {payload:0.02f} {payload.prefix}B in {transfer} ({bps:0.02f} {bps.prefix}b/s)".format(
+                    i=i,
+                    payload=si_number(stream.transfer_bytes, binary=True),
+                    transfer=ns_timedelta(stream.transfer_ns),
+                    bps=si_number(stream.bps),
+                )
+            )
+        return sample
+
+    def trace_phases(self, sample, tid=None):
+        """Record the phases of a completed sample, from its own timestamps"""
+        if sample.streams is not None:
+            # Each stream is shown as its own track
+            for i, stream in enumerate(sample.streams):
+                self.tracer.name_thread(self.stream_tid_base + i, "stream {}".format(i))
+                self.trace_phases(stream, self.stream_tid_base + i)
+            return
+        t = sample.start_ns
+        for name, duration in (("connect", sample.connect_ns), ("send", sample.send_ns), ("first byte", sample.ttfb_ns)):
+            if duration:
+                self.tracer.complete(name, t, t + duration, "phase", tid=tid)
+                t += duration
+        self.tracer.complete(
+            "transfer",
+            sample.end_ns - sample.transfer_ns,
+            sample.end_ns,
+            "phase",
+            tid=tid,
+            args={"bytes": sample.transfer_bytes, "bps": sample.bps},
+        )
+
+    def log_latency(self, label, stats):
+        if not stats.count:
+            logging.info("{} latency: no responses ({} lost)".format(label, stats.lost))
+            return
+        logging.info(
+            "{label} latency: {median:0.02f} ms median, {min:0.02f} ms min, {p99:0.02f} ms p99, "
+            "{jitter:0.02f} ms jitter ({count} probes{lost})".format(
+                label=label,
+                median=stats.median_ns / 1e6,
+                min=stats.min_ns / 1e6,
+                p99=stats.p99_ns / 1e6,
+                jitter=stats.jitter_ns / 1e6,
+                count=stats.count,
+                lost=(", {} lost".format(stats.lost) if stats.lost else ""),
+            )
+        )
+
+    def emit(self, record):
+        """Write a record immediately when streaming NDJSON"""
+        if self.args.format == "ndjson":
+            sys.stdout.write(json.dumps(record) + "\n")
+            sys.stdout.flush()
+
+    def latency_test(self, url_base):
+        from .latency import LatencyProbe
+
+        logging.info("Testing idle latency to {}".format(url_base))
+        transport = self.get_transport(url_base, stream=1)
+        try:
+            stats = LatencyProbe(transport, self.args.latency_interval).run(self.args.latency_samples)
+        finally:
+            transport.close()
+        self.log_latency("Idle", stats)
+        logging.info("")
+        self.emit(dict(type="latency", server=url_base, **stats.as_dict()))
+        return stats
+
     def do_test(self, mode, url_base):
+        import concurrent.futures
+
+        from .latency import LatencyProbe
+
+        transports = [self.get_transport(url_base, stream=i) for i in range(max(self.args.streams, 1))]
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(transports)) if len(transports) > 1 else None
+        latency_probe = None
+        if not self.args.no_latency:
+            # The probe gets its own connection, separate from any stream
+            latency_probe = LatencyProbe(self.get_transport(url_base, stream=len(transports)), self.args.latency_interval)
+        try:
+            return self._do_test(mode, url_base, transports, executor, latency_probe)
+        finally:
+            # Also after a failed test, which --daemon and --batch survive
+            if latency_probe is not None:
+                latency_probe.stop()
+                latency_probe.transport.close()
+            if executor is not None:
+                executor.shutdown()
+            for transport in transports:
+                transport.close()
+
+    def _do_test(self, mode, url_base, transports, executor, latency_probe=None):
+        from .convergence import ConfidenceConvergence, EWMAConvergence
+
         if mode == "download":
             logging.info("Testing download speed from {}".format(url_base))
         else:
             logging.info("Testing upload speed to {}".format(url_base))
 
-        r = self.st_request("GET", url_base + "hello")
-        hello_response = r.text.strip()
+        transport = transports[0]
+        with self.tracer.span("hello", "phase"):
+            hello_response = transport.hello()
         logging.debug("Server: {}".format(hello_response))
-        if not hello_response.startswith("hello"):
+        if not hello_response.upper().startswith("HELLO"):
             raise ValueError("Expected hello response from server, got: {}".format(hello_response))
 
-        projected_bytes = self.args.initial_download if mode == "download" else self.args.initial_upload
-        ewma_bps = EWMA(self.args.ewma_weight)
-        ewma_time = EWMA(self.args.ewma_weight, state=datetime.timedelta())
+        target_ns = self.args.target.total_seconds() * 1e9
+        initial_bytes = self.args.initial_download if mode == "download" else self.args.initial_upload
+        if self.args.convergence == "ci":
+            convergence = ConfidenceConvergence(
+                target_ns,
+                initial_bytes,
+                relative_error=self.args.relative_error,
+                confidence=self.args.confidence_level,
+                minimum_samples=(3 if self.args.minimum_samples is None else self.args.minimum_samples),
+                maximum_samples=self.args.maximum_samples,
+            )
+        else:
+            convergence = EWMAConvergence(
+                target_ns,
+                initial_bytes,
+                ewma_weight=self.args.ewma_weight,
+                minimum_samples=(10 if self.args.minimum_samples is None else self.args.minimum_samples),
+                maximum_samples=self.args.maximum_samples,
+            )
         transfer_count = 0
         transfer_bytes_sum = 0
-        bps_sample_list = []
-        rampup_mode = True
-        test_start = datetime.datetime.now()
-
-        while True:
+        sample_records = []
+        if latency_probe is not None:
+            latency_probe.start()
+        test_start = time.perf_counter_ns()
+
+        while not convergence.done:
+            projected_bytes = convergence.projected_bytes
+            max_ns = None
+            if convergence.rampup and convergence.partial_rampup and mode == "download":
+                # Ask for far more than needed, and stop reading at the
+                # target time, so ramp-up takes a single request.
+                projected_bytes = max(projected_bytes, self.partial_rampup_bytes)
+                max_ns = target_ns
             if mode == "download":
                 logging.debug(
                     "Requesting payload of {payload:0.02f} {payload.prefix}B from {url}download".format(
                         payload=si_number(projected_bytes, binary=True), url=url_base
                     )
                 )
-                with self.st_request(
-                    "GET",
-                    url_base + "download",
-                    params={"size": projected_bytes},
-                    stream=True,
-                ) as r:
-                    t_start = datetime.datetime.now()
-                    transfer_bytes = 0
-                    for i in r.iter_content(chunk_size=None):
-                        transfer_bytes += len(i)
-                    t_end = datetime.datetime.now()
-                    t_transfer = t_end - t_start
-                if projected_bytes != transfer_bytes:
-                    raise ValueError("Requested {} bytes from server, got {}".format(projected_bytes, transfer_bytes))
             else:
                 logging.debug(
                     "Sending payload of {payload:0.02f} {payload.prefix}B to {url}upload".format(
                         payload=si_number(projected_bytes, binary=True), url=url_base
                     )
                 )
-                random_payload = b"".join(SemiRandomGenerator(projected_bytes))
-                # requests supports data= being a generator, but then uses
-                # Chunked transfer encoding, which the servers do not support,
-                # so we must sent the data to requests in one go.
-                r = self.st_request("POST", url_base + "upload", data=random_payload, stream=True)
-                t_transfer = r.elapsed
-                response_size = int(urllib.parse.parse_qs(r.text.strip())["size"][0])
-                if response_size != projected_bytes:
-                    raise ValueError("Expected confirmation of {} bytes from server, got {}".format(projected_bytes, response_size))
-                transfer_bytes = projected_bytes
-
-            bps = transfer_bytes / t_transfer.total_seconds() * 8.0
-            transfer_bytes_sum += transfer_bytes
+            with self.tracer.span("sample", "sample", index=transfer_count, requested_bytes=projected_bytes) as sample_span:
+                if executor is None:
+                    sample = self.transfer(transport, mode, projected_bytes, max_ns)
+                else:
+                    sample = self.parallel_transfer(executor, transports, mode, projected_bytes, max_ns)
+
+            # Excluding the slow start head of the transfer, where known
+            bps = sample.steady_bps
+            t_transfer = sample.transfer_ns
+            transfer_bytes_sum += sample.transfer_bytes
             transfer_count += 1
             logging.debug(
-                "Request processing time: {elapsed}, payload: "
-                "{payload:0.02f} {payload.prefix}B in {transfer} "
-                "({bps:0.02f} {bps.prefix}b/s)".format(
-                    elapsed=r.elapsed,
-                    payload=si_number(transfer_bytes, binary=True),
-                    transfer=t_transfer,
-                    bps=si_number(bps),
+                "Request phases: connect {connect}, send {send}, first byte {ttfb}{server}".format(
+                    connect=ns_timedelta(sample.connect_ns),
+                    send=ns_timedelta(sample.send_ns),
+                    ttfb=ns_timedelta(sample.ttfb_ns),
+                    server=("" if sample.server_ns is None else ", server receive {}".format(ns_timedelta(sample.server_ns))),
+                )
+            )
+            logging.debug(
+                "Payload: {payload:0.02f} {payload.prefix}B in {transfer} ({bps:0.02f} {bps.prefix}b/s, "
+                "{steady:0.02f} {steady.prefix}b/s after slow start)".format(
+                    payload=si_number(sample.transfer_bytes, binary=True),
+                    transfer=ns_timedelta(t_transfer),
+                    bps=si_number(sample.bps),
+                    steady=si_number(bps),
                 )
             )
 
+            # Do not consider the first results
+            counted = convergence.add(bps, t_transfer)
+            if self.tracer.enabled:
+                sample_span.set(bytes=sample.transfer_bytes, bps=bps, counted=counted)
+                self.trace_phases(sample)
+            if self.args.include_samples:
+                record = dict(
+                    type="sample",
+                    server=url_base,
+                    index=(transfer_count - 1),
+                    rampup=(not counted),
+                    offset_ns=(sample.end_ns - test_start),
+                    **sample.as_dict(),
+                )
+                sample_records.append(record)
+                self.emit(record)
+            if counted:
+                logging.debug(convergence.status())
+            else:
+                logging.debug(
+                    "Confidence not yet high on early sample ({} targeting {}), not counting toward the result".format(
+                        ns_timedelta(t_transfer), self.args.target
+                    )
+                )
+            if convergence.stats.count >= self.args.maximum_samples:
+                logging.debug("Reached maximum samples")
+
             if self.is_tty and not self.args.debug:
 
                 def confidence_bar(fraction, length=20):
@@ -250,47 +732,18 @@ class QOSpeedTest:
 
                 sys.stderr.write(
                     "\r\x1b[K{dots} {spinner} {bps:0.02f} {bps.prefix}b/s ({count})".format(
-                        dots=("?" * 20 if rampup_mode else confidence_bar(ewma_time.average / self.args.target)),
+                        dots=("?" * 20 if convergence.rampup else confidence_bar(convergence.confidence)),
                         spinner=["/", "-", "\\", "|"][(transfer_count - 1) % 4],
-                        bps=si_number(bps if rampup_mode else ewma_bps.average),
+                        bps=si_number(bps if convergence.rampup else convergence.bps),
                         count=transfer_count,
                     )
                 )
 
-            # Do not consider the first results
-            if rampup_mode:
-                thresh_low = self.args.target * 0.9
-                thresh_high = self.args.target * 1.5
-                if not (thresh_high > t_transfer > thresh_low):
-                    logging.debug(
-                        "Confidence not yet high on early sample "
-                        "({} not within {} and {} targeting {}), "
-                        "not counting toward EWMA".format(t_transfer, thresh_low, thresh_high, self.args.target)
-                    )
-                    projected_bytes = int(bps * self.args.target.total_seconds() / 8.0)
-                    continue
-                else:
-                    rampup_mode = False
-
-            ewma_bps.add(bps)
-            ewma_time.add(t_transfer)
-            bps_sample_list.append(bps)
-            logging.debug(
-                "EWMA bps: {bps:0.02f} {bps.prefix}b/s, time: {time}".format(
-                    bps=si_number(ewma_bps.average), time=ewma_time.average
-                )
-            )
-
-            if len(bps_sample_list) >= self.args.maximum_samples:
-                logging.debug("Reached maximum samples")
-                break
-            elif len(bps_sample_list) >= self.args.minimum_samples:
-                if (self.args.target * 1.25) > ewma_time.average > (self.args.target * 0.95):
-                    break
-
-            projected_bytes = int(ewma_bps.average * self.args.target.total_seconds() / 8.0)
-
-        test_end = datetime.datetime.now()
+        test_end = time.perf_counter_ns()
+        stats = convergence.stats
+        latency_stats = None
+        if latency_probe is not None:
+            latency_stats = latency_probe.stop()
 
         if self.is_tty and not self.args.debug:
             sys.stderr.write("\r\x1b[K")
@@ -302,25 +755,76 @@ class QOSpeedTest:
             "{type} speed: {bps:0.02f} {bps.prefix}b/s, {transfer:0.02f} {transfer.prefix}B {verb} in "
             "{time}".format(
                 type=wording[0],
-                bps=si_number(ewma_bps.average),
+                bps=si_number(convergence.bps),
                 transfer=si_number(transfer_bytes_sum, binary=True),
                 verb=wording[1],
-                time=(test_end - test_start),
+                time=ns_timedelta(test_end - test_start),
             )
         )
-        if len(bps_sample_list) > 1:
-            stdev = statistics.stdev(bps_sample_list)
+        if stats.count > 1:
             logging.info(
                 "Standard deviation: {stdev:0.02f} {stdev.prefix}b/s ({stdev_ratio:.1%}), "
-                "lowest {min:0.02f} {min.prefix}b/s, highest {max:0.02f} {max.prefix}b/s".format(
-                    stdev=si_number(stdev),
-                    stdev_ratio=(stdev / ewma_bps.average),
-                    min=si_number(min(bps_sample_list)),
-                    max=si_number(max(bps_sample_list)),
+                "lowest {min:0.02f} {min.prefix}b/s, median {median:0.02f} {median.prefix}b/s, "
+                "highest {max:0.02f} {max.prefix}b/s".format(
+                    stdev=si_number(stats.stdev),
+                    stdev_ratio=(stats.stdev / convergence.bps),
+                    min=si_number(stats.min),
+                    median=si_number(stats.quantile(0.5)),
+                    max=si_number(stats.max),
                 )
             )
+        if latency_stats is not None:
+            self.log_latency("Loaded", latency_stats)
         logging.info("")
 
+        result = {
+            "type": "result",
+            "server": url_base,
+            "mode": mode,
+            "bps": convergence.bps,
+            "bytes": transfer_bytes_sum,
+            "duration_ns": test_end - test_start,
+            "transfers": transfer_count,
+            "samples": stats.count,
+            "stdev_bps": stats.stdev,
+            "min_bps": stats.min,
+            "median_bps": stats.quantile(0.5),
+            "max_bps": stats.max,
+            "streams": len(transports),
+            "loaded_latency": (latency_stats.as_dict() if latency_stats is not None else None),
+        }
+        self.emit(result)
+        if self.args.include_samples and self.args.format == "json":
+            result["sample_list"] = sample_records
+        return result
+
+    def resolve_server(self, server):
+        """URL for a saved server profile, speedtest.net server ID or URL"""
+        if server in self.user_config["servers"]:
+            url_base = self.user_config["servers"][server]["url"]
+        elif server.isdigit():
+            remote = self.get_speedtest_net_servers().get(server)
+            if remote is None:
+                raise ValueError("Unknown speedtest.net server ID: {}".format(server))
+            url_base = "http://{}/".format(remote["host"])
+        else:
+            url_base = server
+        if not url_base.endswith("/"):
+            url_base += "/"
+        return url_base
+
+    def run_batch(self):
+        from .batch import Batch
+
+        batch = Batch(self, self.args.batch or list(self.user_config["servers"]), workers=self.args.batch_workers)
+        report = batch.run()
+        if self.args.format == "json":
+            json.dump(report, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+        else:
+            batch.log_report(report)
+        return 1 if any(entry["error"] for entry in report["batch"]) else None
+
     def main(self):
         self.args = self.parse_args()
 
@@ -331,45 +835,96 @@ class QOSpeedTest:
             logging_level = logging.INFO
             logging_format = "%(message)s"
         logging.basicConfig(format=logging_format, level=logging_level)
+        if self.args.trace:
+            from .tracing import Tracer
+
+            self.tracer = Tracer("qospeedtest", cpu=self.args.trace_cpu)
+            self.trace_path = self.args.trace
 
         self.load_user_config()
-        self.http_session = requests.Session()
-        self.http_session.headers["User-Agent"] = "qospeedtest (https://github.com/rfinnie/qospeedtest)"
         self.session_guid = guid()
 
         if self.args.list:
             for server in self.user_config["servers"]:
                 logging.info("{}\t{}".format(server, self.user_config["servers"][server]["url"]))
             return
-        elif self.args.nearby:
+        elif self.args.history:
+            return self.print_history()
+
+        self.http_session = self.new_http_session()
+        if self.args.nearby:
             return self.print_nearby_remote()
+        elif self.args.batch is not None:
+            return self.run_batch()
         elif self.args.server:
-            if self.args.server in self.user_config["servers"]:
-                url_base = self.user_config["servers"][self.args.server]["url"]
-            else:
-                url_base = self.args.server
+            url_base = self.resolve_server(self.args.server)
         elif self.user_config["default_server"]:
             url_base = self.user_config["servers"][self.user_config["default_server"]]["url"]
             logging.info("Using default server '{}' from user configuration".format(self.user_config["default_server"]))
             logging.info("")
-        else:
-            speedtest_net_servers = self.get_speedtest_net_servers()
-            server = next(speedtest_net_servers)
-            url_base = "http://{}/".format(server.attrib["host"])
+        elif self.args.auto_select:
+            server = self.auto_select_server()
+            url_base = "http://{}/".format(server["host"])
             logging.info(
-                "Using closest speedtest.net server: {} in {}, {}".format(
-                    server.attrib["sponsor"], server.attrib["name"], server.attrib["cc"]
+                "Using lowest latency speedtest.net server: {} in {}, {} ({:0.02f} ms)".format(
+                    server["sponsor"], server["name"], server["cc"], server["rtt_ns"] / 1e6
                 )
             )
             logging.info("")
+        else:
+            server = next(iter(self.get_speedtest_net_servers()))
+            url_base = "http://{}/".format(server["host"])
+            logging.info("Using closest speedtest.net server: {} in {}, {}".format(server["sponsor"], server["name"], server["cc"]))
+            logging.info("")
 
         if not url_base.endswith("/"):
             url_base += "/"
 
+        if self.args.daemon:
+            from . import metrics
+            from .daemon import Daemon
+
+            daemon = Daemon(self, url_base, interval=self.args.interval, jitter=self.args.jitter)
+            if self.args.metrics_bind:
+                metrics.serve_background(self.args.metrics_bind, daemon.metrics.registry)
+            daemon.run_forever()
+        else:
+            self.run_tests(url_base)
+
+    def run_tests(self, url_base):
+        try:
+            with self.tracer.span("run", "run", server=url_base):
+                return self._run_tests(url_base)
+        finally:
+            if self.trace_path is not None:
+                self.tracer.write(self.trace_path)
+
+    def _run_tests(self, url_base):
+        output = {
+            "version": __version__,
+            "session": self.session_guid,
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "server": url_base,
+            "latency": None,
+            "results": [],
+        }
+        if not self.args.no_latency:
+            with self.tracer.span("idle latency", "test"):
+                output["latency"] = self.latency_test(url_base).as_dict()
         if not self.args.no_download:
-            self.do_test("download", url_base)
+            with self.tracer.span("download test", "test"):
+                output["results"].append(self.do_test("download", url_base))
         if not self.args.no_upload:
-            self.do_test("upload", url_base)
+            with self.tracer.span("upload test", "test"):
+                output["results"].append(self.do_test("upload", url_base))
+        if not self.args.no_history:
+            self.record_history(output)
+        # A batch reports all of its runs together
+        if self.args.format == "json" and self.args.batch is None:
+            json.dump(output, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+            sys.stdout.flush()
+        return output
 
 
 def main():
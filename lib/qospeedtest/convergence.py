@@ -0,0 +1,163 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import math
+
+from . import si_number
+from .stats import StreamingStats
+
+
+def t_quantile(p, df):
+    """Student's t quantile function
+
+    Exact for 1 and 2 degrees of freedom, otherwise the Cornish-Fisher
+    expansion around the normal quantile (Abramowitz and Stegun
+    26.7.5), which is within 1% of tables for 3 or more.
+    """
+    if df == 1:
+        return math.tan(math.pi * (p - 0.5))
+    elif df == 2:
+        return (2 * p - 1) / math.sqrt(2 * p * (1 - p))
+    import statistics
+
+    z = statistics.NormalDist().inv_cdf(p)
+    g1 = (z**3 + z) / 4
+    g2 = (5 * z**5 + 16 * z**3 + 3 * z) / 96
+    g3 = (3 * z**7 + 19 * z**5 + 17 * z**3 - 15 * z) / 384
+    g4 = (79 * z**9 + 776 * z**7 + 1482 * z**5 - 1920 * z**3 - 945 * z) / 92160
+    return z + g1 / df + g2 / df**2 + g3 / df**3 + g4 / df**4
+
+
+class EWMAConvergence:
+    """Sample sizing and stopping for a download or upload test
+
+    Early samples are used only to size the next request, until one
+    lands near the target time.  From then on, samples are averaged
+    with an EWMA, and the test is done once the average request time
+    is close to the target (or the maximum samples are reached).
+    """
+
+    # Ramp-up needs whole samples near the target time
+    partial_rampup = False
+
+    def __init__(self, target_ns, initial_bytes, ewma_weight=8.0, minimum_samples=10, maximum_samples=50):
+        self.target_ns = target_ns
+        self.minimum_samples = minimum_samples
+        self.maximum_samples = maximum_samples
+        self.thresh_low = target_ns * 0.9
+        self.thresh_high = target_ns * 1.5
+        self.projected_bytes = initial_bytes
+        # Counted samples; request times only need their EWMA
+        self.stats = StreamingStats(ewma_weight)
+        self.time_stats = StreamingStats(ewma_weight, quantiles=())
+        self.rampup = True
+        self.done = False
+
+    @property
+    def bps(self):
+        return self.stats.ewma
+
+    @property
+    def confidence(self):
+        """Average request time as a fraction of the target"""
+        return self.time_stats.ewma / self.target_ns
+
+    def status(self):
+        return "EWMA bps: {bps:0.02f} {bps.prefix}b/s, time: {time:0.03f} s".format(
+            bps=si_number(self.stats.ewma), time=(self.time_stats.ewma / 1e9)
+        )
+
+    def add(self, bps, transfer_ns):
+        """Add a sample, returning whether it was counted"""
+        if self.rampup:
+            if not (self.thresh_high > transfer_ns > self.thresh_low):
+                self.projected_bytes = int(bps * self.target_ns / 8e9)
+                return False
+            self.rampup = False
+
+        self.stats.add(bps)
+        self.time_stats.add(transfer_ns)
+        if self.stats.count >= self.maximum_samples:
+            self.done = True
+        elif self.stats.count >= self.minimum_samples:
+            if (self.target_ns * 1.25) > self.time_stats.ewma > (self.target_ns * 0.95):
+                self.done = True
+        self.projected_bytes = int(self.stats.ewma * self.target_ns / 8e9)
+        return True
+
+
+class ConfidenceConvergence:
+    """Stop once a Student's t confidence interval on the mean is narrow enough
+
+    The mean and variance are updated incrementally (Welford), and the
+    test is done once the interval half-width is within relative_error
+    of the mean.  Samples of at least half the target time count, and
+    partial_rampup allows the transport to cut a ramp-up request off at
+    the target time rather than waiting for all of it.
+    """
+
+    partial_rampup = True
+
+    def __init__(self, target_ns, initial_bytes, relative_error=0.05, confidence=0.95, minimum_samples=3, maximum_samples=50):
+        self.target_ns = target_ns
+        self.relative_error = relative_error
+        self.confidence_level = confidence
+        self.minimum_samples = max(minimum_samples, 2)
+        self.maximum_samples = maximum_samples
+        self.thresh_low = target_ns * 0.5
+        self.projected_bytes = initial_bytes
+        self.stats = StreamingStats()
+        self.rampup = True
+        self.done = False
+
+    @property
+    def bps(self):
+        return self.stats.mean
+
+    @property
+    def half_width(self):
+        count = self.stats.count
+        if count < 2:
+            return math.inf
+        t = t_quantile(1 - (1 - self.confidence_level) / 2, count - 1)
+        return t * self.stats.stdev / math.sqrt(count)
+
+    @property
+    def confidence(self):
+        """Requested relative error as a fraction of the current one"""
+        if not self.stats.mean:
+            return 0.0
+        if not self.half_width:
+            # Identical samples leave no error at all
+            return 1.0
+        return min(self.relative_error / (self.half_width / self.stats.mean), 1.0)
+
+    def status(self):
+        if self.stats.count < 2:
+            return "Mean bps: {bps:0.02f} {bps.prefix}b/s (1 sample)".format(bps=si_number(self.stats.mean))
+        if not self.stats.mean:
+            return "Mean bps: {bps:0.02f} {bps.prefix}b/s ({count} samples)".format(
+                bps=si_number(self.stats.mean), count=self.stats.count
+            )
+        return "Mean bps: {bps:0.02f} {bps.prefix}b/s +/- {half_width:.1%} ({count} samples)".format(
+            bps=si_number(self.stats.mean), half_width=(self.half_width / self.stats.mean), count=self.stats.count
+        )
+
+    def add(self, bps, transfer_ns):
+        """Add a sample, returning whether it was counted"""
+        if transfer_ns < self.thresh_low:
+            # Too short to be representative; size the next one from it
+            self.projected_bytes = int(bps * self.target_ns / 8e9)
+            return False
+        self.rampup = False
+
+        self.stats.add(bps)
+        if self.stats.count >= self.maximum_samples:
+            self.done = True
+        elif self.stats.count >= self.minimum_samples and self.half_width <= self.relative_error * self.stats.mean:
+            self.done = True
+        self.projected_bytes = int(self.stats.mean * self.target_ns / 8e9)
+        return True
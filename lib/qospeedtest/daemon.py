@@ -0,0 +1,105 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import logging
+import random
+import threading
+import time
+
+from .metrics import Registry, exponential_buckets
+
+
+class SpeedTestMetrics:
+    def __init__(self, registry=None):
+        self.registry = registry or Registry()
+        r = self.registry
+        self.runs = r.counter("qospeedtest_runs_total", "Test runs, by outcome", ["result"])
+        self.last_run = r.gauge("qospeedtest_last_run_timestamp_seconds", "Time the last test run completed")
+        self.bytes = r.counter("qospeedtest_transfer_bytes_total", "Bytes transferred during tests", ["mode"])
+        self.throughput = r.gauge("qospeedtest_throughput_bits_per_second", "Speed from the last test", ["mode"])
+        self.throughput_histogram = r.histogram(
+            "qospeedtest_throughput_bits_per_second_histogram",
+            "Speed of each test",
+            ["mode"],
+            buckets=exponential_buckets(1e6, 2, 14),
+        )
+        self.duration = r.histogram(
+            "qospeedtest_test_duration_seconds",
+            "Time taken by each test",
+            ["mode"],
+            buckets=(1, 2.5, 5, 10, 15, 20, 30, 45, 60, 90, 120),
+        )
+        self.latency = r.gauge(
+            "qospeedtest_latency_seconds", "Latency from the last test, idle or under load", ["condition", "stat"]
+        )
+        self.latency_histogram = r.histogram(
+            "qospeedtest_latency_median_seconds",
+            "Median latency of each test, idle or under load",
+            ["condition"],
+            buckets=exponential_buckets(0.0005, 2, 14),
+        )
+
+    def observe_latency(self, condition, stats):
+        if stats is None or not stats.get("count"):
+            return
+        for stat in ("min", "median", "p99", "jitter"):
+            self.latency.labels(condition, stat).set(stats[stat + "_ns"] / 1e9)
+        self.latency_histogram.labels(condition).observe(stats["median_ns"] / 1e9)
+
+    def observe(self, output):
+        self.observe_latency("idle", output["latency"])
+        for result in output["results"]:
+            mode = result["mode"]
+            self.bytes.labels(mode).inc(result["bytes"])
+            self.throughput.labels(mode).set(result["bps"])
+            self.throughput_histogram.labels(mode).observe(result["bps"])
+            self.duration.labels(mode).observe(result["duration_ns"] / 1e9)
+            self.observe_latency("loaded_" + mode, result["loaded_latency"])
+
+
+class Daemon:
+    """Run tests on a schedule, reusing one QOSpeedTest and its HTTP session
+
+    Each run starts interval seconds after the previous one started,
+    plus or minus a random amount of up to jitter seconds, so multiple
+    monitors do not synchronize against the same server.
+    """
+
+    def __init__(self, speedtest, url_base, interval=300.0, jitter=30.0, metrics=None):
+        self.speedtest = speedtest
+        self.url_base = url_base
+        self.interval = interval
+        self.jitter = jitter
+        self.metrics = metrics or SpeedTestMetrics()
+        self._stop = threading.Event()
+
+    def run_once(self):
+        try:
+            output = self.speedtest.run_tests(self.url_base)
+        except Exception:
+            logging.exception("Test run failed")
+            self.metrics.runs.labels("error").inc()
+            return None
+        self.metrics.observe(output)
+        self.metrics.runs.labels("ok").inc()
+        self.metrics.last_run.set(time.time())
+        return output
+
+    def next_delay(self, elapsed):
+        delay = self.interval + random.uniform(-self.jitter, self.jitter) - elapsed
+        return delay if delay > 0 else 0
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            t_start = time.monotonic()
+            self.run_once()
+            delay = self.next_delay(time.monotonic() - t_start)
+            logging.info("Next test in {:0.0f} seconds".format(delay))
+            logging.info("")
+            self._stop.wait(delay)
+
+    def stop(self):
+        self._stop.set()
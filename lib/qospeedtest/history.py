@@ -0,0 +1,274 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import datetime
+import json
+import math
+import pathlib
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE results (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    server TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    session TEXT,
+    bps REAL,
+    bytes INTEGER,
+    duration_ns INTEGER,
+    samples INTEGER,
+    stdev_bps REAL,
+    min_bps REAL,
+    max_bps REAL,
+    idle_latency_ns REAL,
+    loaded_latency_ns REAL
+);
+CREATE INDEX results_server_mode_time ON results (server, mode, time);
+CREATE INDEX results_time ON results (time);
+CREATE TABLE daily (
+    server TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    day TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    bps_sum REAL NOT NULL,
+    bps_sq_sum REAL NOT NULL,
+    bps_min REAL,
+    bps_max REAL,
+    buckets TEXT NOT NULL,
+    PRIMARY KEY (server, mode, day)
+) WITHOUT ROWID;
+CREATE INDEX daily_day ON daily (day);
+"""
+
+# Daily rollups keep a histogram of speeds in buckets of 1/8 of an
+# octave (about 9% wide), enough for percentiles over any date range
+# without going back to the individual results.
+BUCKETS_PER_OCTAVE = 8
+
+
+def bucket_index(bps):
+    return math.floor(math.log2(bps) * BUCKETS_PER_OCTAVE)
+
+
+def bucket_value(index):
+    # Geometric middle of the bucket
+    return 2 ** ((index + 0.5) / BUCKETS_PER_OCTAVE)
+
+
+def buckets_percentile(buckets, fraction):
+    total = sum(buckets.values())
+    if not total:
+        return None
+    rank = fraction * total
+    cumulative = 0
+    for index in sorted(buckets):
+        cumulative += buckets[index]
+        if cumulative >= rank:
+            return bucket_value(index)
+    return bucket_value(max(buckets))
+
+
+def utc_day(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime("%Y-%m-%d")
+
+
+class Rollup:
+    """Aggregate of a set of results, mergeable with others"""
+
+    __slots__ = ("count", "bps_sum", "bps_sq_sum", "bps_min", "bps_max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.bps_sum = 0.0
+        self.bps_sq_sum = 0.0
+        self.bps_min = None
+        self.bps_max = None
+        self.buckets = {}
+
+    def add(self, bps):
+        self.count += 1
+        self.bps_sum += bps
+        self.bps_sq_sum += bps * bps
+        self.bps_min = bps if self.bps_min is None else min(self.bps_min, bps)
+        self.bps_max = bps if self.bps_max is None else max(self.bps_max, bps)
+        if bps > 0:
+            index = bucket_index(bps)
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, count, bps_sum, bps_sq_sum, bps_min, bps_max, buckets):
+        self.count += count
+        self.bps_sum += bps_sum
+        self.bps_sq_sum += bps_sq_sum
+        if bps_min is not None:
+            self.bps_min = bps_min if self.bps_min is None else min(self.bps_min, bps_min)
+        if bps_max is not None:
+            self.bps_max = bps_max if self.bps_max is None else max(self.bps_max, bps_max)
+        for index, n in buckets.items():
+            self.buckets[int(index)] = self.buckets.get(int(index), 0) + n
+
+    def percentile(self, fraction):
+        value = buckets_percentile(self.buckets, fraction)
+        if value is None:
+            return None
+        # Bucket estimates are kept within the actual range
+        return min(max(value, self.bps_min), self.bps_max)
+
+    def as_dict(self):
+        mean = self.bps_sum / self.count if self.count else None
+        stdev = None
+        if self.count > 1:
+            stdev = math.sqrt(max(self.bps_sq_sum - self.count * mean * mean, 0.0) / (self.count - 1))
+        return {
+            "count": self.count,
+            "mean_bps": mean,
+            "stdev_bps": stdev,
+            "min_bps": self.bps_min,
+            "p10_bps": self.percentile(0.1),
+            "median_bps": self.percentile(0.5),
+            "p90_bps": self.percentile(0.9),
+            "max_bps": self.bps_max,
+        }
+
+
+class History:
+    """SQLite store of test results
+
+    Results are queued with add() and written together by flush(),
+    outside of the tests themselves.  Each write also updates the
+    daily rollups, which are what queries read.
+    """
+
+    schema_version = 1
+
+    def __init__(self, path):
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(path))
+        self.pending = []
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version == 0:
+            with self.db:
+                self.db.executescript(SCHEMA)
+                self.db.execute("PRAGMA user_version = {}".format(self.schema_version))
+        elif version != self.schema_version:
+            raise ValueError("Unsupported history database version {}".format(version))
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def add(self, output):
+        timestamp = datetime.datetime.fromisoformat(output["time"]).timestamp()
+        idle_latency_ns = output["latency"]["median_ns"] if output.get("latency") else None
+        for result in output["results"]:
+            loaded_latency = result.get("loaded_latency")
+            self.pending.append(
+                (
+                    timestamp,
+                    result["server"],
+                    result["mode"],
+                    output.get("session"),
+                    result["bps"],
+                    result["bytes"],
+                    result["duration_ns"],
+                    result["samples"],
+                    result["stdev_bps"],
+                    result["min_bps"],
+                    result["max_bps"],
+                    idle_latency_ns,
+                    loaded_latency["median_ns"] if loaded_latency else None,
+                )
+            )
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        rollups = {}
+        for row in pending:
+            key = (row[1], row[2], utc_day(row[0]))
+            rollups.setdefault(key, Rollup()).add(row[4])
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO results (time, server, mode, session, bps, bytes, duration_ns, samples, "
+                "stdev_bps, min_bps, max_bps, idle_latency_ns, loaded_latency_ns) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                pending,
+            )
+            for (server, mode, day), rollup in rollups.items():
+                row = self.db.execute(
+                    "SELECT count, bps_sum, bps_sq_sum, bps_min, bps_max, buckets FROM daily "
+                    "WHERE server = ? AND mode = ? AND day = ?",
+                    (server, mode, day),
+                ).fetchone()
+                if row is not None:
+                    rollup.merge(*row[:5], json.loads(row[5]))
+                self.db.execute(
+                    "INSERT OR REPLACE INTO daily (server, mode, day, count, bps_sum, bps_sq_sum, bps_min, bps_max, buckets) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        server,
+                        mode,
+                        day,
+                        rollup.count,
+                        rollup.bps_sum,
+                        rollup.bps_sq_sum,
+                        rollup.bps_min,
+                        rollup.bps_max,
+                        json.dumps(rollup.buckets, separators=(",", ":")),
+                    ),
+                )
+
+    def daily(self, server=None, mode=None, since=None):
+        """Daily rollups as (server, mode, day, Rollup), oldest first"""
+        conditions = []
+        params = []
+        for column, value in (("server", server), ("mode", mode)):
+            if value is not None:
+                conditions.append("{} = ?".format(column))
+                params.append(value)
+        if since is not None:
+            conditions.append("day >= ?")
+            params.append(utc_day(since))
+        query = "SELECT server, mode, day, count, bps_sum, bps_sq_sum, bps_min, bps_max, buckets FROM daily"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY server, mode, day"
+        for row in self.db.execute(query, params):
+            rollup = Rollup()
+            rollup.merge(*row[3:8], json.loads(row[8]))
+            yield row[0], row[1], row[2], rollup
+
+    def summary(self, server=None, mode=None, since=None):
+        """Per server and mode summaries, with daily breakdowns"""
+        summaries = {}
+        for row_server, row_mode, day, rollup in self.daily(server, mode, since):
+            key = (row_server, row_mode)
+            if key not in summaries:
+                summaries[key] = {"server": row_server, "mode": row_mode, "total": Rollup(), "days": []}
+            total = summaries[key]["total"]
+            total.merge(rollup.count, rollup.bps_sum, rollup.bps_sq_sum, rollup.bps_min, rollup.bps_max, rollup.buckets)
+            summaries[key]["days"].append(dict(day=day, **rollup.as_dict()))
+        ret = []
+        for summary in summaries.values():
+            summary.update(summary.pop("total").as_dict())
+            summary["trend"] = trend(summary["days"])
+            ret.append(summary)
+        return ret
+
+
+def trend(days):
+    """Least squares slope of the daily mean speed, as a fraction of the mean per day"""
+    points = [(datetime.date.fromisoformat(day["day"]).toordinal(), day["mean_bps"]) for day in days]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, y in points) / len(points)
+    mean_y = sum(y for x, y in points) / len(points)
+    sxx = sum((x - mean_x) ** 2 for x, y in points)
+    if not sxx or not mean_y:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / sxx / mean_y
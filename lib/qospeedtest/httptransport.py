@@ -0,0 +1,198 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import functools
+import threading
+import time
+import urllib.parse
+
+import requests
+import urllib3
+
+from . import Sample, SemiRandomPayload, ThroughputSeries
+
+# Sample currently being timed by this thread, if any
+_phase_timing = threading.local()
+
+
+class TimedConnectionMixin:
+    """Records connect/send/TTFB phases into the thread's current Sample"""
+
+    _sent_ns = 0
+
+    def connect(self):
+        t_start = time.perf_counter_ns()
+        super().connect()
+        sample = getattr(_phase_timing, "sample", None)
+        if sample is not None:
+            sample.connect_ns += time.perf_counter_ns() - t_start
+
+    def request(self, *args, **kwargs):
+        sample = getattr(_phase_timing, "sample", None)
+        connect_ns = sample.connect_ns if sample is not None else 0
+        t_start = time.perf_counter_ns()
+        super().request(*args, **kwargs)
+        self._sent_ns = time.perf_counter_ns()
+        if sample is not None:
+            # Exclude any connection setup which happened on first send
+            sample.send_ns += self._sent_ns - t_start - (sample.connect_ns - connect_ns)
+
+    def getresponse(self, *args, **kwargs):
+        response = super().getresponse(*args, **kwargs)
+        sample = getattr(_phase_timing, "sample", None)
+        if sample is not None:
+            sample.ttfb_ns = time.perf_counter_ns() - self._sent_ns
+        return response
+
+
+class TimedHTTPConnection(TimedConnectionMixin, urllib3.connection.HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedConnectionMixin, urllib3.connection.HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool,
+        }
+
+
+def iter_body(raw, chunk_size):
+    """Iterate over a response body as it arrives, in chunks of up to chunk_size
+
+    Unlike iter_content(), which waits for a whole chunk, so a deadline
+    may be checked as often as data arrives.
+    """
+    if hasattr(raw, "read1"):
+        read = functools.partial(raw.read1, chunk_size, decode_content=True)
+    else:
+        # urllib3 1.x has no read1(); smaller reads wait for less
+        read = functools.partial(raw.read, min(chunk_size, 65536), decode_content=True)
+    while True:
+        data = read()
+        if not data:
+            return
+        yield data
+
+
+def parse_server_timing(header):
+    # e.g. "recv;dur=12.345"
+    for metric in header.split(","):
+        for param in metric.split(";")[1:]:
+            key, _, value = param.strip().partition("=")
+            if key == "dur":
+                try:
+                    return int(float(value) * 1000000)
+                except ValueError:
+                    pass
+    return None
+
+
+class HTTPTransport:
+    def __init__(self, speedtest, url_base, http_session=None, chunk_size=1048576, upload_chunk_size=65536):
+        self.speedtest = speedtest
+        self.url_base = url_base
+        self.http_session = http_session
+        self.chunk_size = chunk_size
+        # Small enough for upload progress to be seen every few ms at 100 Mbit/s
+        self.payload = SemiRandomPayload(chunk_size=upload_chunk_size)
+
+    def close(self):
+        if self.http_session is not None:
+            self.http_session.close()
+
+    def hello(self):
+        r = self.speedtest.st_request("GET", self.url_base + "hello", http_session=self.http_session)
+        return r.text.strip()
+
+    def ping(self):
+        t_start = time.perf_counter_ns()
+        self.speedtest.st_request("GET", self.url_base + "hello", http_session=self.http_session).content
+        return time.perf_counter_ns() - t_start
+
+    def download(self, size, max_ns=None):
+        """Download size bytes, or stop after max_ns of transfer
+
+        A download cut short closes the connection rather than
+        draining the rest of the response.
+        """
+        sample = Sample("download")
+        _phase_timing.sample = sample
+        try:
+            with self.speedtest.st_request(
+                "GET",
+                self.url_base + "download",
+                params={"size": size},
+                stream=True,
+                http_session=self.http_session,
+            ) as r:
+                series = sample.series = ThroughputSeries()
+                t_start = series.start_ns
+                deadline = None if max_ns is None else t_start + max_ns
+                transfer_bytes = 0
+                # A bounded chunk size, as urllib3 2 reads the whole body for chunk_size=None
+                for i in iter_body(r.raw, self.chunk_size):
+                    transfer_bytes += len(i)
+                    now = series.add(transfer_bytes)
+                    if deadline is not None and now >= deadline:
+                        break
+                sample.end_ns = time.perf_counter_ns()
+                series.finish(sample.end_ns, transfer_bytes)
+        finally:
+            _phase_timing.sample = None
+        sample.transfer_bytes = transfer_bytes
+        sample.transfer_ns = sample.end_ns - t_start
+        return sample
+
+    def upload(self, size):
+        # requests uses chunked transfer encoding for iterables of
+        # unknown length, which the servers do not support, but will
+        # send a Content-Length for iterables which support len().
+        self.payload.byte_count = size
+        sample = Sample("upload")
+        self.payload.series = sample.series = ThroughputSeries()
+        _phase_timing.sample = sample
+        try:
+            r = self.speedtest.st_request(
+                "POST",
+                self.url_base + "upload",
+                data=self.payload,
+                stream=True,
+                http_session=self.http_session,
+            )
+            sample.end_ns = time.perf_counter_ns()
+        finally:
+            _phase_timing.sample = None
+        sample.transfer_bytes = int(urllib.parse.parse_qs(r.text.strip())["size"][0])
+        sample.series.finish(sample.end_ns, sample.transfer_bytes)
+        # The body send completes once the data is buffered locally, so
+        # the transfer lasts until the server confirms receipt.
+        sample.transfer_ns = sample.send_ns + sample.ttfb_ns
+        if "Server-Timing" in r.headers:
+            sample.server_ns = parse_server_timing(r.headers["Server-Timing"])
+        return sample
+
+
+def new_http_session():
+    http_session = requests.Session()
+    adapter = TimedHTTPAdapter()
+    http_session.mount("http://", adapter)
+    http_session.mount("https://", adapter)
+    http_session.headers["User-Agent"] = "qospeedtest (https://github.com/rfinnie/qospeedtest)"
+    return http_session
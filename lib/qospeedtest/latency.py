@@ -0,0 +1,93 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import logging
+import math
+import statistics
+import threading
+
+
+class LatencyStats:
+    __slots__ = ("count", "lost", "min_ns", "median_ns", "p99_ns", "jitter_ns")
+
+    def __init__(self, rtt_list, lost=0):
+        self.count = len(rtt_list)
+        self.lost = lost
+        if not rtt_list:
+            self.min_ns = self.median_ns = self.p99_ns = self.jitter_ns = None
+            return
+        rtt_sorted = sorted(rtt_list)
+        self.min_ns = rtt_sorted[0]
+        self.median_ns = statistics.median(rtt_sorted)
+        self.p99_ns = rtt_sorted[max(math.ceil(len(rtt_sorted) * 0.99) - 1, 0)]
+        # Mean difference between consecutive probes, as in RFC 3550
+        if len(rtt_list) > 1:
+            self.jitter_ns = statistics.mean(abs(b - a) for a, b in zip(rtt_list, rtt_list[1:]))
+        else:
+            self.jitter_ns = 0
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class LatencyProbe:
+    """Round-trip probes against a transport, idle or in the background
+
+    The transport must be dedicated to the probe, so probes are not
+    queued behind transfers on the same connection.
+    """
+
+    def __init__(self, transport, interval=0.2):
+        self.transport = transport
+        self.interval = interval
+        self.rtt_list = []
+        self.lost = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def probe(self):
+        try:
+            self.rtt_list.append(self.transport.ping())
+        except Exception as e:
+            logging.debug("Latency probe failed: {}".format(e))
+            self.lost += 1
+
+    def warm_up(self):
+        # Establish the connection outside of any timed probe
+        try:
+            self.transport.hello()
+        except Exception as e:
+            logging.debug("Latency probe failed: {}".format(e))
+
+    def run(self, count):
+        self.warm_up()
+        for i in range(count):
+            if i:
+                self._stop.wait(self.interval)
+            self.probe()
+        return self.stats()
+
+    def start(self):
+        self.rtt_list = []
+        self.lost = 0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run_background, daemon=True)
+        self._thread.start()
+
+    def _run_background(self):
+        self.warm_up()
+        while not self._stop.wait(self.interval):
+            self.probe()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return self.stats()
+
+    def stats(self):
+        return LatencyStats(self.rtt_list, self.lost)
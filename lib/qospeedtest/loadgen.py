@@ -0,0 +1,339 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+# Server capacity load generator.  Each virtual client is a coroutine
+# with its own keep-alive HTTP connection, running the same hello,
+# ramp-up and EWMA sampling as a real qospeedtest test.  Clients can be
+# spread over several processes when one event loop cannot keep up.
+#
+#   qospeedtest-loadgen http://example.com:8080/ --clients 1,10,100,200
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+import urllib.parse
+
+from . import __version__
+from . import random_pool, si_number
+from .convergence import EWMAConvergence
+
+
+class HTTPError(Exception):
+    pass
+
+
+class VirtualClient:
+    """A single simulated qospeedtest client
+
+    Once its own result has converged, a client keeps transferring
+    until every client sharing its level has finished, so the
+    concurrency does not drop off for the slowest clients.
+    """
+
+    def __init__(self, url_base, mode, options, level=None):
+        url = urllib.parse.urlsplit(url_base)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.path = url.path.rstrip("/") + "/"
+        self.mode = mode
+        self.options = options
+        self.level = level
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def read_response(self):
+        head = await self.reader.readuntil(b"\r\n\r\n")
+        lines = head.decode("ISO-8859-1").split("\r\n")
+        status = lines[0].split(" ", 2)
+        if len(status) < 2 or status[1] != "200":
+            raise HTTPError(lines[0])
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            if name.strip().lower() == "content-length":
+                return int(value)
+        raise HTTPError("No Content-Length in response")
+
+    def request_head(self, method, path, content_length=None):
+        return "{} {}{} HTTP/1.1\r\nHost: {}\r\n{}\r\n".format(
+            method,
+            self.path,
+            path,
+            self.host,
+            "" if content_length is None else "Content-Length: {}\r\n".format(content_length),
+        ).encode("ISO-8859-1")
+
+    async def hello(self):
+        self.writer.write(self.request_head("GET", "hello"))
+        body = await self.reader.readexactly(await self.read_response())
+        if not body.startswith(b"hello"):
+            raise HTTPError("Expected hello response from server, got: {}".format(body.strip()))
+
+    async def download(self, size):
+        self.writer.write(self.request_head("GET", "download?size={}".format(size)))
+        content_length = await self.read_response()
+        t_start = time.perf_counter_ns()
+        received = 0
+        chunk_size = self.options.chunk_size
+        while received < content_length:
+            left = content_length - received
+            data = await self.reader.read(left if left < chunk_size else chunk_size)
+            if not data:
+                raise ConnectionError("Connection closed by server")
+            received += len(data)
+        return received, time.perf_counter_ns() - t_start
+
+    async def upload(self, size):
+        pool = memoryview(random_pool())
+        pool_len = len(pool)
+        t_start = time.perf_counter_ns()
+        self.writer.write(self.request_head("POST", "upload", size))
+        left = size
+        while left > 0:
+            self.writer.write(pool if left >= pool_len else pool[:left])
+            left -= pool_len
+            await self.writer.drain()
+        body = await self.reader.readexactly(await self.read_response())
+        t_transfer = time.perf_counter_ns() - t_start
+        return int(urllib.parse.parse_qs(body.decode("UTF-8").strip())["size"][0]), t_transfer
+
+    async def run(self):
+        options = self.options
+        result = {"bps": None, "bytes": 0, "transfers": 0, "error": None}
+        convergence = EWMAConvergence(
+            options.target_seconds * 1e9,
+            options.initial_download if self.mode == "download" else options.initial_upload,
+            ewma_weight=options.ewma_weight,
+            minimum_samples=options.minimum_samples,
+            maximum_samples=options.maximum_samples,
+        )
+        transfer = self.download if self.mode == "download" else self.upload
+        try:
+            await asyncio.wait_for(self.connect(), options.timeout)
+            await asyncio.wait_for(self.hello(), options.timeout)
+            while not convergence.done:
+                size = max(convergence.projected_bytes, 1)
+                transferred, t_transfer = await asyncio.wait_for(transfer(size), options.timeout)
+                if transferred != size:
+                    raise HTTPError("Expected {} bytes, got {}".format(size, transferred))
+                result["bytes"] += transferred
+                result["transfers"] += 1
+                convergence.add(transferred * 8e9 / max(t_transfer, 1), t_transfer)
+            result["bps"] = convergence.bps
+        except (OSError, EOFError, asyncio.TimeoutError, HTTPError, ValueError, KeyError) as e:
+            result["error"] = "{}: {}".format(type(e).__name__, e)
+        if self.level is not None:
+            self.level.finished()
+            # A size of 0 would be taken by the server as its 10 GiB default
+            size = max(convergence.projected_bytes, 1)
+            try:
+                while result["error"] is None and not self.level.done:
+                    transferred, t_transfer = await asyncio.wait_for(transfer(size), options.timeout)
+                    result["bytes"] += transferred
+            except (OSError, EOFError, asyncio.TimeoutError, HTTPError, ValueError, KeyError):
+                pass
+        self.close()
+        return result
+
+
+class Level:
+    """The clients of a concurrency level which have yet to finish
+
+    remaining is a multiprocessing.Value, shared by every process
+    running clients of the level.
+    """
+
+    def __init__(self, remaining):
+        self.remaining = remaining
+
+    def finished(self):
+        with self.remaining.get_lock():
+            self.remaining.value -= 1
+
+    @property
+    def done(self):
+        return self.remaining.value <= 0
+
+
+# Set in worker processes by init_worker()
+_level_remaining = None
+
+
+def init_worker(remaining):
+    global _level_remaining
+    _level_remaining = remaining
+
+
+async def run_clients(url_base, mode, count, options, remaining=None):
+    if remaining is None:
+        import multiprocessing
+
+        remaining = multiprocessing.Value("l", count)
+    level = Level(remaining)
+    clients = [VirtualClient(url_base, mode, options, level) for i in range(count)]
+    return await asyncio.gather(*[client.run() for client in clients])
+
+
+def run_clients_sync(url_base, mode, count, options):
+    # Entry point for worker processes, whose clients share the level
+    return asyncio.run(run_clients(url_base, mode, count, options, _level_remaining))
+
+
+def jain_index(values):
+    """Jain's fairness index: 1.0 when all values are equal, 1/n when one takes everything"""
+    if not values:
+        return None
+    square_sum = sum(v * v for v in values)
+    return (sum(values) ** 2) / (len(values) * square_sum) if square_sum else None
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def summarize(mode, count, results, duration_ns):
+    bps_list = sorted(result["bps"] for result in results if result["error"] is None)
+    errors = [result["error"] for result in results if result["error"] is not None]
+    total_bytes = sum(result["bytes"] for result in results)
+    return {
+        "mode": mode,
+        "clients": count,
+        "errors": len(errors),
+        "error_rate": len(errors) / count,
+        "error_examples": sorted(set(errors))[:5],
+        "duration_ns": duration_ns,
+        "bytes": total_bytes,
+        # Everything moved during the level, over its wall clock time
+        "aggregate_bps": total_bytes * 8e9 / duration_ns,
+        "client_bps_sum": sum(bps_list),
+        "client_bps_min": percentile(bps_list, 0),
+        "client_bps_p10": percentile(bps_list, 0.1),
+        "client_bps_median": percentile(bps_list, 0.5),
+        "client_bps_p90": percentile(bps_list, 0.9),
+        "client_bps_max": percentile(bps_list, 1),
+        "jain_index": jain_index(bps_list),
+    }
+
+
+def run_level(executor, url_base, mode, count, options, remaining=None):
+    """Run a level of count clients, over executor's processes if given
+
+    remaining is the Value the executor's workers were initialized
+    with, which is reset to count for the level.
+    """
+    t_start = time.perf_counter_ns()
+    if executor is None:
+        results = asyncio.run(run_clients(url_base, mode, count, options))
+    else:
+        remaining.value = count
+        processes = options.processes
+        counts = [count // processes + (1 if i < count % processes else 0) for i in range(processes)]
+        futures = [executor.submit(run_clients_sync, url_base, mode, n, options) for n in counts if n]
+        results = [result for future in futures for result in future.result()]
+    return summarize(mode, count, results, time.perf_counter_ns() - t_start)
+
+
+def format_summary(summary):
+    def bps(value):
+        if value is None:
+            return "-"
+        value = si_number(value)
+        return "{:0.02f} {}b/s".format(value, value.prefix)
+
+    return (
+        "{mode} x{clients}: aggregate {aggregate}, per client min {min} / median {median} / max {max}, "
+        "Jain's index {jain}, {errors} errors ({error_rate:.1%})".format(
+            mode=summary["mode"],
+            clients=summary["clients"],
+            aggregate=bps(summary["aggregate_bps"]),
+            min=bps(summary["client_bps_min"]),
+            median=bps(summary["client_bps_median"]),
+            max=bps(summary["client_bps_max"]),
+            jain=("-" if summary["jain_index"] is None else "{:0.3f}".format(summary["jain_index"])),
+            errors=summary["errors"],
+            error_rate=summary["error_rate"],
+        )
+    )
+
+
+def parse_args(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    program = os.path.basename(argv[0])
+    parser = argparse.ArgumentParser(
+        description="{} ({})".format(program, __version__),
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        prog=program,
+    )
+    parser.add_argument("server", type=str, help="qospeedtest-server or OoklaServer HTTP URL")
+    parser.add_argument(
+        "--clients",
+        type=lambda x: [int(i) for i in x.split(",")],
+        default=[1, 10, 50, 100],
+        help="Comma-separated numbers of concurrent virtual clients to step through",
+    )
+    parser.add_argument("--mode", choices=["download", "upload"], action="append", default=None, help="Test to run (default: both)")
+    parser.add_argument("--processes", type=int, default=1, help="Number of processes to spread virtual clients over")
+    parser.add_argument("--target-seconds", type=float, default=1.0, help="Length of each request to try for")
+    parser.add_argument("--ewma-weight", type=float, default=8.0, help="EWMA weight for speed confidence")
+    parser.add_argument("--initial-download", type=int, default=(1024 * 1024), help="Bytes for the initial download")
+    parser.add_argument("--initial-upload", type=int, default=(1024 * 128), help="Bytes for the initial upload")
+    parser.add_argument("--minimum-samples", type=int, default=10, help="Minimum number of samples per client")
+    parser.add_argument("--maximum-samples", type=int, default=50, help="Maximum number of samples per client")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Seconds before a client request is an error")
+    parser.add_argument("--chunk-size", type=int, default=(1024 * 256), help="Read size for downloads")
+    parser.add_argument("--format", choices=["text", "json", "ndjson"], default="text", help="Output format")
+    return parser.parse_args(args=argv[1:])
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    executor = None
+    remaining = None
+    if args.processes > 1:
+        import concurrent.futures
+        import multiprocessing
+
+        remaining = multiprocessing.Value("l", 0)
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.processes, initializer=init_worker, initargs=(remaining,)
+        )
+    summaries = []
+    try:
+        for mode in args.mode or ("download", "upload"):
+            for count in args.clients:
+                logging.info("Running {} {} clients against {}".format(count, mode, args.server))
+                summary = run_level(executor, args.server, mode, count, args, remaining)
+                summaries.append(summary)
+                logging.info(format_summary(summary))
+                if args.format == "ndjson":
+                    sys.stdout.write(json.dumps(summary) + "\n")
+                    sys.stdout.flush()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if args.format == "json":
+        json.dump({"version": __version__, "server": args.server, "levels": summaries}, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,262 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+# Minimal Prometheus text format (0.0.4) metrics, without the
+# prometheus_client dependency.  Counters and histograms are sharded
+# per thread, so updating them on a hot path takes no lock; the shards
+# are only summed when the metrics are collected.
+
+import bisect
+import logging
+import math
+import threading
+import weakref
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    elif value == -math.inf:
+        return "-Inf"
+    elif isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in labels)
+    )
+
+
+class ShardedCells:
+    """A fixed number of values, each thread updating its own copy"""
+
+    def __init__(self, size):
+        self.size = size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = {}
+        # Totals from threads which have since exited
+        self._retired = [0] * size
+
+    def cell(self):
+        try:
+            return self._local.cell
+        except AttributeError:
+            pass
+        cell = self._local.cell = [0] * self.size
+        with self._lock:
+            self._shards[id(cell)] = cell
+        weakref.finalize(threading.current_thread(), self._retire, cell)
+        return cell
+
+    def _retire(self, cell):
+        with self._lock:
+            del self._shards[id(cell)]
+            for i, v in enumerate(cell):
+                self._retired[i] += v
+
+    def totals(self):
+        with self._lock:
+            totals = list(self._retired)
+            for cell in self._shards.values():
+                for i, v in enumerate(cell):
+                    totals[i] += v
+        return totals
+
+
+class CounterChild:
+    def __init__(self, metric):
+        self._cells = ShardedCells(1)
+
+    def inc(self, amount=1):
+        self._cells.cell()[0] += amount
+
+    def get(self):
+        return self._cells.totals()[0]
+
+    def samples(self, name):
+        yield name, (), self.get()
+
+
+class GaugeChild:
+    # Gauges change rarely (once per transfer or test), so a lock is fine
+    def __init__(self, metric):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value):
+        self._value = value
+
+    def get(self):
+        return self._value
+
+    def samples(self, name):
+        yield name, (), self._value
+
+
+class HistogramChild:
+    def __init__(self, metric):
+        self.buckets = metric.buckets
+        # Per-bucket (non-cumulative) counts, then +Inf, then the sum
+        self._cells = ShardedCells(len(self.buckets) + 2)
+
+    def observe(self, value):
+        cell = self._cells.cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def samples(self, name):
+        totals = self._cells.totals()
+        cumulative = 0
+        for bucket, count in zip(self.buckets + (math.inf,), totals):
+            cumulative += count
+            yield name + "_bucket", (("le", format_value(float(bucket))),), cumulative
+        yield name + "_sum", (), totals[-1]
+        yield name + "_count", (), cumulative
+
+
+class Metric:
+    type = "untyped"
+    child_class = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        self._default = None if self.labelnames else self.labels()
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError("Expected labels {}, got {}".format(self.labelnames, values))
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self.child_class(self)
+        return child
+
+    def exposition(self):
+        yield "# HELP {} {}".format(self.name, self.documentation.replace("\\", "\\\\").replace("\n", "\\n"))
+        yield "# TYPE {} {}".format(self.name, self.type)
+        for values, child in list(self._children.items()):
+            labels = tuple(zip(self.labelnames, values))
+            for name, extra_labels, value in child.samples(self.name):
+                yield "{}{} {}".format(name, format_labels(labels + extra_labels), format_value(value))
+
+
+class Counter(Metric):
+    type = "counter"
+    child_class = CounterChild
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def get(self):
+        return self._default.get()
+
+
+class Gauge(Metric):
+    type = "gauge"
+    child_class = GaugeChild
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def set(self, value):
+        self._default.set(value)
+
+    def get(self):
+        return self._default.get()
+
+
+class Histogram(Metric):
+    type = "histogram"
+    child_class = HistogramChild
+
+    def __init__(self, name, documentation, labelnames=(), buckets=(0.01, 0.1, 1.0, 10.0)):
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+
+def exponential_buckets(start, factor, count):
+    return tuple(start * factor**i for i in range(count))
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def exposition(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.exposition())
+        lines.append("")
+        return "\n".join(lines).encode("UTF-8")
+
+
+def serve_background(bind, registry):
+    """Serve registry on /metrics from a background thread"""
+    import http.server
+
+    from .server import parse_bind
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.partition("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.exposition()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("Metrics request: {}".format(format % args))
+
+    server = http.server.ThreadingHTTPServer(parse_bind(bind), MetricsHandler)
+    server.daemon_threads = True
+    logging.info("Serving metrics at: http://{}:{}/metrics".format(*server.server_address[:2]))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
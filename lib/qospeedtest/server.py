@@ -4,106 +4,478 @@
 # SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
 # SPDX-License-Identifier: MPL-2.0
 
+import argparse
+import io
 import logging
+import os
+import sys
+import tempfile
+import threading
+import time
 import urllib.parse
 
 from . import __version__
-from . import SemiRandomGenerator
+from . import configure_pool, random_pool
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from .metrics import Registry, exponential_buckets
+from .tracing import NULL_TRACER
 
 
-class ServerApplication:
-    def __call__(self, environ, start_response):
+class PoolFile:
+    """The random pool repeated into a memory-backed file, for sendfile()
+
+    The file offset is never moved after creation, so the descriptor
+    can be shared by every response; servers which use sendfile()
+    pass explicit offsets.
+    """
+
+    def __init__(self, size):
+        pool = random_pool()
+        repeat = max(1, size // len(pool))
+        if hasattr(os, "memfd_create"):
+            self.file = open(os.memfd_create("qospeedtest-pool", os.MFD_CLOEXEC), "w+b")
+        else:
+            self.file = tempfile.TemporaryFile()
+        for i in range(repeat):
+            self.file.write(pool)
+        self.file.flush()
+        self.file.seek(0)
+        self.size = repeat * len(pool)
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def reopen(self):
+        """Another file object for the pool file, with an offset of its own
+
+        For servers whose sendfile() moves the file offset afterwards.
+        Raises io.UnsupportedOperation where the file cannot be opened
+        again through /proc, as a dup() would share the offset.
+        """
+        try:
+            return open("/proc/self/fd/{}".format(self.fileno()), "rb")
+        except OSError:
+            raise io.UnsupportedOperation("reopen")
+
+
+def block_size():
+    """Size of the blocks DownloadBody is read in
+
+    Whole blocks of a bytes pool are returned without copying.  WSGI
+    needs bytes, so blocks of a memory-mapped pool are copies, and are
+    kept to 1 MiB.
+    """
+    pool = random_pool()
+    return len(pool) if isinstance(pool, bytes) else min(len(pool), 1048576)
+
+
+class DownloadBody:
+    """File-like download body of a given length, for wsgi.file_wrapper
+
+    read() repeats the random pool without copying it for full-sized
+    blocks.  fileno() is only offered when the whole body fits within
+    the PoolFile, as WSGI servers will sendfile() exactly the
+    Content-Length from the descriptor.
+
+    Servers which sendfile() it through socket.sendfile(), as Gunicorn
+    does, seek() to the end of what was sent afterwards, including when
+    the client went away, so the position is what was sent either way;
+    a server which does neither is taken to have sent nothing.
+
+    It is also iterable, for WSGI servers without a file_wrapper.
+    on_close, if given, is called once with the number of bytes sent
+    and the length when the server closes the body.  throttle, if
+    given, is called with the size of each block before it is
+    returned, and may sleep to pace the download.
+    """
+
+    def __init__(self, length, pool_file=None, on_close=None, throttle=None):
+        self.length = length
+        self.position = 0
+        self.pool_file = pool_file
+        self.on_close = on_close
+        self.throttle = throttle
+
+    def fileno(self):
+        if self.pool_file is None or self.length > self.pool_file.size:
+            raise io.UnsupportedOperation("fileno")
+        return self.pool_file.fileno()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        # Only the position moves; the shared PoolFile offset stays at 0
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        self.position = min(max(offset, 0), self.length)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def __iter__(self):
+        read_size = block_size()
+        while True:
+            data = self.read(read_size)
+            if not data:
+                return
+            yield data
+
+    def read(self, size=-1):
+        pool = random_pool()
+        pool_len = len(pool)
+        remaining = self.length - self.position
+        if size < 0 or size > remaining:
+            size = remaining
+        offset = self.position % pool_len
+        if size > pool_len - offset:
+            size = pool_len - offset
+        self.position += size
+        if self.throttle is not None and size:
+            self.throttle(size)
+        if offset == 0 and size == pool_len and isinstance(pool, bytes):
+            return pool
+        return pool[offset : offset + size]
+
+    def close(self):
+        if self.on_close is not None:
+            on_close, self.on_close = self.on_close, None
+            on_close(self.position, self.length)
+
+
+def download_size(query_params):
+    output_len = 0
+    if "size" in query_params:
+        try:
+            output_len = int(query_params["size"][0])
+        except Exception:
+            pass
+    if output_len <= 0:
+        output_len = 10737418240
+    return output_len
+
+
+def options_headers(origin=None, request_headers=None):
+    headers = [
+        ("Content-Type", "text/plain; charset=UTF-8"),
+        ("Content-Length", str(0)),
+        ("Access-Control-Allow-Methods", "OPTIONS, GET, POST"),
+    ]
+    if origin is not None:
+        headers.append(("Access-Control-Allow-Origin", origin))
+        headers.append(("Vary", "Origin"))
+    if request_headers is not None:
+        headers.append(("Access-Control-Allow-Headers", request_headers))
+    return headers
+
+
+class Request:
+    __slots__ = ("environ", "start_response", "path", "_query_params")
+
+    def __init__(self, environ, start_response):
         self.environ = environ
         self.start_response = start_response
-        self.path = self.environ["PATH_INFO"].lstrip("/")
-        self.query_params = {}
-        if "QUERY_STRING" in self.environ:
-            self.query_params = urllib.parse.parse_qs(self.environ["QUERY_STRING"])
-        if hasattr(self, "method_{}".format(self.environ["REQUEST_METHOD"])):
-            return getattr(self, "method_{}".format(self.environ["REQUEST_METHOD"]))()
+        self.path = environ["PATH_INFO"].lstrip("/")
+        self._query_params = None
+
+    @property
+    def query_params(self):
+        if self._query_params is None:
+            self._query_params = urllib.parse.parse_qs(self.environ.get("QUERY_STRING", ""))
+        return self._query_params
+
+
+class ServerMetrics:
+    """Per-transfer server instrumentation
+
+    Only transfer starts and ends are recorded, not individual chunks,
+    so the cost does not grow with the transfer size.
+    """
+
+    modes = ("download", "upload")
+
+    def __init__(self, registry=None):
+        r = self.registry = registry or Registry()
+        active = r.gauge("qospeedtest_server_active_transfers", "Transfers in progress", ["mode"])
+        transfers = r.counter("qospeedtest_server_transfers_total", "Transfers completed or aborted", ["mode"])
+        aborts = r.counter("qospeedtest_server_client_aborts_total", "Transfers ended early by the client", ["mode"])
+        rejected = r.counter("qospeedtest_server_rejected_transfers_total", "Transfers refused as the server was busy", ["mode"])
+        transfer_bytes = r.counter(
+            "qospeedtest_server_transfer_bytes_total", "Payload bytes sent (download) or received (upload)", ["mode"]
+        )
+        duration = r.histogram(
+            "qospeedtest_server_transfer_duration_seconds",
+            "Time taken by each transfer",
+            ["mode"],
+            buckets=exponential_buckets(0.001, 2, 16),
+        )
+        # Label lookups are done once, rather than on every transfer
+        self._children = {
+            mode: (
+                active.labels(mode),
+                transfers.labels(mode),
+                aborts.labels(mode),
+                transfer_bytes.labels(mode),
+                duration.labels(mode),
+            )
+            for mode in self.modes
+        }
+        self._rejected = {mode: rejected.labels(mode) for mode in self.modes}
+
+    def reject(self, mode):
+        self._rejected[mode].inc()
+
+    def start(self, mode):
+        """Record the start of a transfer, returning its finish(transferred, expected) callback"""
+        active, transfers, aborts, transfer_bytes, duration = self._children[mode]
+        active.inc()
+        t_start = time.perf_counter_ns()
+
+        def finish(transferred, expected):
+            duration.observe((time.perf_counter_ns() - t_start) / 1e9)
+            active.dec()
+            transfers.inc()
+            transfer_bytes.inc(transferred)
+            if transferred < expected:
+                aborts.inc()
+
+        return finish
+
+
+def finish_transfer(transfer, finish=None):
+    """Combine releasing an admitted transfer with its metrics finish(transferred, expected)"""
+
+    def on_close(transferred, expected):
+        transfer.release()
+        if finish is not None:
+            finish(transferred, expected)
+
+    return on_close
+
+
+class ServerApplication:
+    _pool_file = None
+
+    def __init__(self, sendfile_max=(1048573 * 64), upload_chunk_size=1048576, metrics=True, admission=None, tracer=None):
+        self.sendfile_max = sendfile_max
+        self.upload_chunk_size = upload_chunk_size
+        self.metrics = ServerMetrics() if metrics else None
+        self.admission = admission
+        self.tracer = tracer or NULL_TRACER
+        self._pool_file_lock = threading.Lock()
+        self._thread_local = threading.local()
+        self.methods = {
+            "GET": self.method_GET,
+            "POST": self.method_POST,
+            "OPTIONS": self.method_OPTIONS,
+        }
+        self.get_routes = {
+            "hello": self.process_hello,
+            "download": self.process_download,
+        }
+        if self.metrics is not None:
+            self.get_routes["metrics"] = self.process_metrics
+        if self.tracer.enabled:
+            self.get_routes["trace"] = self.process_trace
+        self.post_routes = {
+            "upload": self.process_upload,
+        }
+
+    @property
+    def pool_file(self):
+        if self._pool_file is None:
+            with self._pool_file_lock:
+                if self._pool_file is None:
+                    self._pool_file = PoolFile(self.sendfile_max)
+        return self._pool_file
+
+    @property
+    def upload_buffer(self):
+        # One reusable receive buffer per worker thread
+        try:
+            return self._thread_local.upload_buffer
+        except AttributeError:
+            self._thread_local.upload_buffer = memoryview(bytearray(self.upload_chunk_size))
+            return self._thread_local.upload_buffer
+
+    def trace_transfer(self, mode, finish=None):
+        """Record a transfer as a trace span when its finish(transferred, expected) is called"""
+        t_start = time.perf_counter_ns()
+
+        def on_close(transferred, expected):
+            self.tracer.complete(
+                mode,
+                t_start,
+                time.perf_counter_ns(),
+                "transfer",
+                args={"bytes": transferred, "expected": expected},
+            )
+            if finish is not None:
+                finish(transferred, expected)
+
+        return on_close
+
+    def drain_input(self, stream, content_length, throttle=None):
+        """Read and discard a request body.
+
+        Returns the number of bytes received and the number of
+        seconds spent receiving them.  throttle, if given, is called
+        with the size of each chunk received.
+        """
+        received = 0
+        t_start = time.perf_counter()
+        if hasattr(stream, "readinto"):
+            buf = self.upload_buffer
+            buf_len = len(buf)
+            while received < content_length:
+                left = content_length - received
+                n = stream.readinto(buf if left >= buf_len else buf[:left])
+                if not n:
+                    break
+                received += n
+                if throttle is not None:
+                    throttle(n)
         else:
-            return self.simple_response("Method Not Allowed", "405 Method Not Allowed")
+            while received < content_length:
+                left = content_length - received
+                n = len(stream.read(left if left < self.upload_chunk_size else self.upload_chunk_size))
+                if not n:
+                    break
+                received += n
+                if throttle is not None:
+                    throttle(n)
+        return received, time.perf_counter() - t_start
 
-    def simple_response(self, message, code_str="200 OK"):
+    def __call__(self, environ, start_response):
+        request = Request(environ, start_response)
+        method = self.methods.get(environ["REQUEST_METHOD"])
+        if method is None:
+            return self.simple_response(request, "Method Not Allowed", "405 Method Not Allowed")
+        return method(request)
+
+    def simple_response(self, request, message, code_str="200 OK", headers=None):
         body = "{}\n".format(message).encode("UTF-8")
-        self.start_response(
+        request.start_response(
             code_str,
             [
                 ("Content-Type", "text/plain; charset=UTF-8"),
                 ("Content-Length", str(len(body))),
-            ],
+            ]
+            + (headers or []),
         )
         return [body]
 
-    def process_hello(self):
-        return self.simple_response("hello qospeedtest-server {}".format(__version__))
-
-    def process_download(self):
-        output_len = 0
-        if "size" in self.query_params:
-            try:
-                output_len = int(self.query_params["size"][0])
-            except Exception:
-                pass
-        if output_len <= 0:
-            output_len = 10737418240
-        self.start_response(
+    def busy_response(self, request, mode):
+        if self.metrics is not None:
+            self.metrics.reject(mode)
+        return self.simple_response(
+            request,
+            "Busy",
+            "503 Service Unavailable",
+            headers=[("Retry-After", str(self.admission.retry_after))],
+        )
+
+    def process_hello(self, request):
+        return self.simple_response(request, "hello qospeedtest-server {}".format(__version__))
+
+    def process_download(self, request):
+        transfer = None
+        if self.admission is not None:
+            transfer = self.admission.admit(request.environ.get("REMOTE_ADDR"))
+            if transfer is None:
+                return self.busy_response(request, "download")
+        output_len = download_size(request.query_params)
+        request.start_response(
             "200 OK",
             [
                 ("Content-Type", "application/octet-stream"),
                 ("Content-Length", str(output_len)),
             ],
         )
-        return SemiRandomGenerator(output_len)
-
-    def process_upload(self):
-        content_length = int(self.environ["CONTENT_LENGTH"])
-        left = content_length
-        while left > 0:
-            to_read = left if left < 1048576 else 1048576
-            left -= to_read
-            self.environ["wsgi.input"].read(to_read)
-        return self.simple_response("size={}".format(content_length))
-
-    def method_POST(self):
+        on_close = self.metrics.start("download") if self.metrics is not None else None
+        if self.tracer.enabled:
+            on_close = self.trace_transfer("download", on_close)
+        throttle = None
+        if transfer is not None:
+            on_close = finish_transfer(transfer, on_close)
+            if self.admission.shaping:
+                throttle = transfer.throttle
+        if "wsgi.file_wrapper" in request.environ:
+            # sendfile() cannot be paced
+            pool_file = self.pool_file if self.sendfile_max and throttle is None else None
+            return request.environ["wsgi.file_wrapper"](DownloadBody(output_len, pool_file, on_close, throttle), block_size())
+        return DownloadBody(output_len, on_close=on_close, throttle=throttle)
+
+    def process_upload(self, request):
+        content_length = int(request.environ["CONTENT_LENGTH"])
+        transfer = None
+        if self.admission is not None:
+            transfer = self.admission.admit(request.environ.get("REMOTE_ADDR"))
+            if transfer is None:
+                return self.busy_response(request, "upload")
+        finish = self.metrics.start("upload") if self.metrics is not None else None
+        if self.tracer.enabled:
+            finish = self.trace_transfer("upload", finish)
+        if transfer is not None:
+            finish = finish_transfer(transfer, finish)
+        received = 0
         try:
-            int(self.environ["CONTENT_LENGTH"])
-        except (KeyError, ValueError):
-            return self.simple_response("Bad Request", "400 Bad Request")
-        if self.path == "upload":
-            return self.process_upload()
-        else:
-            return self.simple_response("Not Found", "404 Not Found")
-
-    def method_OPTIONS(self):
-        headers = [
-            ("Content-Type", "text/plain; charset=UTF-8"),
-            ("Content-Length", str(0)),
-            ("Access-Control-Allow-Methods", "OPTIONS, GET, POST"),
-        ]
-        if "HTTP_ORIGIN" in self.environ:
-            headers.append(("Access-Control-Allow-Origin", self.environ["HTTP_ORIGIN"]))
-            headers.append(("Vary", "Origin"))
-        if "HTTP_ACCESS_CONTROL_REQUEST_HEADERS" in self.environ:
-            headers.append(
-                (
-                    "Access-Control-Allow-Headers",
-                    self.environ["HTTP_ACCESS_CONTROL_REQUEST_HEADERS"],
-                )
+            received, t_receive = self.drain_input(
+                request.environ["wsgi.input"],
+                content_length,
+                throttle=(transfer.throttle if transfer is not None and self.admission.shaping else None),
             )
-        self.start_response("200 OK", headers)
+        finally:
+            # A failed upload is finished as aborted, releasing its transfer
+            if finish is not None:
+                finish(received, content_length)
+        return self.simple_response(
+            request,
+            "size={}".format(received),
+            headers=[("Server-Timing", "recv;dur={:0.3f}".format(t_receive * 1000.0))],
+        )
+
+    def process_metrics(self, request):
+        body = self.metrics.registry.exposition()
+        request.start_response("200 OK", [("Content-Type", METRICS_CONTENT_TYPE), ("Content-Length", str(len(body)))])
+        return [body]
+
+    def process_trace(self, request):
+        body = self.tracer.dumps()
+        request.start_response("200 OK", [("Content-Type", "application/json"), ("Content-Length", str(len(body)))])
+        return [body]
+
+    def method_POST(self, request):
+        try:
+            int(request.environ["CONTENT_LENGTH"])
+        except (KeyError, ValueError):
+            return self.simple_response(request, "Bad Request", "400 Bad Request")
+        route = self.post_routes.get(request.path)
+        if route is None:
+            return self.simple_response(request, "Not Found", "404 Not Found")
+        return route(request)
+
+    def method_OPTIONS(self, request):
+        headers = options_headers(
+            request.environ.get("HTTP_ORIGIN"),
+            request.environ.get("HTTP_ACCESS_CONTROL_REQUEST_HEADERS"),
+        )
+        request.start_response("200 OK", headers)
         return []
 
-    def method_GET(self):
-        if self.path == "hello":
-            return self.process_hello()
-        elif self.path == "download":
-            return self.process_download()
-        else:
-            return self.simple_response("Not Found", "404 Not Found")
+    def method_GET(self, request):
+        route = self.get_routes.get(request.path)
+        if route is None:
+            return self.simple_response(request, "Not Found", "404 Not Found")
+        return route(request)
 
 
-def standalone_gunicorn():
+def parse_bind(bind):
+    host, _, port = bind.rpartition(":")
+    return host.strip("[]") or "0.0.0.0", int(port)
+
+
+def standalone_gunicorn(bind="0.0.0.0:8080", application=None):
     from gunicorn.app.base import BaseApplication
 
     class StandaloneApplication(BaseApplication):
@@ -120,27 +492,152 @@ def standalone_gunicorn():
         def load(self):
             return self.application
 
-    options = {"bind": "0.0.0.0:8080", "worker_class": "gthread"}
-    application = ServerApplication()
+    options = {"bind": bind, "worker_class": "gthread"}
+    if application is None:
+        application = ServerApplication()
     server = StandaloneApplication(application, options)
     server.run()
 
 
-def standalone_wsgiref():
+def standalone_wsgiref(bind="0.0.0.0:8080", application=None):
     logging.warning("wsgiref.simple_server is unsuitable for production, as it supports neither HTTP 1.1 nor 100 Continue.")
     from wsgiref.simple_server import make_server
 
-    application = ServerApplication()
-    server = make_server("0.0.0.0", 8080, application)
+    if application is None:
+        application = ServerApplication()
+    server = make_server(*parse_bind(bind), application)
     server.serve_forever()
 
 
-def main():
-    logging.basicConfig(format="%(asctime)s: %(name)s/%(levelname)s: %(message)s", level=logging.INFO)
+def standalone_asyncio(bind="0.0.0.0:8080", application=None):
+    import asyncio
+
+    from .aioserver import AsyncioServer
+
     try:
-        standalone_gunicorn()
+        import resource
     except ImportError:
-        standalone_wsgiref()
+        pass
+    else:
+        # Allow as many concurrent clients as the hard limit permits
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    server = AsyncioServer(application)
+    asyncio.run(server.serve_forever(*parse_bind(bind)))
+
+
+def parse_args(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    program = os.path.basename(argv[0])
+    parser = argparse.ArgumentParser(
+        description="{} ({})".format(program, __version__),
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        prog=program,
+    )
+
+    parser.add_argument(
+        "--version",
+        "-V",
+        action="version",
+        version=__version__,
+        help="report the program version",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["auto", "gunicorn", "wsgiref", "asyncio"],
+        default="auto",
+        help="Server backend; auto uses gunicorn if installed, otherwise wsgiref",
+    )
+    parser.add_argument("--bind", type=str, default="0.0.0.0:8080", help="Address and port to listen on")
+    parser.add_argument(
+        "--tcp-bind",
+        type=str,
+        default=None,
+        help="Also serve the OoklaServer TCP protocol on this address and port (e.g. 0.0.0.0:5060)",
+    )
+    parser.add_argument("--no-metrics", action="store_true", help="Do not collect metrics or serve /metrics")
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="Record each download and upload, served in Chrome trace event format at /trace",
+    )
+    parser.add_argument(
+        "--pool-size",
+        type=float,
+        default=None,
+        help="Size of the random payload pool in MiB, from 1 to 64 (default: 1, or QOSPEEDTEST_POOL_SIZE bytes)",
+    )
+    parser.add_argument(
+        "--pool-file",
+        type=str,
+        default=None,
+        help="File to keep the random payload pool in and memory-map (default: QOSPEEDTEST_POOL_FILE, if set)",
+    )
+    parser.add_argument(
+        "--max-transfers",
+        type=int,
+        default=0,
+        help="Maximum concurrent downloads and uploads across all workers; more are refused as busy (0 for unlimited)",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=0.0,
+        help="Total transfer rate across all workers, in Mbit/s (0 for unlimited)",
+    )
+    parser.add_argument(
+        "--client-rate-limit",
+        type=float,
+        default=0.0,
+        help="Transfer rate per client address, in Mbit/s (0 for unlimited)",
+    )
+
+    return parser.parse_args(args=argv[1:])
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(format="%(asctime)s: %(name)s/%(levelname)s: %(message)s", level=logging.INFO)
+    configure_pool(size=(None if args.pool_size is None else int(args.pool_size * 1048576)), path=args.pool_file)
+    admission = None
+    if args.max_transfers or args.rate_limit or args.client_rate_limit:
+        from .admission import Admission
+
+        # Created before Gunicorn forks, so its workers share the limits
+        admission = Admission(
+            max_transfers=args.max_transfers,
+            rate=(args.rate_limit * 1e6 / 8),
+            client_rate=(args.client_rate_limit * 1e6 / 8),
+        )
+    tracer = None
+    if args.trace:
+        from .tracing import Tracer
+
+        tracer = Tracer("qospeedtest-server")
+    application = ServerApplication(metrics=(not args.no_metrics), admission=admission, tracer=tracer)
+    # Created before Gunicorn forks, so the pool and sendfile() file are
+    # shared by all workers rather than each building their own
+    random_pool()
+    pool_file = application.pool_file if application.sendfile_max else None
+    if args.tcp_bind:
+        from .tcp import serve_background
+
+        serve_background(args.tcp_bind, pool_file)
+    if args.backend == "gunicorn":
+        standalone_gunicorn(args.bind, application)
+    elif args.backend == "wsgiref":
+        standalone_wsgiref(args.bind, application)
+    elif args.backend == "asyncio":
+        standalone_asyncio(args.bind, application)
+    else:
+        try:
+            standalone_gunicorn(args.bind, application)
+        except ImportError:
+            standalone_wsgiref(args.bind, application)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,90 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import heapq
+import json
+import math
+
+
+class ServerList:
+    """Pre-parsed speedtest.net servers list
+
+    The list keeps the order of speedtest-servers-static.php (nearest
+    first, as seen by speedtest.net), and is cached as compact JSON
+    rows so it does not need to be re-parsed from XML on each run.
+    """
+
+    fields = ("id", "host", "name", "country", "cc", "sponsor", "lat", "lon")
+    cache_version = 1
+
+    def __init__(self, servers=None):
+        self.servers = servers or []
+        self._index = None
+
+    def __iter__(self):
+        return iter(self.servers)
+
+    def __len__(self):
+        return len(self.servers)
+
+    @classmethod
+    def from_xml(cls, source):
+        # Imported here as it is only needed when refreshing the cache
+        import xml.etree.ElementTree as ET
+
+        servers = []
+        for event, elem in ET.iterparse(source):
+            if elem.tag != "server":
+                continue
+            server = {field: elem.attrib.get(field, "") for field in cls.fields}
+            try:
+                server["lat"] = float(server["lat"])
+                server["lon"] = float(server["lon"])
+            except ValueError:
+                server["lat"] = server["lon"] = None
+            servers.append(server)
+            elem.clear()
+        return cls(servers)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("version") != cls.cache_version or data.get("fields") != list(cls.fields):
+            raise ValueError("Unsupported servers list cache format")
+        return cls([dict(zip(cls.fields, row)) for row in data["servers"]])
+
+    def save(self, path):
+        data = {
+            "version": self.cache_version,
+            "fields": list(self.fields),
+            "servers": [[server[field] for field in self.fields] for server in self.servers],
+        }
+        with open(path, "w") as f:
+            json.dump(data, f, separators=(",", ":"))
+
+    def get(self, key):
+        """Look up a server by ID or host"""
+        if self._index is None:
+            self._index = {}
+            for server in self.servers:
+                self._index.setdefault(server["id"], server)
+                self._index.setdefault(server["host"], server)
+        return self._index.get(str(key))
+
+    def nearest(self, lat, lon, count=10):
+        return heapq.nsmallest(
+            count,
+            (server for server in self.servers if server["lat"] is not None),
+            key=lambda server: distance(lat, lon, server["lat"], server["lon"]),
+        )
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """Great-circle distance in kilometers"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 6371.0 * 2 * math.asin(math.sqrt(a))
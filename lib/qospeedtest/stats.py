@@ -0,0 +1,123 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import math
+
+
+class P2Quantile:
+    """Streaming quantile estimate in constant memory
+
+    The P-squared algorithm (Jain and Chlamtac, 1985): five markers
+    track the minimum, maximum, the quantile and half way to it either
+    side, and are moved along a parabola fitted through their
+    neighbours as samples arrive.  Exact for up to five samples.
+    """
+
+    __slots__ = ("p", "heights", "positions", "desired", "increments")
+
+    def __init__(self, p):
+        self.p = p
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x):
+        h = self.heights
+        if len(h) < 5:
+            h.append(x)
+            h.sort()
+            return
+
+        n = self.positions
+        if x < h[0]:
+            h[0] = x
+            k = 0
+        elif x >= h[4]:
+            h[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= h[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = h[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (h[i + 1] - h[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (h[i] - h[i - 1]) / (n[i] - n[i - 1])
+                )
+                if not h[i - 1] < height < h[i + 1]:
+                    height = h[i] + d * (h[i + d] - h[i]) / (n[i + d] - n[i])
+                h[i] = height
+                n[i] += d
+
+    @property
+    def value(self):
+        h = self.heights
+        if not h:
+            return None
+        if len(h) < 5:
+            # Linear interpolation between the closest ranks
+            rank = self.p * (len(h) - 1)
+            low = math.floor(rank)
+            high = min(low + 1, len(h) - 1)
+            return h[low] + (h[high] - h[low]) * (rank - low)
+        return h[2]
+
+
+class StreamingStats:
+    """Running summary of a series of values, in constant memory
+
+    Count, mean and variance (Welford), minimum and maximum, an EWMA
+    (weighted as qospeedtest.EWMA), and P-squared estimates of the
+    requested quantiles are all updated with each value.
+    """
+
+    __slots__ = ("count", "mean", "m2", "min", "max", "ewma_weight", "ewma", "quantiles")
+
+    def __init__(self, ewma_weight=8.0, quantiles=(0.5,)):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.ewma_weight = ewma_weight
+        self.ewma = 0.0
+        self.quantiles = {p: P2Quantile(p) for p in quantiles}
+
+    def add(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        if self.count == 1:
+            self.min = self.max = self.ewma = x
+        else:
+            if x < self.min:
+                self.min = x
+            elif x > self.max:
+                self.max = x
+            self.ewma += (x - self.ewma) / self.ewma_weight
+        for quantile in self.quantiles.values():
+            quantile.add(x)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else None
+
+    @property
+    def stdev(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else None
+
+    def quantile(self, p):
+        return self.quantiles[p].value
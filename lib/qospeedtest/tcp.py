@@ -0,0 +1,263 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+# OoklaServer raw TCP protocol (typically port 5060, or the HTTP port):
+#
+#   HI\n                  -> HELLO <version>\n
+#   PING <ms>\n           -> PONG <ms>\n
+#   DOWNLOAD <size>\n     -> "DOWNLOAD " + random data + "\n", <size> bytes total
+#   UPLOAD <size> 0\n ... -> OK <size> <ms>\n, where <size> includes the command line
+#   GETIP\n               -> YOURIP <address>\n
+#   QUIT\n                -> connection closed
+
+import logging
+import socket
+import socketserver
+import time
+import urllib.parse
+
+from . import __version__
+from . import Sample, SemiRandomPayload, ThroughputSeries, random_pool
+from .server import DownloadBody
+
+
+class TCPRequestHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = memoryview(bytearray(self.server.chunk_size))
+        self.pending = bytearray()
+
+    def readline(self):
+        while True:
+            pos = self.pending.find(b"\n")
+            if pos >= 0:
+                line = bytes(self.pending[: pos + 1])
+                del self.pending[: pos + 1]
+                return line
+            if len(self.pending) > 4096:
+                return None
+            n = self.request.recv_into(self.buffer)
+            if not n:
+                return None
+            self.pending += self.buffer[:n]
+
+    def handle(self):
+        commands = {
+            "HI": self.command_HI,
+            "PING": self.command_PING,
+            "DOWNLOAD": self.command_DOWNLOAD,
+            "UPLOAD": self.command_UPLOAD,
+            "GETIP": self.command_GETIP,
+        }
+        while True:
+            line = self.readline()
+            if line is None:
+                return
+            args = line.decode("ISO-8859-1").split()
+            if not args or args[0] == "QUIT":
+                return
+            command = commands.get(args[0])
+            if command is None:
+                self.request.sendall(b"ERROR\n")
+                continue
+            try:
+                if command(line, args[1:]) is False:
+                    return
+            except (IndexError, ValueError):
+                self.request.sendall(b"ERROR\n")
+            except ConnectionError:
+                # e.g. a client ending a download early
+                return
+
+    def command_HI(self, line, args):
+        self.request.sendall("HELLO qospeedtest-server {}\n".format(__version__).encode("UTF-8"))
+
+    def command_PING(self, line, args):
+        self.request.sendall("PONG {}\n".format(int(time.time() * 1000)).encode("UTF-8"))
+
+    def command_GETIP(self, line, args):
+        self.request.sendall("YOURIP {}\n".format(self.client_address[0]).encode("UTF-8"))
+
+    def command_DOWNLOAD(self, line, args):
+        size = int(args[0])
+        if size < 10:
+            raise ValueError(size)
+        self.request.sendall(b"DOWNLOAD ")
+        left = size - 10
+        pool_file = self.server.pool_file
+        if pool_file is None:
+            pool = memoryview(random_pool())
+            while left > 0:
+                self.request.sendall(pool if left >= len(pool) else pool[:left])
+                left -= len(pool)
+        else:
+            while left > 0:
+                count = left if left < pool_file.size else pool_file.size
+                self.request.sendfile(DownloadBody(count, pool_file), 0, count)
+                left -= count
+        self.request.sendall(b"\n")
+
+    def command_UPLOAD(self, line, args):
+        size = int(args[0])
+        t_start = time.perf_counter()
+        received = len(line) + len(self.pending)
+        del self.pending[:]
+        buf_len = len(self.buffer)
+        while received < size:
+            left = size - received
+            n = self.request.recv_into(self.buffer if left >= buf_len else self.buffer[:left])
+            if not n:
+                return False
+            received += n
+        t_receive = time.perf_counter() - t_start
+        self.request.sendall("OK {} {}\n".format(received, int(t_receive * 1000)).encode("UTF-8"))
+
+
+class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, pool_file=None, chunk_size=1048576):
+        self.pool_file = pool_file
+        self.chunk_size = chunk_size
+        super().__init__(server_address, TCPRequestHandler)
+
+
+class TCPClient:
+    def __init__(self, url_base, timeout=30.0, chunk_size=1048576, upload_chunk_size=65536):
+        url = urllib.parse.urlsplit(url_base)
+        self.address = (url.hostname, url.port or 5060)
+        self.timeout = timeout
+        self.buffer = memoryview(bytearray(chunk_size))
+        self.upload_chunk_size = upload_chunk_size
+        self.sock = None
+
+    def connect(self, sample=None):
+        if self.sock is None:
+            t_start = time.perf_counter_ns()
+            self.sock = socket.create_connection(self.address, timeout=self.timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if sample is not None:
+                sample.connect_ns = time.perf_counter_ns() - t_start
+        return self.sock
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.sendall(b"QUIT\n")
+            except OSError:
+                pass
+            self.sock.close()
+            self.sock = None
+
+    def readline(self):
+        # Responses to commands are always a single short line
+        pos = 0
+        while True:
+            n = self.sock.recv_into(self.buffer[pos:])
+            if not n:
+                raise ConnectionError("Connection closed by server")
+            pos += n
+            if self.buffer[pos - 1] == 10:
+                return bytes(self.buffer[:pos]).decode("UTF-8")
+
+    def command(self, line):
+        self.connect().sendall(line.encode("UTF-8"))
+        return self.readline()
+
+    def hello(self):
+        return self.command("HI\n").strip()
+
+    def ping(self):
+        self.connect()
+        t_start = time.perf_counter_ns()
+        response = self.command("PING {}\n".format(int(time.time() * 1000)))
+        t_ping = time.perf_counter_ns() - t_start
+        if not response.startswith("PONG "):
+            raise ValueError("Expected PONG response from server, got: {}".format(response.strip()))
+        return t_ping
+
+    def download(self, size, max_ns=None):
+        """Download size bytes, or stop after max_ns of transfer
+
+        A download cut short closes the connection, as the rest of the
+        data cannot be skipped.
+        """
+        sample = Sample("download")
+        sock = self.connect(sample)
+        t_start = time.perf_counter_ns()
+        sock.sendall("DOWNLOAD {}\n".format(size).encode("UTF-8"))
+        # The transfer is timed from the request, as the data from the
+        # first recv arrived at some point while waiting for it.
+        series = sample.series = ThroughputSeries()
+        t_sent = series.start_ns
+        deadline = None if max_ns is None else t_sent + max_ns
+        buf_len = len(self.buffer)
+        received = sock.recv_into(self.buffer if size >= buf_len else self.buffer[:size])
+        t_first = series.add(received)
+        while 0 < received < size:
+            left = size - received
+            n = sock.recv_into(self.buffer if left >= buf_len else self.buffer[:left])
+            if not n:
+                break
+            received += n
+            now = series.add(received)
+            if deadline is not None and now >= deadline:
+                break
+        sample.end_ns = time.perf_counter_ns()
+        series.finish(sample.end_ns, received)
+        if received < size:
+            self.sock.close()
+            self.sock = None
+        sample.send_ns = t_sent - t_start
+        sample.ttfb_ns = t_first - t_sent
+        sample.transfer_ns = sample.end_ns - t_sent
+        sample.transfer_bytes = received
+        return sample
+
+    def upload(self, size):
+        sample = Sample("upload")
+        sock = self.connect(sample)
+        command = "UPLOAD {} 0\n".format(size).encode("UTF-8")
+        if size <= len(command):
+            raise ValueError("Upload size must be larger than {} bytes".format(len(command)))
+        series = sample.series = ThroughputSeries()
+        t_start = series.start_ns
+        sock.sendall(command)
+        sent = len(command)
+        for data in SemiRandomPayload(size - len(command) - 1, chunk_size=self.upload_chunk_size):
+            sock.sendall(data)
+            sent += len(data)
+            series.add(sent)
+        sock.sendall(b"\n")
+        t_sent = time.perf_counter_ns()
+        response = self.readline()
+        sample.end_ns = time.perf_counter_ns()
+        if not response.startswith("OK "):
+            raise ValueError("Expected OK response from server, got: {}".format(response.strip()))
+        response_args = response.split()
+        sample.send_ns = t_sent - t_start
+        sample.ttfb_ns = sample.end_ns - t_sent
+        # The final send completes once the data is buffered locally, so
+        # the transfer lasts until the server confirms receipt.
+        sample.transfer_ns = sample.end_ns - t_start
+        sample.transfer_bytes = int(response_args[1])
+        series.finish(sample.end_ns, sample.transfer_bytes)
+        if len(response_args) > 2:
+            sample.server_ns = int(response_args[2]) * 1000000
+        return sample
+
+
+def serve_background(bind, pool_file=None):
+    import threading
+
+    from .server import parse_bind
+
+    server = TCPServer(parse_bind(bind), pool_file=pool_file)
+    logging.info("Listening at: tcp://{}:{}/ (OoklaServer TCP protocol)".format(*server.server_address[:2]))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,162 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+# Span tracing in the Chrome trace event format, viewable in Perfetto
+# (https://ui.perfetto.dev/) or chrome://tracing.  Code holds a
+# NULL_TRACER by default, whose spans do nothing, so tracing costs one
+# method call per span when disabled; anything more expensive is
+# guarded by tracer.enabled.
+
+import collections
+import json
+import os
+import threading
+import time
+
+
+class Span:
+    """Context manager timing a span of code
+
+    Arguments may be added with set() even after the span has ended,
+    as the recorded event shares them.
+    """
+
+    __slots__ = ("tracer", "name", "category", "args", "start_ns", "cpu_start_ns")
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.cpu_start_ns = None
+
+    def __enter__(self):
+        if self.tracer.cpu:
+            self.cpu_start_ns = time.process_time_ns()
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end_ns = time.perf_counter_ns()
+        if self.cpu_start_ns is not None:
+            self.args["cpu_ms"] = (time.process_time_ns() - self.cpu_start_ns) / 1e6
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer.complete(self.name, self.start_ns, end_ns, self.category, args=self.args)
+        return False
+
+    def set(self, **args):
+        self.args.update(args)
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class NullTracer:
+    enabled = False
+    cpu = False
+
+    def span(self, name, category="", **args):
+        return NULL_SPAN
+
+    def complete(self, name, start_ns, end_ns, category="", tid=None, args=None):
+        pass
+
+    def instant(self, name, category="", **args):
+        pass
+
+
+NULL_TRACER = NullTracer()
+
+
+class Tracer:
+    """Records spans as Chrome trace events
+
+    Timestamps are time.perf_counter_ns() values.  With cpu, spans
+    also record the process CPU time used during them.  Only the most
+    recent max_events are kept, so a long-running process does not
+    grow without bound.
+    """
+
+    enabled = True
+
+    def __init__(self, process_name=None, cpu=False, max_events=100000):
+        self.process_name = process_name
+        self.cpu = cpu
+        self.events = collections.deque(maxlen=max_events)
+        self.thread_names = {}
+
+    def tid(self):
+        tid = threading.get_ident()
+        if tid not in self.thread_names:
+            self.thread_names[tid] = threading.current_thread().name
+        return tid
+
+    def span(self, name, category="", **args):
+        return Span(self, name, category, args)
+
+    def complete(self, name, start_ns, end_ns, category="", tid=None, args=None):
+        """Record a span from timestamps already taken"""
+        self.events.append(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": start_ns / 1000,
+                "dur": (end_ns - start_ns) / 1000,
+                "pid": os.getpid(),
+                "tid": self.tid() if tid is None else tid,
+                "args": args or {},
+            }
+        )
+
+    def instant(self, name, category="", **args):
+        self.events.append(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "i",
+                "s": "t",
+                "ts": time.perf_counter_ns() / 1000,
+                "pid": os.getpid(),
+                "tid": self.tid(),
+                "args": args,
+            }
+        )
+
+    def name_thread(self, tid, name):
+        """Name a tid, e.g. one used for spans which are not on a real thread"""
+        self.thread_names[tid] = name
+
+    def export(self):
+        pid = os.getpid()
+        metadata = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+            for tid, name in list(self.thread_names.items())
+        ]
+        if self.process_name is not None:
+            metadata.append({"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": self.process_name}})
+        return {"traceEvents": metadata + list(self.events), "displayTimeUnit": "ms"}
+
+    def dumps(self):
+        return json.dumps(self.export()).encode("UTF-8")
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.export(), f)
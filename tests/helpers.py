@@ -0,0 +1,65 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import asyncio
+import io
+import threading
+import wsgiref.util
+
+from qospeedtest.aioserver import AsyncioServer
+from qospeedtest.server import ServerApplication
+
+
+def make_environ(method, path, query_string="", body=b""):
+    environ = {
+        "REQUEST_METHOD": method,
+        "PATH_INFO": path,
+        "QUERY_STRING": query_string,
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.input": io.BytesIO(body),
+    }
+    wsgiref.util.setup_testing_defaults(environ)
+    return environ
+
+
+class AsyncioServerMixin:
+    """TestCase mixin serving an AsyncioServer from an event loop on a thread
+
+    self.server listens on self.port; listen() starts more listeners
+    on the same loop, which are closed along with any connection
+    handlers still running at tearDown.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.listeners = []
+        self.server = AsyncioServer(ServerApplication(sendfile_max=(1048573 * 2)))
+        self.port = self.listen(self.server.start_server("127.0.0.1", 0))
+
+    def listen(self, start_server):
+        """Run a start_server() coroutine on the loop, returning the port listened on"""
+        listener = asyncio.run_coroutine_threadsafe(start_server, self.loop).result()
+        self.listeners.append(listener)
+        return listener.sockets[0].getsockname()[1]
+
+    def tearDown(self):
+        async def shutdown():
+            for listener in self.listeners:
+                listener.close()
+            # Finish any connection handlers still waiting on their clients
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        super().tearDown()
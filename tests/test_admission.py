@@ -0,0 +1,126 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import multiprocessing
+import os
+import signal
+import threading
+import unittest
+
+from qospeedtest.admission import Admission
+from qospeedtest.server import ServerApplication
+
+from .helpers import make_environ
+
+
+def admit_in_child(admission, count):
+    for i in range(count):
+        admission.admit("192.0.2.1")
+
+
+def die_holding_lock(admission):
+    admission.__enter__()
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+class FailingInput:
+    def read(self, size):
+        raise ConnectionResetError()
+
+
+class TestAdmission(unittest.TestCase):
+    def test_max_transfers(self):
+        application = ServerApplication(admission=Admission(max_transfers=1))
+        status = []
+
+        def start_response(code_str, headers):
+            status.append((code_str, dict(headers)))
+
+        body = application(make_environ("GET", "/download", "size=10"), start_response)
+        self.assertEqual(status[-1][0], "200 OK")
+        b"".join(application(make_environ("GET", "/download", "size=10"), start_response))
+        self.assertEqual(status[-1][0], "503 Service Unavailable")
+        self.assertEqual(status[-1][1]["Retry-After"], "5")
+        b"".join(application(make_environ("POST", "/upload", body=b"x"), start_response))
+        self.assertEqual(status[-1][0], "503 Service Unavailable")
+        # Closing the first download frees its slot
+        self.assertEqual(len(b"".join(body)), 10)
+        body.close()
+        self.assertEqual(application.admission.active, 0)
+        b"".join(application(make_environ("POST", "/upload", body=b"x"), start_response))
+        self.assertEqual(status[-1][0], "200 OK")
+        self.assertEqual(application.admission.active, 0)
+        self.assertIn(
+            'qospeedtest_server_rejected_transfers_total{mode="download"} 1',
+            application.metrics.registry.exposition().decode("UTF-8").splitlines(),
+        )
+
+    def test_token_buckets(self):
+        admission = Admission(client_rate=100, burst_seconds=1.0)
+        transfer = admission.admit("192.0.2.1")
+        # Within the client's burst, then into debt at the client rate
+        self.assertEqual(transfer.delay(100), 0.0)
+        self.assertAlmostEqual(transfer.delay(50), 0.5, places=2)
+        # Other clients have their own buckets
+        self.assertEqual(admission.admit("192.0.2.2").delay(100), 0.0)
+
+        admission = Admission(rate=1000, burst_seconds=1.0)
+        self.assertEqual(admission.admit("192.0.2.1").delay(1000), 0.0)
+        self.assertAlmostEqual(admission.admit("192.0.2.2").delay(100), 0.1, places=2)
+
+    def test_shared_between_processes(self):
+        admission = Admission(max_transfers=10)
+        process = multiprocessing.Process(target=admit_in_child, args=(admission, 3))
+        process.start()
+        process.join()
+        self.assertEqual(admission.active, 3)
+
+    def test_dead_process_reclaimed(self):
+        admission = Admission(max_transfers=3)
+        # A worker killed mid-transfer never releases its transfers
+        process = multiprocessing.Process(target=admit_in_child, args=(admission, 3))
+        process.start()
+        process.join()
+        self.assertEqual(admission.active, 3)
+        self.assertIsNotNone(admission.admit("192.0.2.1"))
+        self.assertEqual(admission.active, 1)
+
+    def test_dead_lock_holder(self):
+        admission = Admission(max_transfers=1)
+        process = multiprocessing.Process(target=die_holding_lock, args=(admission,))
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, -signal.SIGKILL)
+        admitted = []
+        thread = threading.Thread(target=lambda: admitted.append(admission.admit("192.0.2.1")), daemon=True)
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertIsNotNone(admitted[0])
+
+    def test_failed_upload(self):
+        application = ServerApplication(admission=Admission(max_transfers=1))
+        environ = make_environ("POST", "/upload", body=b"x" * 10)
+        environ["wsgi.input"] = FailingInput()
+        with self.assertRaises(ConnectionResetError):
+            application(environ, lambda code_str, headers: None)
+        self.assertEqual(application.admission.active, 0)
+        self.assertIn(
+            'qospeedtest_server_active_transfers{mode="upload"} 0',
+            application.metrics.registry.exposition().decode("UTF-8").splitlines(),
+        )
+
+    @unittest.skipUnless(os.path.exists("/proc/self/stat"), "Needs process start times from /proc")
+    def test_reused_pid_reclaimed(self):
+        admission = Admission(max_transfers=2)
+        process = multiprocessing.Process(target=admit_in_child, args=(admission, 2))
+        process.start()
+        process.join()
+        # Another process, started long before, now has the dead worker's pid
+        pids = admission.shared[admission.processes :: 3]
+        admission.shared[admission.processes + 3 * pids.index(process.pid)] = os.getppid()
+        self.assertIsNotNone(admission.admit("192.0.2.1"))
+        self.assertEqual(admission.active, 1)
@@ -0,0 +1,112 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import http.client
+import os
+import socket
+import threading
+import time
+import unittest
+
+from qospeedtest.admission import Admission
+from qospeedtest.aioserver import AsyncioServer
+from qospeedtest.server import ServerApplication
+from qospeedtest.tracing import Tracer
+
+from .helpers import AsyncioServerMixin
+
+
+class TestAsyncioServer(AsyncioServerMixin, unittest.TestCase):
+    def test_keepalive(self):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port)
+        conn.request("GET", "/hello")
+        r = conn.getresponse()
+        self.assertTrue(r.read().startswith(b"hello "))
+        sock = conn.sock
+        for size in (1, 1048573, 3 * 1048573 + 5):
+            conn.request("GET", "/download?size={}".format(size))
+            r = conn.getresponse()
+            self.assertEqual(len(r.read()), size)
+        # sendfile() must not move the shared pool file's offset
+        self.assertEqual(os.lseek(self.server.application.pool_file.fileno(), 0, os.SEEK_CUR), 0)
+        conn.request("POST", "/upload", body=b"x" * 12345)
+        r = conn.getresponse()
+        self.assertEqual(r.read(), b"size=12345\n")
+        self.assertIn("recv;dur=", r.getheader("Server-Timing"))
+        conn.request("OPTIONS", "/upload", headers={"Origin": "http://example.com"})
+        r = conn.getresponse()
+        r.read()
+        self.assertEqual(r.getheader("Access-Control-Allow-Origin"), "http://example.com")
+        conn.request("PUT", "/upload")
+        r = conn.getresponse()
+        r.read()
+        self.assertEqual(r.status, 405)
+        self.assertIs(conn.sock, sock)
+        conn.close()
+
+    def test_100_continue(self):
+        with socket.create_connection(("127.0.0.1", self.port)) as sock:
+            sock.sendall(b"POST /upload HTTP/1.1\r\nHost: localhost\r\nContent-Length: 5\r\nExpect: 100-continue\r\n\r\n")
+            self.assertEqual(sock.recv(1024), b"HTTP/1.1 100 Continue\r\n\r\n")
+            sock.sendall(b"hello")
+            f = sock.makefile("rb")
+            self.assertEqual(f.readline(), b"HTTP/1.1 200 OK\r\n")
+
+    def test_application_routes(self):
+        application = ServerApplication(tracer=Tracer("qospeedtest-server"))
+        application.get_routes["extra"] = lambda request: application.simple_response(request, "extra")
+        port = self.listen(AsyncioServer(application).start_server("127.0.0.1", 0))
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        for path, status, body in (
+            ("/extra", 200, b"extra\n"),
+            ("/metrics", 200, None),
+            ("/trace", 200, None),
+            ("/missing", 404, b"Not Found\n"),
+        ):
+            conn.request("GET", path)
+            r = conn.getresponse()
+            data = r.read()
+            self.assertEqual(r.status, status)
+            self.assertEqual(int(r.getheader("Content-Length")), len(data))
+            if body is not None:
+                self.assertEqual(data, body)
+        conn.request("POST", "/missing", body=b"x")
+        r = conn.getresponse()
+        r.read()
+        self.assertEqual(r.status, 404)
+        # The unread body means the connection cannot be reused
+        self.assertEqual(r.getheader("Connection"), "close")
+        conn.close()
+
+    def test_admission_off_loop(self):
+        admission = Admission(max_transfers=10)
+        server = AsyncioServer(ServerApplication(admission=admission))
+        port = self.listen(server.start_server("127.0.0.1", 0))
+        results = []
+
+        def download():
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+            conn.request("GET", "/download?size=100")
+            results.append(len(conn.getresponse().read()))
+            conn.close()
+
+        # While the admission lock is held, the download waits for it,
+        # but the event loop keeps answering other requests
+        with admission:
+            thread = threading.Thread(target=download)
+            thread.start()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", "/hello")
+            self.assertTrue(conn.getresponse().read().startswith(b"hello "))
+            conn.close()
+            self.assertEqual(results, [])
+        thread.join()
+        self.assertEqual(results, [100])
+        # Released once the response has been written
+        deadline = time.monotonic() + 2
+        while admission.active and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(admission.active, 0)
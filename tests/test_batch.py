@@ -0,0 +1,46 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import socket
+import unittest
+
+from qospeedtest.batch import Batch
+from qospeedtest.client import QOSpeedTest
+
+
+def closed_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.speedtest = QOSpeedTest()
+        self.speedtest.args = self.speedtest.parse_args(["qospeedtest", "--batch", "--no-history", "--no-latency"])
+        self.speedtest.user_config = {
+            "servers": {
+                "a1": {"url": "http://127.0.0.1:{}".format(closed_port()), "link": "wan"},
+                "a2": {"url": "http://127.0.0.1:{}/".format(closed_port()), "link": "wan"},
+                "b1": {"url": "http://127.0.0.1:{}/".format(closed_port())},
+            },
+            "default_server": None,
+        }
+
+    def test_resolve(self):
+        batch = Batch(self.speedtest, ["a1", "b1", "a2", "http://example.com"])
+        links, failed = batch.resolve()
+        self.assertEqual(failed, [])
+        self.assertEqual([entry["name"] for entry in links["wan"]], ["a1", "a2"])
+        self.assertEqual([entry["name"] for entry in links["default"]], ["b1", "http://example.com"])
+        self.assertTrue(links["wan"][0]["server"].endswith("/"))
+
+    def test_failures_isolated(self):
+        report = Batch(self.speedtest, ["b1", "a1", "a2"], workers=1).run()
+        self.assertEqual([entry["name"] for entry in report["batch"]], ["b1", "a1", "a2"])
+        for entry in report["batch"]:
+            self.assertIsNone(entry["output"])
+            self.assertIn("ConnectionError", entry["error"])
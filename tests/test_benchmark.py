@@ -0,0 +1,47 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import unittest
+
+import qospeedtest
+from qospeedtest import benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_wait_usage(self):
+        proc = subprocess.Popen([sys.executable, "-c", "import sys; sys.exit(3)"])
+        usage = benchmark.wait_usage(proc)
+        self.assertEqual((usage.returncode, proc.returncode), (3, 3))
+
+        proc = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+        proc.terminate()
+        usage = benchmark.wait_usage(proc)
+        self.assertEqual(usage.returncode, -15 if hasattr(os, "wait4") else proc.returncode)
+        self.assertEqual(proc.returncode, usage.returncode)
+
+    def test_report(self):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = str(pathlib.Path(qospeedtest.__file__).resolve().parent.parent)
+        command = [sys.executable, "-m", "qospeedtest.benchmark", "--backend=asyncio", "--mode=download", "--format=json"]
+        command += ["--target-seconds=0.05", "--minimum-samples=2", "--maximum-samples=3"]
+        proc = subprocess.run(command, env=env, capture_output=True, text=True, timeout=120)
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        report = json.loads(proc.stdout)
+        self.assertEqual(report["version"], qospeedtest.__version__)
+        self.assertEqual(len(report["results"]), 1, proc.stderr)
+        row = report["results"][0]
+        self.assertEqual((row["backend"], row["mode"]), ("asyncio", "download"))
+        self.assertGreater(row["bps"], 0)
+        self.assertGreater(row["bytes"], 0)
+        self.assertGreater(row["duration_ns"], 0)
+        if hasattr(os, "wait4"):
+            for key in ("client_cpu_seconds_per_gb", "server_cpu_seconds_per_gb", "client_maxrss_bytes", "server_maxrss_bytes"):
+                self.assertGreater(row[key], 0, key)
@@ -0,0 +1,329 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import asyncio
+import concurrent.futures
+import contextlib
+import io
+import json
+import pathlib
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from qospeedtest import guid
+from qospeedtest.client import QOSpeedTest
+from qospeedtest.httptransport import HTTPTransport
+from qospeedtest.latency import LatencyProbe
+
+from .helpers import AsyncioServerMixin
+
+
+def closed_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def trickle(reader, writer):
+    # Answers a byte at a time, never finishing the response headers
+    try:
+        writer.write(b"HTTP/1.1 200 OK\r\nX-Trickle: ")
+        while True:
+            await asyncio.sleep(0.05)
+            writer.write(b"a")
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def slow_download(reader, writer):
+    # Serves any request as an endless download at about 800 kB/s
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 1073741824\r\n\r\n")
+        while True:
+            writer.write(bytes(8192))
+            await writer.drain()
+            await asyncio.sleep(0.01)
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+def silent_server(testcase):
+    # Connections are queued by the kernel, but never accepted
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen()
+    testcase.addCleanup(sock.close)
+    return "127.0.0.1:{}".format(sock.getsockname()[1])
+
+
+class AutoSelectSpeedTest(QOSpeedTest):
+    servers = ()
+    cache_dir = None
+
+    def get_speedtest_net_servers(self):
+        return list(self.servers)
+
+    def get_cache_dir(self):
+        return self.cache_dir
+
+
+class FailingSpeedTest(QOSpeedTest):
+    """Fails every transfer after the first fail_after, and keeps track of transports"""
+
+    fail_after = 1
+
+    def __init__(self):
+        super().__init__()
+        self.transports = []
+        self.transfers = 0
+
+    def get_transport(self, url_base, stream=0):
+        transport = super().get_transport(url_base, stream)
+        transport.closed = False
+        close = transport.close
+
+        def closing():
+            transport.closed = True
+            close()
+
+        transport.close = closing
+        self.transports.append(transport)
+        return transport
+
+    def transfer(self, transport, mode, size, max_ns=None):
+        self.transfers += 1
+        if self.transfers > self.fail_after:
+            raise ConnectionResetError("Failed transfer")
+        return super().transfer(transport, mode, size, max_ns)
+
+
+class TestParseArgs(unittest.TestCase):
+    def test_location(self):
+        speedtest = QOSpeedTest()
+        self.assertEqual(speedtest.parse_args(["qospeedtest", "--nearby", "--location=51.5,-0.12"]).location, (51.5, -0.12))
+        for location in ("51.5", "51.5,-0.12,3", "north,west", ""):
+            with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()) as stderr:
+                speedtest.parse_args(["qospeedtest", "--nearby", "--location={}".format(location)])
+            self.assertIn("expected LAT,LON", stderr.getvalue())
+
+
+class TestClient(AsyncioServerMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.url_base = self.url(self.port)
+
+    def url(self, port):
+        return "http://127.0.0.1:{}/".format(port)
+
+    def speedtest(self, *argv, cls=QOSpeedTest):
+        speedtest = cls()
+        speedtest.args = speedtest.parse_args(
+            [
+                "qospeedtest",
+                "--no-history",
+                "--target-seconds=0.01",
+                "--initial-download=65536",
+                "--initial-upload=65536",
+                "--minimum-samples=2",
+                "--maximum-samples=4",
+            ]
+            + list(argv)
+        )
+        speedtest.user_config = {"servers": {}, "default_server": None}
+        speedtest.session_guid = guid()
+        speedtest.http_session = speedtest.new_http_session()
+        speedtest.is_tty = False
+        self.addCleanup(speedtest.http_session.close)
+        return speedtest
+
+    def test_streams(self):
+        speedtest = self.speedtest("--no-latency", "--streams=3", "--include-samples", "--format=json")
+        for mode in ("download", "upload"):
+            result = speedtest.do_test(mode, self.url_base)
+            self.assertEqual(result["streams"], 3)
+            self.assertEqual(result["transfers"], len(result["sample_list"]))
+            self.assertEqual(result["bytes"], sum(record["bytes"] for record in result["sample_list"]))
+            for record in result["sample_list"]:
+                self.assertEqual(len(record["streams"]), 3)
+                self.assertEqual(record["bytes"], sum(stream["bytes"] for stream in record["streams"]))
+                self.assertTrue(all(stream["bytes"] > 0 for stream in record["streams"]))
+
+    def test_parallel_transfer_small(self):
+        speedtest = self.speedtest()
+        transports = [speedtest.get_transport(self.url_base, stream=i) for i in range(3)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            # Fewer bytes than streams, where a stream of 0 bytes would be a default sized download
+            sample = speedtest.parallel_transfer(executor, transports, "download", 2)
+        for transport in transports:
+            transport.close()
+        self.assertEqual(sample.transfer_bytes, 2)
+        self.assertEqual([stream.transfer_bytes for stream in sample.streams], [1, 1])
+
+    def test_failed_test_cleanup(self):
+        speedtest = self.speedtest("--no-latency", "--streams=2", cls=FailingSpeedTest)
+        threads = set(threading.enumerate())
+        with self.assertRaises(ConnectionResetError):
+            speedtest.do_test("download", self.url_base)
+        self.assertEqual(len(speedtest.transports), 2)
+        self.assertTrue(all(transport.closed for transport in speedtest.transports))
+        # The executor's threads are shut down
+        self.assertEqual(set(threading.enumerate()) - threads, set())
+
+    def test_failed_test_stops_latency_probe(self):
+        speedtest = self.speedtest("--latency-interval=0.01", cls=FailingSpeedTest)
+        threads = set(threading.enumerate())
+        with self.assertRaises(ConnectionResetError):
+            speedtest.do_test("download", self.url_base)
+        # The stream's transport, then the latency probe's
+        self.assertEqual(len(speedtest.transports), 2)
+        self.assertTrue(all(transport.closed for transport in speedtest.transports))
+        self.assertEqual(set(threading.enumerate()) - threads, set())
+
+    def test_latency_probe(self):
+        speedtest = self.speedtest()
+        probe = LatencyProbe(speedtest.get_transport(self.url_base, stream=1), interval=0.01)
+        self.addCleanup(probe.transport.close)
+        stats = probe.run(5)
+        self.assertEqual((stats.count, stats.lost), (5, 0))
+        self.assertGreater(stats.min_ns, 0)
+
+        threads = set(threading.enumerate())
+        probe.start()
+        time.sleep(0.1)
+        self.assertEqual(len(set(threading.enumerate()) - threads), 1)
+        stats = probe.stop()
+        self.assertEqual(set(threading.enumerate()) - threads, set())
+        self.assertGreater(stats.count, 0)
+        self.assertEqual(stats.lost, 0)
+        # Stopping again changes nothing
+        self.assertEqual(probe.stop().count, stats.count)
+
+        # Probes without a response are counted as lost
+        probe = LatencyProbe(speedtest.get_transport("http://127.0.0.1:{}/".format(closed_port()), stream=1), interval=0)
+        self.addCleanup(probe.transport.close)
+        stats = probe.run(3)
+        self.assertEqual((stats.count, stats.lost), (0, 3))
+        self.assertIsNone(stats.median_ns)
+
+    def test_probe_server(self):
+        speedtest = self.speedtest()
+        self.assertGreater(speedtest.probe_server({"host": self.url_base[7:-1]}, time.monotonic() + 5), 0)
+        self.assertIsNone(speedtest.probe_server({"host": "127.0.0.1:{}".format(closed_port())}, time.monotonic() + 5))
+        t_start = time.monotonic()
+        self.assertIsNone(speedtest.probe_server({"host": silent_server(self)}, time.monotonic() + 0.2))
+        self.assertLess(time.monotonic() - t_start, 1.0)
+
+    def test_auto_select(self):
+        live = self.url_base[7:-1]
+        hosts = [
+            "127.0.0.1:{}".format(self.listen(asyncio.start_server(trickle, "127.0.0.1", 0))),
+            silent_server(self),
+            "127.0.0.1:{}".format(closed_port()),
+            live,
+        ]
+        speedtest = self.speedtest("--select-timeout=0.5", cls=AutoSelectSpeedTest)
+        speedtest.servers = [{"host": host, "name": "Test", "cc": "US", "sponsor": "Test"} for host in hosts]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            speedtest.cache_dir = pathlib.Path(tmpdir)
+            t_start = time.monotonic()
+            server = speedtest.auto_select_server()
+            # A total budget, even with a server which keeps sending
+            self.assertLess(time.monotonic() - t_start, 1.0)
+            self.assertEqual(server["host"], live)
+            self.assertGreater(server["rtt_ns"], 0)
+            ranking = json.loads(speedtest.cache_dir.joinpath("speedtest-servers-ranking.json").read_text())
+            self.assertEqual([server["host"] for server in ranking], [live])
+
+            # The cached ranking is used without probing again
+            speedtest.servers = []
+            self.assertEqual(speedtest.auto_select_server()["host"], live)
+            speedtest.cache_dir = pathlib.Path(tmpdir, "empty")
+            with self.assertRaises(ValueError):
+                speedtest.auto_select_server()
+
+    def test_json_format(self):
+        speedtest = self.speedtest("--format=json", "--include-samples", "--latency-samples=2", "--latency-interval=0")
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            output = speedtest.run_tests(self.url_base)
+        document = json.loads(stdout.getvalue())
+        self.assertEqual(document, json.loads(json.dumps(output)))
+        self.assertEqual(document["server"], self.url_base)
+        self.assertEqual(document["session"], speedtest.session_guid)
+        self.assertEqual(document["latency"]["count"], 2)
+        self.assertEqual([result["mode"] for result in document["results"]], ["download", "upload"])
+        for result in document["results"]:
+            self.assertEqual(result["type"], "result")
+            self.assertGreater(result["bps"], 0)
+            self.assertIsNotNone(result["loaded_latency"])
+            samples = result["sample_list"]
+            self.assertEqual([sample["index"] for sample in samples], list(range(result["transfers"])))
+            self.assertEqual(sum(sample["bytes"] for sample in samples), result["bytes"])
+            self.assertEqual(sum(not sample["rampup"] for sample in samples), result["samples"])
+            for sample in samples:
+                self.assertEqual((sample["type"], sample["mode"]), ("sample", result["mode"]))
+                self.assertIn("series", sample)
+
+        # Without --include-samples, only the summary
+        speedtest = self.speedtest("--format=json", "--no-latency", "--no-upload")
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            speedtest.run_tests(self.url_base)
+        document = json.loads(stdout.getvalue())
+        self.assertIsNone(document["latency"])
+        self.assertNotIn("sample_list", document["results"][0])
+
+    def test_ndjson_format(self):
+        speedtest = self.speedtest("--format=ndjson", "--include-samples", "--latency-samples=2", "--latency-interval=0")
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            speedtest.run_tests(self.url_base)
+        records = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual(records[0]["type"], "latency")
+        self.assertEqual(records[0]["count"], 2)
+        # Each test's samples as they happen, then its result
+        results = [i for i, record in enumerate(records) if record["type"] == "result"]
+        self.assertEqual([records[i]["mode"] for i in results], ["download", "upload"])
+        self.assertEqual(results[-1], len(records) - 1)
+        start = 1
+        for i in results:
+            samples = records[start:i]
+            self.assertEqual([sample["type"] for sample in samples], ["sample"] * records[i]["transfers"])
+            self.assertEqual({sample["mode"] for sample in samples}, {records[i]["mode"]})
+            self.assertEqual(sum(sample["bytes"] for sample in samples), records[i]["bytes"])
+            self.assertNotIn("sample_list", records[i])
+            start = i + 1
+
+        speedtest = self.speedtest("--format=ndjson", "--no-latency")
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            speedtest.run_tests(self.url_base)
+        self.assertEqual([json.loads(line)["type"] for line in stdout.getvalue().splitlines()], ["result", "result"])
+
+    def test_download_cut_off(self):
+        speedtest = self.speedtest()
+        transport = HTTPTransport(speedtest, self.url(self.listen(asyncio.start_server(slow_download, "127.0.0.1", 0))))
+        t_start = time.perf_counter_ns()
+        sample = transport.download(1 << 30, max_ns=200000000)
+        # Well before the 1.3 seconds a 1 MiB chunk would take to arrive
+        self.assertLess(time.perf_counter_ns() - t_start, 600000000)
+        self.assertGreaterEqual(sample.transfer_ns, 200000000)
+        self.assertLess(sample.transfer_ns, 300000000)
+        self.assertGreater(sample.transfer_bytes, 0)
+
+    def test_download_series(self):
+        speedtest = self.speedtest()
+        transport = HTTPTransport(speedtest, self.url(self.listen(asyncio.start_server(slow_download, "127.0.0.1", 0))))
+        sample = transport.download(1 << 30, max_ns=300000000)
+        # Progress every 10 ms or so, rather than per MiB
+        points = sample.series.points
+        self.assertGreaterEqual(len(points), 10)
+        self.assertLess(max(b[0] - a[0] for a, b in zip(points, points[1:])), 50000000)
+        self.assertEqual(points[-1], (sample.end_ns - sample.series.start_ns, sample.transfer_bytes))
+        self.assertIsNotNone(sample.series.steady_bps())
@@ -0,0 +1,79 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import datetime
+import os
+import tempfile
+import unittest
+
+from qospeedtest import history
+
+
+def make_output(when, download_bps, upload_bps):
+    def result(mode, bps):
+        return {
+            "server": "http://example.com/",
+            "mode": mode,
+            "bps": bps,
+            "bytes": 1000,
+            "duration_ns": 1000000000,
+            "samples": 10,
+            "stdev_bps": 1.0,
+            "min_bps": bps,
+            "max_bps": bps,
+            "loaded_latency": None,
+        }
+
+    return {
+        "session": "test",
+        "time": when.isoformat(),
+        "latency": {"median_ns": 1000000},
+        "results": [result("download", download_bps), result("upload", upload_bps)],
+    }
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "qospeedtest", "history.sqlite3")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_rollups(self):
+        store = history.History(self.path)
+        start = datetime.datetime(2024, 1, 1, 12, tzinfo=datetime.timezone.utc)
+        for day in range(3):
+            for i in range(10):
+                store.add(make_output(start + datetime.timedelta(days=day, minutes=i), 100e6 * (day + 1) + i * 1e6, 10e6))
+            # Rollups are merged across separate writes of the same day
+            store.flush()
+        store.add(make_output(start + datetime.timedelta(days=2, hours=1), 300e6, 10e6))
+        store.close()
+
+        store = history.History(self.path)
+        self.assertEqual(store.db.execute("SELECT COUNT(*) FROM results").fetchone()[0], 62)
+        summaries = {summary["mode"]: summary for summary in store.summary(since=start.timestamp())}
+        download = summaries["download"]
+        self.assertEqual(download["count"], 31)
+        self.assertEqual([day["count"] for day in download["days"]], [10, 10, 11])
+        self.assertEqual(download["min_bps"], 100e6)
+        self.assertEqual(download["max_bps"], 309e6)
+        # Percentiles come from the rollup histograms, within a bucket
+        self.assertAlmostEqual(download["median_bps"] / 200e6, 1, delta=0.1)
+        self.assertGreater(download["trend"], 0)
+        self.assertEqual(summaries["upload"]["trend"], 0)
+
+        later = (start + datetime.timedelta(days=2)).timestamp()
+        self.assertEqual(store.summary(mode="download", since=later)[0]["count"], 11)
+        self.assertEqual(store.summary(server="http://other.example.com/"), [])
+        store.close()
+
+    def test_buckets_percentile(self):
+        buckets = {history.bucket_index(v): 1 for v in (1e6, 2e6, 4e6, 8e6)}
+        self.assertAlmostEqual(history.buckets_percentile(buckets, 0.5) / 2e6, 1, delta=0.1)
+        self.assertAlmostEqual(history.buckets_percentile(buckets, 1.0) / 8e6, 1, delta=0.1)
+        self.assertIsNone(history.buckets_percentile({}, 0.5))
@@ -0,0 +1,92 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import argparse
+import asyncio
+import concurrent.futures
+import multiprocessing
+import unittest
+
+from qospeedtest import loadgen
+from qospeedtest.aioserver import AsyncioServer
+from qospeedtest.server import ServerApplication
+
+from .helpers import AsyncioServerMixin
+
+
+def make_options(**kwargs):
+    options = argparse.Namespace(
+        target_seconds=0.01,
+        ewma_weight=8.0,
+        initial_download=1024,
+        initial_upload=1024,
+        minimum_samples=2,
+        maximum_samples=3,
+        timeout=10.0,
+        chunk_size=65536,
+    )
+    vars(options).update(kwargs)
+    return options
+
+
+class TestLoadGenerator(unittest.TestCase):
+    def test_jain_index(self):
+        self.assertEqual(loadgen.jain_index([5, 5, 5, 5]), 1.0)
+        self.assertEqual(loadgen.jain_index([1, 0, 0, 0]), 0.25)
+        self.assertIsNone(loadgen.jain_index([]))
+
+    def test_run_clients(self):
+        options = make_options()
+
+        async def run(mode):
+            server = AsyncioServer(ServerApplication(sendfile_max=(1048573 * 2)))
+            listener = await server.start_server("127.0.0.1", 0)
+            url = "http://127.0.0.1:{}/".format(listener.sockets[0].getsockname()[1])
+            try:
+                return await loadgen.run_clients(url, mode, 4, options)
+            finally:
+                listener.close()
+
+        for mode in ("download", "upload"):
+            results = asyncio.run(run(mode))
+            summary = loadgen.summarize(mode, 4, results, 10**9)
+            self.assertEqual(summary["errors"], 0, summary["error_examples"])
+            self.assertEqual(summary["clients"], 4)
+            self.assertGreater(summary["client_bps_min"], 0)
+
+
+class TestLevels(AsyncioServerMixin, unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.url_base = "http://127.0.0.1:{}/".format(self.port)
+
+    def test_shared_level(self):
+        # One of two clients of a level, the other being in another process
+        remaining = multiprocessing.Value("l", 2)
+
+        async def run():
+            task = asyncio.ensure_future(loadgen.run_clients(self.url_base, "download", 1, make_options(), remaining))
+            await asyncio.sleep(0.3)
+            self.assertFalse(task.done())
+            self.assertEqual(remaining.value, 1)
+            loadgen.Level(remaining).finished()
+            return await asyncio.wait_for(task, 10)
+
+        (result,) = asyncio.run(run())
+        self.assertIsNone(result["error"])
+        self.assertGreater(result["transfers"], 0)
+
+    def test_processes(self):
+        remaining = multiprocessing.Value("l", 0)
+        options = make_options(processes=2)
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=2, initializer=loadgen.init_worker, initargs=(remaining,)
+        ) as executor:
+            for count in (3, 1):
+                summary = loadgen.run_level(executor, self.url_base, "download", count, options, remaining)
+                self.assertEqual(summary["errors"], 0, summary["error_examples"])
+                self.assertEqual(summary["clients"], count)
+                self.assertEqual(remaining.value, 0)
@@ -0,0 +1,53 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import gc
+import threading
+import unittest
+
+from qospeedtest import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter_threads(self):
+        counter = metrics.Counter("test_total", "Test")
+
+        def work():
+            for i in range(1000):
+                counter.inc()
+
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc(5)
+        self.assertEqual(counter.get(), 8005)
+        # Exited threads are folded into the retired totals
+        del threads, thread
+        gc.collect()
+        self.assertEqual(counter.get(), 8005)
+        self.assertEqual(len(counter._default._cells._shards), 1)
+
+    def test_exposition(self):
+        registry = metrics.Registry()
+        registry.counter("test_bytes_total", "Bytes", ["mode"]).labels("download").inc(10)
+        registry.gauge("test_active", "Active").set(2)
+        histogram = registry.histogram("test_seconds", "Seconds", buckets=(1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+        lines = registry.exposition().decode("UTF-8").splitlines()
+        self.assertIn("# TYPE test_bytes_total counter", lines)
+        self.assertIn('test_bytes_total{mode="download"} 10', lines)
+        self.assertIn("test_active 2", lines)
+        self.assertIn('test_seconds_bucket{le="1"} 2', lines)
+        self.assertIn('test_seconds_bucket{le="5"} 3', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn("test_seconds_sum 14.5", lines)
+        self.assertIn("test_seconds_count 4", lines)
+
+    def test_label_escaping(self):
+        self.assertEqual(metrics.format_labels((("a", 'x"y\\'),)), '{a="x\\"y\\\\"}')
@@ -0,0 +1,238 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import concurrent.futures
+import io
+import os
+import pathlib
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+import wsgiref.util
+
+import qospeedtest
+from qospeedtest.server import DownloadBody, PoolFile, ServerApplication
+
+from .helpers import make_environ
+
+
+class TestServerApplication(unittest.TestCase):
+    def setUp(self):
+        self.application = ServerApplication(sendfile_max=(1048573 * 2))
+
+    def request(self, environ):
+        status = []
+
+        def start_response(code_str, headers):
+            status.append((code_str, dict(headers)))
+
+        iterable = self.application(environ, start_response)
+        body = b"".join(iterable)
+        if hasattr(iterable, "close"):
+            iterable.close()
+        return status[0][0], status[0][1], body
+
+    def test_hello(self):
+        code_str, headers, body = self.request(make_environ("GET", "/hello"))
+        self.assertEqual(code_str, "200 OK")
+        self.assertTrue(body.startswith(b"hello "))
+
+    def test_download_file_wrapper(self):
+        for size in (1, 1048573, 1048574, 3 * 1048573 + 5):
+            environ = make_environ("GET", "/download", "size={}".format(size))
+            environ["wsgi.file_wrapper"] = wsgiref.util.FileWrapper
+            code_str, headers, body = self.request(environ)
+            self.assertEqual(int(headers["Content-Length"]), size)
+            self.assertEqual(body, b"".join(qospeedtest.SemiRandomGenerator(size)))
+
+    def test_download_generator(self):
+        environ = make_environ("GET", "/download", "size=1048574")
+        environ.pop("wsgi.file_wrapper", None)
+        code_str, headers, body = self.request(environ)
+        self.assertEqual(len(body), 1048574)
+
+    def test_upload(self):
+        code_str, headers, body = self.request(make_environ("POST", "/upload", body=b"x" * 12345))
+        self.assertEqual(body, b"size=12345\n")
+        self.assertTrue(headers["Server-Timing"].startswith("recv;dur="))
+
+    def test_drain_input(self):
+        class ReadOnly:
+            def __init__(self, data):
+                self.stream = io.BytesIO(data)
+
+            def read(self, size):
+                return self.stream.read(size)
+
+        application = ServerApplication(upload_chunk_size=1000)
+        for stream in (io.BytesIO(b"x" * 12345), ReadOnly(b"x" * 12345)):
+            received, t_receive = application.drain_input(stream, 12345)
+            self.assertEqual(received, 12345)
+        # Short body
+        received, t_receive = application.drain_input(io.BytesIO(b"x" * 500), 12345)
+        self.assertEqual(received, 500)
+
+    def test_not_found(self):
+        code_str, headers, body = self.request(make_environ("GET", "/nonexistent"))
+        self.assertEqual(code_str, "404 Not Found")
+        code_str, headers, body = self.request(make_environ("POST", "/nonexistent"))
+        self.assertEqual(code_str, "404 Not Found")
+        code_str, headers, body = self.request(make_environ("DELETE", "/hello"))
+        self.assertEqual(code_str, "405 Method Not Allowed")
+
+    def test_metrics(self):
+        environ = make_environ("GET", "/download", "size=1048574")
+        environ["wsgi.file_wrapper"] = wsgiref.util.FileWrapper
+        self.request(environ)
+        environ = make_environ("GET", "/download", "size=3000000")
+        body = self.application(environ, lambda code_str, headers: None)
+        next(iter(body))
+        body.close()
+        environ = make_environ("POST", "/upload", body=b"x" * 500)
+        environ["CONTENT_LENGTH"] = "1000"
+        self.request(environ)
+
+        code_str, headers, body = self.request(make_environ("GET", "/metrics"))
+        self.assertEqual(code_str, "200 OK")
+        lines = body.decode("UTF-8").splitlines()
+        self.assertIn('qospeedtest_server_transfers_total{mode="download"} 2', lines)
+        self.assertIn('qospeedtest_server_transfer_bytes_total{mode="download"} 2097147', lines)
+        self.assertIn('qospeedtest_server_client_aborts_total{mode="download"} 1', lines)
+        self.assertIn('qospeedtest_server_transfer_bytes_total{mode="upload"} 500', lines)
+        self.assertIn('qospeedtest_server_client_aborts_total{mode="upload"} 1', lines)
+        self.assertIn('qospeedtest_server_active_transfers{mode="download"} 0', lines)
+
+    def test_metrics_disabled(self):
+        self.application = ServerApplication(metrics=False)
+        code_str, headers, body = self.request(make_environ("GET", "/metrics"))
+        self.assertEqual(code_str, "404 Not Found")
+
+    def test_concurrent_requests(self):
+        threads = 32
+        barrier = threading.Barrier(threads)
+
+        def worker(n):
+            barrier.wait()
+            results = []
+            for i in range(20):
+                size = (n * 1000) + i + 1
+                if i % 2:
+                    environ = make_environ("GET", "/download", "size={}".format(size))
+                    environ["wsgi.file_wrapper"] = wsgiref.util.FileWrapper
+                    code_str, headers, body = self.request(environ)
+                    results.append((size, int(headers["Content-Length"]), len(body)))
+                else:
+                    code_str, headers, body = self.request(make_environ("POST", "/upload", body=b"x" * size))
+                    results.append((size, size, int(body.decode("UTF-8").strip().split("=")[1])))
+            return results
+
+        # Force frequent thread switches so requests interleave.
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+                all_results = list(executor.map(worker, range(threads)))
+        finally:
+            sys.setswitchinterval(switch_interval)
+        for results in all_results:
+            for expected, header_size, body_size in results:
+                self.assertEqual(header_size, expected)
+                self.assertEqual(body_size, expected)
+
+
+class TestDownloadBody(unittest.TestCase):
+    def test_fileno(self):
+        pool_file = PoolFile(1048573 * 2)
+        self.assertEqual(pool_file.size, 1048573 * 2)
+        self.assertEqual(DownloadBody(pool_file.size, pool_file).fileno(), pool_file.fileno())
+        with self.assertRaises(io.UnsupportedOperation):
+            DownloadBody(pool_file.size + 1, pool_file).fileno()
+        self.assertEqual(os.lseek(pool_file.fileno(), 0, os.SEEK_CUR), 0)
+
+    def test_reopen(self):
+        pool_file = PoolFile(1048573)
+        try:
+            f = pool_file.reopen()
+        except io.UnsupportedOperation:
+            self.skipTest("No /proc/self/fd")
+        with f:
+            self.assertEqual(f.read(16), qospeedtest.random_pool()[:16])
+        self.assertEqual(os.lseek(pool_file.fileno(), 0, os.SEEK_CUR), 0)
+
+    def sendfile_closed(self, received_limit):
+        """socket.sendfile() a body as Gunicorn does, to a client which closes after received_limit"""
+        pool_file = PoolFile(1048573 * 2)
+        closed = []
+        body = DownloadBody(pool_file.size, pool_file, on_close=lambda sent, length: closed.append((sent, length)))
+        server, client = socket.socketpair()
+
+        def receive():
+            received = 0
+            while received < received_limit:
+                data = client.recv(65536)
+                if not data:
+                    break
+                received += len(data)
+            client.close()
+
+        thread = threading.Thread(target=receive)
+        thread.start()
+        try:
+            server.sendfile(body, offset=0, count=body.length)
+        except OSError:
+            pass
+        finally:
+            thread.join()
+            server.close()
+            body.close()
+        self.assertEqual(os.lseek(pool_file.fileno(), 0, os.SEEK_CUR), 0)
+        return closed
+
+    def test_sendfile_sent(self):
+        closed = self.sendfile_closed(1048573 * 2)
+        self.assertEqual(closed, [(1048573 * 2, 1048573 * 2)])
+
+    def test_sendfile_aborted(self):
+        ((sent, length),) = self.sendfile_closed(65536)
+        self.assertLess(sent, length)
+
+    def test_close_unsent(self):
+        # Offered for sendfile() but closed without a completed send
+        pool_file = PoolFile(1048573 * 2)
+        closed = []
+        body = DownloadBody(1000, pool_file, on_close=lambda sent, length: closed.append((sent, length)))
+        body.fileno()
+        body.close()
+        self.assertEqual(closed, [(0, 1000)])
+
+    def test_memory_mapped_pool(self):
+        # A separate process, as the pool is created once per process
+        with tempfile.TemporaryDirectory() as tmpdir:
+            env = dict(os.environ)
+            env["PYTHONPATH"] = str(pathlib.Path(qospeedtest.__file__).resolve().parent.parent)
+            env["QOSPEEDTEST_POOL_FILE"] = os.path.join(tmpdir, "pool")
+            env["QOSPEEDTEST_POOL_SIZE"] = str(3 * 1048576)
+            script = (
+                "import qospeedtest, wsgiref.util\n"
+                "from qospeedtest.server import DownloadBody, block_size\n"
+                "pool = qospeedtest.random_pool()\n"
+                "assert not isinstance(pool, bytes) and len(pool) == 3145721, len(pool)\n"
+                "assert block_size() == 1048576\n"
+                "size = 2 * len(pool) + 5\n"
+                "blocks = list(wsgiref.util.FileWrapper(DownloadBody(size), block_size()))\n"
+                "assert all(type(block) is bytes for block in blocks)\n"
+                "assert all(type(block) is bytes for block in qospeedtest.SemiRandomGenerator(size))\n"
+                "assert b''.join(blocks) == b''.join(qospeedtest.SemiRandomGenerator(size))\n"
+                "print(pool[:16].hex())\n"
+            )
+            first = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True, check=True)
+            second = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True, check=True)
+            # The same file is reused by later processes
+            self.assertEqual(first.stdout, second.stdout)
+            self.assertEqual(os.path.getsize(env["QOSPEEDTEST_POOL_FILE"]), 3145721)
@@ -0,0 +1,49 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import io
+import os
+import tempfile
+import unittest
+
+from qospeedtest.servers import ServerList
+
+SERVERS_XML = b"""<?xml version="1.0" encoding="UTF-8"?>
+<settings>
+<servers>
+<server url="http://a.example.com:8080/speedtest/upload.php" lat="45.5" lon="-122.6" name="Portland, OR"
+ country="United States" cc="US" sponsor="Example A" id="101" host="a.example.com:8080" />
+<server url="http://b.example.com:8080/speedtest/upload.php" lat="47.6" lon="-122.3" name="Seattle, WA"
+ country="United States" cc="US" sponsor="Example B" id="102" host="b.example.com:8080" />
+<server url="http://c.example.com:8080/speedtest/upload.php" lat="51.5" lon="-0.1" name="London"
+ country="United Kingdom" cc="GB" sponsor="Example C" id="103" host="c.example.com:8080" />
+</servers>
+</settings>
+"""
+
+
+class TestServerList(unittest.TestCase):
+    def setUp(self):
+        self.servers = ServerList.from_xml(io.BytesIO(SERVERS_XML))
+
+    def test_from_xml(self):
+        self.assertEqual([server["id"] for server in self.servers], ["101", "102", "103"])
+        self.assertEqual(self.servers.servers[0]["lat"], 45.5)
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "speedtest-servers.json")
+            self.servers.save(path)
+            self.assertEqual(ServerList.load(path).servers, self.servers.servers)
+
+    def test_get(self):
+        self.assertEqual(self.servers.get(102)["sponsor"], "Example B")
+        self.assertEqual(self.servers.get("c.example.com:8080")["id"], "103")
+        self.assertIsNone(self.servers.get("999"))
+
+    def test_nearest(self):
+        nearest = self.servers.nearest(51.0, 0.0, count=2)
+        self.assertEqual([server["id"] for server in nearest], ["103", "102"])
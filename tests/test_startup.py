@@ -0,0 +1,54 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import os
+import pathlib
+import subprocess
+import sys
+import unittest
+
+import qospeedtest
+
+# Total import time budget for qospeedtest --version, in microseconds.
+# Generous, as CI machines vary; a regression which pulls requests etc
+# back in at import time is caught by test_lazy_modules regardless.
+IMPORT_BUDGET_US = 250000
+
+HEAVY_MODULES = ("requests", "urllib3", "yaml", "xml.etree.ElementTree", "statistics", "concurrent.futures", "sqlite3")
+
+
+class TestStartup(unittest.TestCase):
+    def run_python(self, *args):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = str(pathlib.Path(qospeedtest.__file__).resolve().parent.parent)
+        return subprocess.run([sys.executable] + list(args), env=env, capture_output=True, text=True, check=True)
+
+    def test_lazy_modules(self):
+        res = self.run_python(
+            "-c",
+            "import sys, qospeedtest, qospeedtest.client; " "print(' '.join(sys.modules)); print(qospeedtest._random_pool is None)",
+        )
+        modules, random_pool_unset = res.stdout.splitlines()
+        for module in HEAVY_MODULES:
+            self.assertNotIn(module, modules.split())
+        self.assertEqual(random_pool_unset, "True")
+
+    def test_version_import_time(self):
+        res = self.run_python("-X", "importtime", "-m", "qospeedtest.client", "--version")
+        self.assertEqual(res.stdout.strip(), qospeedtest.__version__)
+        modules = []
+        total_us = 0
+        for line in res.stderr.splitlines():
+            fields = line.split("|")
+            if len(fields) != 3 or not fields[1].strip().isdigit():
+                continue
+            modules.append(fields[2].strip())
+            # Nested imports are indented, and included in their parent's time
+            if not fields[2].startswith("  "):
+                total_us += int(fields[1])
+        for module in HEAVY_MODULES:
+            self.assertNotIn(module, modules)
+        self.assertLess(total_us, IMPORT_BUDGET_US)
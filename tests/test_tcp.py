@@ -0,0 +1,76 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import socket
+import threading
+import time
+import unittest
+
+from qospeedtest.server import PoolFile
+from qospeedtest.tcp import TCPClient, TCPServer
+
+
+class TestTCP(unittest.TestCase):
+    pool_file = None
+
+    def setUp(self):
+        self.server = TCPServer(("127.0.0.1", 0), pool_file=self.pool_file)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = TCPClient("tcp://127.0.0.1:{}/".format(self.server.server_address[1]))
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_hello(self):
+        self.assertTrue(self.client.hello().startswith("HELLO "))
+        self.assertGreater(self.client.ping(), 0)
+
+    def test_download(self):
+        for size in (10, 100, 1048573, 3 * 1048573 + 5):
+            sample = self.client.download(size)
+            self.assertEqual(sample.transfer_bytes, size)
+            self.assertGreater(sample.bps, 0)
+        self.assertTrue(self.client.hello().startswith("HELLO "))
+
+    def test_upload(self):
+        for size in (100, 1048573, 3 * 1048573 + 5):
+            sample = self.client.upload(size)
+            self.assertEqual(sample.transfer_bytes, size)
+            self.assertGreater(sample.bps, 0)
+        self.assertTrue(self.client.hello().startswith("HELLO "))
+
+
+class TestTCPTiming(unittest.TestCase):
+    def test_download_timed_from_request(self):
+        # Answers a download after a delay, all in a single send
+        listener = socket.create_server(("127.0.0.1", 0))
+        self.addCleanup(listener.close)
+
+        def serve():
+            conn, addr = listener.accept()
+            with conn:
+                conn.recv(1024)
+                time.sleep(0.2)
+                conn.sendall(bytes(1000))
+                conn.recv(1024)
+
+        thread = threading.Thread(target=serve, daemon=True)
+        thread.start()
+        client = TCPClient("tcp://127.0.0.1:{}/".format(listener.getsockname()[1]))
+        self.addCleanup(client.close)
+        sample = client.download(1000)
+        self.assertEqual(sample.transfer_bytes, 1000)
+        # The bytes of the first recv arrived during the wait for it
+        self.assertGreaterEqual(sample.ttfb_ns, 150000000)
+        self.assertGreaterEqual(sample.transfer_ns, sample.ttfb_ns)
+        self.assertLess(sample.bps, 1000 * 8 / 0.15)
+        self.assertEqual(sample.series.points[-1][1], 1000)
+
+
+class TestTCPPoolFile(TestTCP):
+    pool_file = PoolFile(1048573 * 2)
@@ -0,0 +1,81 @@
+# SPDX-PackageName: qospeedtest
+# SPDX-PackageSupplier: Ryan Finnie <ryan@finnie.org>
+# SPDX-PackageDownloadLocation: https://github.com/rfinnie/qospeedtest
+# SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
+# SPDX-License-Identifier: MPL-2.0
+
+import json
+import unittest
+
+from qospeedtest.server import ServerApplication
+from qospeedtest.tracing import NULL_TRACER, Tracer
+
+from .helpers import make_environ
+
+
+class TestTracing(unittest.TestCase):
+    def test_spans(self):
+        tracer = Tracer("test", cpu=True)
+        with tracer.span("outer", "test", a=1) as outer:
+            with tracer.span("inner"):
+                pass
+        # Arguments may still be added once the span has ended
+        outer.set(b=2)
+        with self.assertRaises(ValueError):
+            with tracer.span("failed"):
+                raise ValueError()
+        tracer.complete("phase", 1000, 3000, "phase", tid=7)
+        tracer.name_thread(7, "stream 0")
+
+        trace = json.loads(tracer.dumps())
+        events = {event["name"]: event for event in trace["traceEvents"]}
+        inner, outer = events["inner"], events["outer"]
+        self.assertEqual(outer["ph"], "X")
+        self.assertLessEqual(outer["ts"], inner["ts"])
+        self.assertGreaterEqual(outer["ts"] + outer["dur"], inner["ts"] + inner["dur"])
+        self.assertEqual(outer["args"]["a"], 1)
+        self.assertEqual(outer["args"]["b"], 2)
+        self.assertIn("cpu_ms", outer["args"])
+        self.assertEqual(events["failed"]["args"]["error"], "ValueError")
+        self.assertEqual((events["phase"]["ts"], events["phase"]["dur"], events["phase"]["tid"]), (1.0, 2.0, 7))
+        self.assertIn(
+            {"name": "thread_name", "ph": "M", "pid": outer["pid"], "tid": 7, "args": {"name": "stream 0"}}, trace["traceEvents"]
+        )
+
+    def test_max_events(self):
+        tracer = Tracer(max_events=10)
+        for i in range(20):
+            tracer.instant("event", i=i)
+        self.assertEqual([event["args"]["i"] for event in tracer.events], list(range(10, 20)))
+
+    def test_null_tracer(self):
+        self.assertFalse(NULL_TRACER.enabled)
+        with NULL_TRACER.span("span") as span:
+            span.set(a=1)
+        self.assertIsNone(NULL_TRACER.complete("phase", 0, 1))
+
+    def test_server_trace(self):
+        application = ServerApplication(tracer=Tracer("qospeedtest-server"))
+        status = []
+        remote_addr = "192.0.2.1"
+
+        def start_response(code_str, headers):
+            status.append(code_str)
+
+        def request(method, path, query_string="", body=b""):
+            environ = make_environ(method, path, query_string, body)
+            environ["REMOTE_ADDR"] = remote_addr
+            iterable = application(environ, start_response)
+            data = b"".join(iterable)
+            if hasattr(iterable, "close"):
+                iterable.close()
+            return data
+
+        request("GET", "/download", "size=100")
+        request("POST", "/upload", body=b"x" * 10)
+        events = json.loads(request("GET", "/trace"))["traceEvents"]
+        self.assertEqual(status[-1], "200 OK")
+        transfers = [(event["name"], event["args"]["bytes"]) for event in events if event.get("cat") == "transfer"]
+        self.assertEqual(transfers, [("download", 100), ("upload", 10)])
+        # The trace is public, so must not expose client addresses
+        self.assertNotIn(remote_addr, json.dumps(events))
@@ -4,11 +4,159 @@
 # SPDX-FileCopyrightText: © 2019 Ryan Finnie <ryan@finnie.org>
 # SPDX-License-Identifier: MPL-2.0
 
+import time
 import unittest
 
 import qospeedtest
+from qospeedtest.convergence import ConfidenceConvergence, EWMAConvergence, t_quantile
+from qospeedtest.latency import LatencyStats
+from qospeedtest.stats import P2Quantile, StreamingStats
 
 
 class TestUtils(unittest.TestCase):
     def test_guid(self):
         self.assertEqual(len(qospeedtest.guid()), 36)
+
+    def test_semi_random_generator(self):
+        blocks = list(qospeedtest.SemiRandomGenerator(2 * 1048573 + 5))
+        self.assertEqual([len(block) for block in blocks], [1048573, 1048573, 5])
+        self.assertTrue(all(type(block) is bytes for block in blocks))
+
+    def test_semi_random_payload(self):
+        for chunk_size in (None, 65536, 1000000):
+            payload = qospeedtest.SemiRandomPayload(chunk_size=chunk_size)
+            for byte_count in (0, 1, 1048573, 1048574, 3 * 1048573 + 5):
+                payload.byte_count = byte_count
+                self.assertEqual(len(payload), byte_count)
+                self.assertEqual(sum(len(chunk) for chunk in payload), byte_count)
+                self.assertLessEqual(max((len(chunk) for chunk in payload), default=0), chunk_size or 1048573)
+                self.assertEqual(b"".join(payload), b"".join(qospeedtest.SemiRandomGenerator(byte_count)))
+
+    def test_semi_random_payload_series(self):
+        # Each slice is handed over at about 8 MB/s
+        payload = qospeedtest.SemiRandomPayload(1048576, chunk_size=16384)
+        payload.series = qospeedtest.ThroughputSeries()
+        for chunk in payload:
+            time.sleep(0.002)
+        payload.series.finish(time.perf_counter_ns(), 1048576)
+        points = payload.series.points
+        self.assertGreaterEqual(len(points), 6)
+        self.assertLess(max(b[0] - a[0] for a, b in zip(points, points[1:])), 50000000)
+        self.assertEqual([transferred for offset, transferred in points], sorted(transferred for offset, transferred in points))
+
+    def test_pool_size(self):
+        self.assertEqual(qospeedtest.pool_size(1 << 20), 1048573)
+        self.assertEqual(qospeedtest.pool_size(0), 1048573)
+        self.assertEqual(qospeedtest.pool_size(1 << 30), qospeedtest.pool_size(64 << 20))
+        for size in (1048573, 5 << 20, 64 << 20):
+            n = qospeedtest.pool_size(size)
+            self.assertTrue(qospeedtest.is_prime(n))
+            self.assertLessEqual(n, size)
+        self.assertFalse(qospeedtest.is_prime(1 << 20))
+
+    def test_latency_stats(self):
+        stats = LatencyStats([5, 1, 3, 2, 4], lost=1)
+        self.assertEqual(stats.count, 5)
+        self.assertEqual(stats.min_ns, 1)
+        self.assertEqual(stats.median_ns, 3)
+        self.assertEqual(stats.p99_ns, 5)
+        self.assertEqual(stats.jitter_ns, 2.25)
+        self.assertIsNone(LatencyStats([]).median_ns)
+
+    def test_ewma_convergence(self):
+        convergence = EWMAConvergence(1e9, 1000, minimum_samples=3, maximum_samples=5)
+        # A short ramp-up sample only sizes the next request
+        self.assertFalse(convergence.add(8e6, 1e6))
+        self.assertTrue(convergence.rampup)
+        self.assertEqual(convergence.projected_bytes, 1000000)
+        for i in range(3):
+            self.assertFalse(convergence.done)
+            self.assertTrue(convergence.add(8e6, 1e9))
+        self.assertTrue(convergence.done)
+        self.assertEqual(convergence.bps, 8e6)
+        self.assertEqual(convergence.stats.count, 3)
+
+    def test_t_quantile(self):
+        for p, df, expected in ((0.975, 1, 12.706), (0.975, 2, 4.303), (0.975, 4, 2.776), (0.975, 9, 2.262), (0.95, 30, 1.697)):
+            self.assertAlmostEqual(t_quantile(p, df), expected, places=2)
+
+    def test_confidence_convergence(self):
+        convergence = ConfidenceConvergence(1e9, 1000, relative_error=0.05, minimum_samples=3)
+        self.assertFalse(convergence.add(8e6, 1e8))
+        self.assertEqual(convergence.projected_bytes, 1000000)
+        # Half the target time is enough to count
+        self.assertTrue(convergence.add(100e6, 5e8))
+        self.assertTrue(convergence.add(101e6, 1e9))
+        self.assertFalse(convergence.done)
+        self.assertTrue(convergence.add(99e6, 1e9))
+        self.assertTrue(convergence.done)
+        self.assertAlmostEqual(convergence.bps, 100e6)
+        # Noisy samples keep going
+        convergence = ConfidenceConvergence(1e9, 1000, relative_error=0.05, minimum_samples=3)
+        for bps in (50e6, 150e6, 60e6):
+            convergence.add(bps, 1e9)
+        self.assertFalse(convergence.done)
+
+    def test_confidence_convergence_constant(self):
+        convergence = ConfidenceConvergence(1e9, 1000, relative_error=0.05, minimum_samples=3)
+        for i in range(2):
+            convergence.add(100e6, 1e9)
+        self.assertFalse(convergence.done)
+        self.assertEqual(convergence.confidence, 1.0)
+        self.assertIn("+/- 0.0%", convergence.status())
+        convergence.add(100e6, 1e9)
+        self.assertTrue(convergence.done)
+        # Nothing transferred at all
+        convergence = ConfidenceConvergence(1e9, 1000, relative_error=0.05, minimum_samples=3)
+        for i in range(2):
+            convergence.add(0.0, 1e9)
+        self.assertEqual(convergence.confidence, 0.0)
+        self.assertIn("(2 samples)", convergence.status())
+
+    def test_streaming_stats(self):
+        import random
+        import statistics
+
+        rng = random.Random(1)
+        values = [rng.gauss(100e6, 10e6) for i in range(2000)]
+        stats = StreamingStats(ewma_weight=8.0, quantiles=(0.1, 0.5, 0.9))
+        ewma = qospeedtest.EWMA(8.0)
+        for value in values:
+            stats.add(value)
+            ewma.add(value)
+        self.assertEqual(stats.count, 2000)
+        self.assertAlmostEqual(stats.mean / statistics.mean(values), 1.0)
+        self.assertAlmostEqual(stats.stdev / statistics.stdev(values), 1.0)
+        self.assertEqual((stats.min, stats.max), (min(values), max(values)))
+        self.assertAlmostEqual(stats.ewma / ewma.average, 1.0)
+        deciles = statistics.quantiles(values, n=10)
+        for p, expected in ((0.1, deciles[0]), (0.5, deciles[4]), (0.9, deciles[8])):
+            self.assertAlmostEqual(stats.quantile(p) / expected, 1.0, delta=0.01)
+        self.assertIsNone(StreamingStats().stdev)
+
+    def test_p2_quantile_small(self):
+        quantile = P2Quantile(0.5)
+        self.assertIsNone(quantile.value)
+        for value in (4, 1, 3, 2):
+            quantile.add(value)
+        self.assertEqual(quantile.value, 2.5)
+
+    def test_throughput_series(self):
+        series = qospeedtest.ThroughputSeries(interval_ns=10)
+        # Slow start: 1 then 2 bytes per ns, then a steady 10 bytes per ns
+        series.points = [(0, 0), (10, 10), (20, 30), (30, 130), (40, 230), (50, 330)]
+        series.finish(series.start_ns + 60, 430)
+        self.assertEqual(series.points[-1], (60, 430))
+        self.assertEqual(series.steady_bps(), 10 * 8e9)
+        # The head is never more than half of the transfer
+        series.points = [(0, 0), (10, 10), (20, 20), (30, 30), (40, 1000)]
+        self.assertEqual(series.steady_bps(), (1000 - 20) * 8e9 / 20)
+        series.points = [(0, 0), (10, 10)]
+        self.assertIsNone(series.steady_bps())
+
+    def test_sample_steady_bps(self):
+        sample = qospeedtest.Sample("download")
+        sample.transfer_bytes = 1000
+        sample.transfer_ns = 1000
+        self.assertEqual(sample.steady_bps, sample.bps)
+        self.assertNotIn("series", sample.as_dict())